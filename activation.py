@@ -31,12 +31,13 @@ class Dice(nn.Module):
 
     def forward(self, x):
         assert x.dim() == self.dim
+        # batch statistics in float32, under autocast x may be half precision
         if self.dim == 2:
-            x_p = self.sigmoid(self.bn(x))
+            x_p = self.sigmoid(self.bn(x.float()))
             out = self.alpha * (1 - x_p) * x + x_p * x
         else:
             x = torch.transpose(x, 1, 2)
-            x_p = self.sigmoid(self.bn(x))
+            x_p = self.sigmoid(self.bn(x.float()))
             out = self.alpha * (1 - x_p) * x + x_p * x
             out = torch.transpose(out, 1, 2)
         return out
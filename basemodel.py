@@ -12,9 +12,8 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.utils.data as Data
+from torch.nn.parallel.scatter_gather import scatter
 from sklearn.metrics import *
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 # try:
@@ -23,14 +22,31 @@ from tensorflow.python.keras.callbacks import CallbackList
 #     from tensorflow.python.keras._impl.keras.callbacks import CallbackList
 
 from inputs import build_input_features, SparseFeat, DenseFeat, VarLenSparseFeat, get_varlen_pooling_list, \
-    create_embedding_matrix, varlen_embedding_lookup
+    create_embedding_matrix, varlen_embedding_lookup, build_input_plan, FeatureBatch, get_input, input_to_device, \
+    split_feature_columns, build_varlen_pooling_layers
 from layers import PredictionLayer
-from utils import slice_arrays
+from utils import slice_arrays, TensorBatchIterator
 from callbacks import History
 
 
+class FeatureBatchDataParallel(nn.DataParallel):
+    """DataParallel over models whose input is a FeatureBatch, which the default scatter can not split.
+    Every typed block of the batch is split along its rows, each replica gets the same rows of all the blocks.
+    """
+
+    def scatter(self, inputs, kwargs, device_ids):
+        if len(inputs) != 1 or not isinstance(inputs[0], FeatureBatch):
+            return super(FeatureBatchDataParallel, self).scatter(inputs, kwargs, device_ids)
+        if kwargs:
+            raise ValueError("FeatureBatchDataParallel does not scatter keyword arguments")
+        X = inputs[0]
+        # blocks have the same number of rows, so they are split into the same chunks
+        chunks = scatter(X.blocks, device_ids, dim=self.dim)
+        return tuple((FeatureBatch(blocks, X.plan),) for blocks in chunks), tuple({} for _ in chunks)
+
+
 class Linear(nn.Module):
-    def __init__(self, feature_columns, feature_index, init_std=0.0001, device='cpu'):
+    def __init__(self, feature_columns, feature_index, init_std=0.0001, device='cpu', sparse_embedding=False):
         super(Linear, self).__init__()
         self.feature_index = feature_index
         self.device = device
@@ -42,8 +58,9 @@ class Linear(nn.Module):
         self.varlen_sparse_feature_columns = list(
             filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if len(feature_columns) else []
 
-        self.embedding_dict = create_embedding_matrix(feature_columns, init_std, linear=True, sparse=False,
-                                                      device=device)
+        self.embedding_dict = create_embedding_matrix(feature_columns, init_std, linear=True,
+                                                      sparse=sparse_embedding, device=device)
+        self.varlen_pooling_layers = build_varlen_pooling_layers(self.varlen_sparse_feature_columns, device)
 
         #         nn.ModuleDict(
         #             {feat.embedding_name: nn.Embedding(feat.dimension, 1, sparse=True) for feat in
@@ -61,20 +78,21 @@ class Linear(nn.Module):
     def forward(self, X, sparse_feat_refine_weight=None):
 
         sparse_embedding_list = [self.embedding_dict[feat.embedding_name](
-            X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]].long()) for
+            get_input(X, self.feature_index, feat.name).long()) for
             feat in self.sparse_feature_columns]
 
-        dense_value_list = [X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]] for feat in
+        dense_value_list = [get_input(X, self.feature_index, feat.name).float() for feat in
                             self.dense_feature_columns]
 
         sequence_embed_dict = varlen_embedding_lookup(X, self.embedding_dict, self.feature_index,
                                                       self.varlen_sparse_feature_columns)
         varlen_embedding_list = get_varlen_pooling_list(sequence_embed_dict, X, self.feature_index,
-                                                        self.varlen_sparse_feature_columns, self.device)
+                                                        self.varlen_sparse_feature_columns, self.device,
+                                                        pooling_layers=self.varlen_pooling_layers)
 
         sparse_embedding_list += varlen_embedding_list
 
-        linear_logit = torch.zeros([X.shape[0], 1]).to(self.device)
+        linear_logit = torch.zeros([len(X), 1]).to(self.device)
         if len(sparse_embedding_list) > 0:
             sparse_embedding_cat = torch.cat(sparse_embedding_list, dim=-1)
             if sparse_feat_refine_weight is not None:
@@ -92,7 +110,7 @@ class Linear(nn.Module):
 
 class BaseModel(nn.Module):
     def __init__(self, linear_feature_columns, dnn_feature_columns, l2_reg_linear=1e-5, l2_reg_embedding=1e-5,
-                 init_std=0.0001, seed=1024, task='binary', device='cpu', gpus=None):
+                 init_std=0.0001, seed=1024, task='binary', device='cpu', gpus=None, sparse_embedding=False):
 
         super(BaseModel, self).__init__()
         torch.manual_seed(seed)
@@ -108,18 +126,37 @@ class BaseModel(nn.Module):
 
         self.feature_index = build_input_features(
             linear_feature_columns + dnn_feature_columns)
+        # layout of the same features as a FeatureBatch
+        self.input_plan = build_input_plan(
+            linear_feature_columns + dnn_feature_columns)
         self.dnn_feature_columns = dnn_feature_columns
+        # (sparse, dense, varlen sparse) columns of the deep part, split once instead of in every forward pass
+        self.dnn_feature_column_groups = split_feature_columns(dnn_feature_columns)
 
-        self.embedding_dict = create_embedding_matrix(dnn_feature_columns, init_std, sparse=False, device=device)
+        self.sparse_embedding = sparse_embedding
+        self.embedding_dict = create_embedding_matrix(dnn_feature_columns, init_std, sparse=sparse_embedding,
+                                                      device=device)
+        self.varlen_pooling_layers = build_varlen_pooling_layers(self.dnn_feature_column_groups[2], device)
         #         nn.ModuleDict(
         #             {feat.embedding_name: nn.Embedding(feat.dimension, embedding_size, sparse=True) for feat in
         #              self.dnn_feature_columns}
         #         )
 
         self.linear_model = Linear(
-            linear_feature_columns, self.feature_index, device=device)
+            linear_feature_columns, self.feature_index, device=device, sparse_embedding=sparse_embedding)
 
         self.regularization_weight = []
+        self.regularization_mode = "full"
+        # {embedding_name: [vocabulary_size] row scale}, see set_regularization_mode
+        self.regularization_row_scale = {}
+        # {id(embedding weight): (embedding_name, input names looked up in it, sparse gradients)}
+        self.embedding_inputs = {}
+        for embedding_dict, feature_columns in ((self.embedding_dict, dnn_feature_columns),
+                                                (self.linear_model.embedding_dict, linear_feature_columns)):
+            for embedding_name, embedding in embedding_dict.items():
+                names = [fc.name for fc in feature_columns
+                         if isinstance(fc, (SparseFeat, VarLenSparseFeat)) and fc.embedding_name == embedding_name]
+                self.embedding_inputs[id(embedding.weight)] = (embedding_name, names, embedding.sparse)
 
         self.add_regularization_weight(self.embedding_dict.parameters(), l2=l2_reg_embedding)
         self.add_regularization_weight(self.linear_model.parameters(), l2=l2_reg_linear)
@@ -184,14 +221,9 @@ class BaseModel(nn.Module):
         else:
             val_x = []
             val_y = []
-        for i in range(len(x)):
-            if len(x[i].shape) == 1:
-                x[i] = np.expand_dims(x[i], axis=1)
-
-        train_tensor_data = Data.TensorDataset(
-            torch.from_numpy(
-                np.concatenate(x, axis=-1)),
-            torch.from_numpy(y))
+        # typed input blocks, ids are never cast to float
+        train_x = FeatureBatch.from_arrays(dict(zip(self.feature_index, x)), self.input_plan)
+        train_y = torch.from_numpy(y)
         if batch_size is None:
             batch_size = 256
 
@@ -201,15 +233,15 @@ class BaseModel(nn.Module):
 
         if self.gpus:
             print('parallel running on these gpus:', self.gpus)
-            model = torch.nn.DataParallel(model, device_ids=self.gpus)
+            model = FeatureBatchDataParallel(model, device_ids=self.gpus)
             batch_size *= len(self.gpus)  # input `batch_size` is batch_size per gpu
         else:
             print(self.device)
 
-        train_loader = DataLoader(
-            dataset=train_tensor_data, shuffle=shuffle, batch_size=batch_size)
+        train_loader = TensorBatchIterator(
+            train_x, train_y, batch_size=batch_size, shuffle=shuffle)
 
-        sample_num = len(train_tensor_data)
+        sample_num = len(train_x)
         steps_per_epoch = (sample_num - 1) // batch_size + 1
 
         # configure callbacks
@@ -224,7 +256,7 @@ class BaseModel(nn.Module):
 
         # Train
         print("Train on {0} samples, validate on {1} samples, {2} steps per epoch".format(
-            len(train_tensor_data), len(val_y), steps_per_epoch))
+            sample_num, len(val_y), steps_per_epoch))
         for epoch in range(initial_epoch, epochs):
             callbacks.on_epoch_begin(epoch)
             epoch_logs = {}
@@ -235,7 +267,7 @@ class BaseModel(nn.Module):
             try:
                 with tqdm(enumerate(train_loader), disable=verbose != 1) as t:
                     for _, (x_train, y_train) in t:
-                        x = x_train.to(self.device).float()
+                        x = input_to_device(x_train, self.device)
                         y = y_train.to(self.device).float()
 
                         y_pred = model(x).squeeze()
@@ -248,7 +280,7 @@ class BaseModel(nn.Module):
                                 [loss_func[i](y_pred[:, i], y[:, i], reduction='sum') for i in range(self.num_tasks)])
                         else:
                             loss = loss_func(y_pred, y.squeeze(), reduction='sum')
-                        reg_loss = self.get_regularization_loss()
+                        reg_loss = self.get_regularization_loss(x)
 
                         total_loss = loss + reg_loss + self.aux_loss
 
@@ -326,19 +358,14 @@ class BaseModel(nn.Module):
         model = self.eval()
         if isinstance(x, dict):
             x = [x[feature] for feature in self.feature_index]
-        for i in range(len(x)):
-            if len(x[i].shape) == 1:
-                x[i] = np.expand_dims(x[i], axis=1)
-
-        tensor_data = Data.TensorDataset(
-            torch.from_numpy(np.concatenate(x, axis=-1)))
-        test_loader = DataLoader(
-            dataset=tensor_data, shuffle=False, batch_size=batch_size)
+        test_loader = TensorBatchIterator(
+            FeatureBatch.from_arrays(dict(zip(self.feature_index, x)), self.input_plan),
+            batch_size=batch_size, shuffle=False)
 
         pred_ans = []
         with torch.no_grad():
-            for _, x_test in enumerate(test_loader):
-                x = x_test[0].to(self.device).float()
+            for x_test, in test_loader:
+                x = input_to_device(x_test, self.device)
 
                 y_pred = model(x).cpu().data.numpy()  # .squeeze()
                 pred_ans.append(y_pred)
@@ -347,13 +374,12 @@ class BaseModel(nn.Module):
 
     def input_from_feature_columns(self, X, feature_columns, embedding_dict, support_dense=True):
 
-        sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
-        dense_feature_columns = list(
-            filter(lambda x: isinstance(x, DenseFeat), feature_columns)) if len(feature_columns) else []
-
-        varlen_sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if feature_columns else []
+        if feature_columns is self.dnn_feature_columns:
+            sparse_feature_columns, dense_feature_columns, varlen_sparse_feature_columns = \
+                self.dnn_feature_column_groups
+        else:
+            sparse_feature_columns, dense_feature_columns, varlen_sparse_feature_columns = \
+                split_feature_columns(feature_columns)
 
         if not support_dense and len(dense_feature_columns) > 0:
             raise ValueError(
@@ -382,7 +408,7 @@ class BaseModel(nn.Module):
         # print(X.shape)
         # exit()
         sparse_embedding_list = [embedding_dict[feat.embedding_name](
-            X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]].long()) for
+            get_input(X, self.feature_index, feat.name).long()) for
             feat in sparse_feature_columns]
 
         sequence_embed_dict = varlen_embedding_lookup(X, self.embedding_dict, self.feature_index,
@@ -390,10 +416,11 @@ class BaseModel(nn.Module):
         varlen_sparse_embedding_list = get_varlen_pooling_list(
             sequence_embed_dict, X, self.feature_index,
             varlen_sparse_feature_columns,
-            self.device
+            self.device,
+            pooling_layers=self.varlen_pooling_layers if feature_columns is self.dnn_feature_columns else None
         )
 
-        dense_value_list = [X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]] for feat in
+        dense_value_list = [get_input(X, self.feature_index, feat.name).float() for feat in
                             dense_feature_columns]
 
         return sparse_embedding_list + varlen_sparse_embedding_list, dense_value_list
@@ -428,21 +455,74 @@ class BaseModel(nn.Module):
             weight_list = list(weight_list)
         self.regularization_weight.append((weight_list, l1, l2))
 
-    def get_regularization_loss(self, ):
+    def set_regularization_mode(self, mode, feature_counts=None):
+        """
+        :param mode: str, ``"full"`` to penalize the whole embedding tables, ``"batch"`` to only penalize the embedding rows looked up by the batch, ``"batch_freq"`` to also scale the penalty of every row by the inverse of its frequency (mini-batch aware regularization of DIN).
+        :param feature_counts: dict, {embedding_name: 1D array, number of occurrences of every id in the training data}. Required by ``"batch_freq"``.
+        """
+        if mode not in ("full", "batch", "batch_freq"):
+            raise ValueError("Unrecognized regularization mode " + str(mode))
+        self.regularization_mode = mode
+        self.regularization_row_scale = {}
+        if mode == "batch_freq":
+            if feature_counts is None:
+                raise ValueError("feature_counts are required by the batch_freq regularization mode")
+            for embedding_name, counts in feature_counts.items():
+                counts = torch.as_tensor(np.asarray(counts), dtype=torch.float32, device=self.device)
+                self.regularization_row_scale[embedding_name] = 1.0 / torch.clamp(counts, min=1.0)
+
+    def _embedding_row_penalty(self, X, parameter, l1, l2):
+        # penalty of the rows of an embedding table looked up by the batch X, gathered with
+        # F.embedding so that sparse tables keep sparse gradients
+        embedding_name, names, sparse = self.embedding_inputs[id(parameter)]
+        if len(names) == 0:
+            return 0
+        rows = torch.unique(torch.cat([get_input(X, self.feature_index, name).reshape(-1).long()
+                                       for name in names]))
+        # 0 pads the histories, it is not a looked up id
+        rows = rows[rows != 0]
+        weight = F.embedding(rows.to(parameter.device), parameter, sparse=sparse)
+        row_penalty = torch.zeros(len(rows), device=weight.device)
+        if l1 > 0:
+            row_penalty = row_penalty + l1 * torch.sum(torch.abs(weight), dim=1)
+        if l2 > 0:
+            row_penalty = row_penalty + l2 * torch.sum(torch.square(weight), dim=1)
+        if self.regularization_mode == "batch_freq":
+            row_penalty = row_penalty * self.regularization_row_scale[embedding_name][rows]
+        return torch.sum(row_penalty)
+
+    def get_regularization_loss(self, X=None):
+        # X: model input of the batch, needed by the batch regularization modes (without it,
+        # whole embedding tables are penalized)
         total_reg_loss = torch.zeros((1,), device=self.device)
+        lazy = self.regularization_mode != "full" and X is not None
         for weight_list, l1, l2 in self.regularization_weight:
+            if l1 <= 0 and l2 <= 0:
+                continue
+            dense_weights = []
             for w in weight_list:
                 if isinstance(w, tuple):
                     parameter = w[1]  # named_parameters
                 else:
                     parameter = w
-                if l1 > 0:
-                    total_reg_loss += torch.sum(l1 * torch.abs(parameter))
-                if l2 > 0:
-                    try:
+                if id(parameter) not in self.embedding_inputs:
+                    dense_weights.append(parameter)
+                elif lazy:
+                    total_reg_loss += self._embedding_row_penalty(X, parameter, l1, l2)
+                else:
+                    if l1 > 0:
+                        total_reg_loss += torch.sum(l1 * torch.abs(parameter))
+                    if l2 > 0:
                         total_reg_loss += torch.sum(l2 * torch.square(parameter))
-                    except AttributeError:
-                        total_reg_loss += torch.sum(l2 * parameter * parameter)
+            if len(dense_weights) == 0:
+                continue
+
+            # one fused penalty over all the non-embedding weights of the group: the norms of all
+            # the tensors are computed by a single multi-tensor kernel, without copying the weights
+            if l1 > 0:
+                total_reg_loss += l1 * torch.stack(torch._foreach_norm(dense_weights, 1)).sum()
+            if l2 > 0:
+                total_reg_loss += l2 * torch.stack(torch._foreach_norm(dense_weights, 2)).pow(2).sum()
 
         return total_reg_loss
 
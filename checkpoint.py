@@ -0,0 +1,319 @@
+# Asynchronous, sharded checkpoints. A checkpoint is a directory holding one file per large
+# tensor (embedding tables and their optimizer accumulators), one file with everything else,
+# and a manifest listing them. Saving only copies the state to CPU memory in the caller,
+# the files are then written in background threads, the shards in parallel.
+# The manifest is written last and atomically renamed into place, a checkpoint directory
+# without manifest (e.g. after a crash during the write) is incomplete and never loaded.
+# Delta checkpoints only hold the embedding rows (and their optimizer accumulator rows)
+# changed since the last full checkpoint, which they reference, the other tensors in full.
+# Tags (e.g. the validation results of the epoch) can be added to a checkpoint once saved
+import os
+import json
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from optimizers import split_embedding_parameters
+
+MANIFEST_NAME = 'manifest.json'
+META_SHARD_NAME = 'meta.pt'
+# marks a tensor moved to its own shard, in the structure saved in META_SHARD_NAME
+SHARD_REF_KEY = '__checkpoint_shard__'
+# marks the changed rows of a tensor, in a delta checkpoint
+DELTA_ROWS_KEY = '__delta_rows__'
+# path of the full checkpoint of a delta checkpoint, relative to the delta's directory
+DELTA_BASE_KEY = 'delta_base'
+# values attached to a checkpoint after it was saved (e.g. its validation results)
+TAGS_NAME = 'tags.json'
+
+
+# copy of a (nested dict/list/tuple) checkpoint whose tensors are detached copies in CPU memory
+def snapshot_state(obj):
+    if isinstance(obj, torch.Tensor):
+        tensor = obj.detach()
+        return tensor.clone() if tensor.device.type == 'cpu' else tensor.cpu()
+    if isinstance(obj, dict):
+        return {key: snapshot_state(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(value) for value in obj)
+    return obj
+
+
+# (checkpoint whose tensors of at least min_shard_bytes are replaced by shard references,
+# {shard file name: tensor})
+def split_shards(obj, min_shard_bytes, shards=None):
+    if shards is None:
+        shards = {}
+    if isinstance(obj, torch.Tensor):
+        if obj.element_size() * obj.nelement() < min_shard_bytes:
+            return obj, shards
+        name = f'tensor_{len(shards)}.pt'
+        shards[name] = obj
+        return {SHARD_REF_KEY: name}, shards
+    if isinstance(obj, dict):
+        obj = {key: split_shards(value, min_shard_bytes, shards)[0] for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        obj = type(obj)(split_shards(value, min_shard_bytes, shards)[0] for value in obj)
+    return obj, shards
+
+
+def _join_shards(obj, load_shard):
+    if isinstance(obj, dict):
+        if set(obj) == {SHARD_REF_KEY}:
+            return load_shard(obj[SHARD_REF_KEY])
+        return {key: _join_shards(value, load_shard) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_join_shards(value, load_shard) for value in obj)
+    return obj
+
+
+def _save_file(obj, path):
+    with open(path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# checkpoints hold more than tensors (history, data cursor with python and numpy RNG states),
+# which the weights_only default of recent torch versions refuses to unpickle. Torch versions
+# before 1.13 have no weights_only argument and always unpickle everything
+_LOAD_KWARGS = (
+    {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+)
+
+
+def _load_file(path, map_location=None):
+    return torch.load(path, map_location=map_location, **_LOAD_KWARGS)
+
+
+# write a snapshot (see snapshot_state) as a checkpoint directory, shards in parallel
+def write_checkpoint(state, checkpoint_dir, num_workers=4, min_shard_bytes=1 << 20):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest_path = os.path.join(checkpoint_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        # the previous checkpoint is invalid as soon as its shards start being replaced
+        os.remove(manifest_path)
+
+    meta, shards = split_shards(state, min_shard_bytes)
+    files = dict(shards, **{META_SHARD_NAME: meta})
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        futures = [
+            executor.submit(_save_file, obj, os.path.join(checkpoint_dir, name))
+            for name, obj in files.items()
+        ]
+        for future in futures:
+            future.result()
+
+    # written last, a checkpoint without it is incomplete
+    manifest = {
+        'meta': META_SHARD_NAME,
+        'shards': {
+            name: os.path.getsize(os.path.join(checkpoint_dir, name)) for name in files
+        },
+    }
+    with open(f'{manifest_path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+# checkpoint saved by torch.save or by write_checkpoint, delta checkpoints are applied to
+# their full checkpoint
+def load_checkpoint(path, map_location=None):
+    if not os.path.isdir(path):
+        return _load_file(path, map_location=map_location)
+
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        raise Exception(f'Incomplete checkpoint {path}, it has no {MANIFEST_NAME}')
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    for name, num_bytes in manifest['shards'].items():
+        if os.path.getsize(os.path.join(path, name)) != num_bytes:
+            raise Exception(f'Checkpoint shard {name} of {path} does not match the manifest')
+
+    meta = _load_file(os.path.join(path, manifest['meta']), map_location=map_location)
+    checkpoint = _join_shards(
+        meta, lambda name: _load_file(os.path.join(path, name), map_location=map_location)
+    )
+    if DELTA_BASE_KEY in checkpoint:
+        base_path = os.path.join(os.path.dirname(os.path.abspath(path)), checkpoint[DELTA_BASE_KEY])
+        base = load_checkpoint(base_path, map_location=map_location)
+        checkpoint = apply_delta(base, checkpoint)
+        checkpoint.pop(DELTA_BASE_KEY, None)
+    return checkpoint
+
+
+# add tags (a json serializable dict) to a checkpoint directory, possibly still being written
+def tag_checkpoint(checkpoint_dir, tags):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    tags = dict(read_checkpoint_tags(checkpoint_dir), **tags)
+    tags_path = os.path.join(checkpoint_dir, TAGS_NAME)
+    with open(f'{tags_path}.tmp', 'w') as f:
+        json.dump(tags, f, indent=2)
+    os.replace(f'{tags_path}.tmp', tags_path)
+
+
+# tags of a checkpoint, {} when it has none
+def read_checkpoint_tags(path):
+    tags_path = os.path.join(path, TAGS_NAME)
+    if not os.path.isdir(path) or not os.path.exists(tags_path):
+        return {}
+    with open(tags_path, 'r') as f:
+        return json.load(f)
+
+
+class EmbeddingRowTracker(object):
+    """Rows of the embedding tables of a model changed since the last ``reset``, read from the
+    gradients of every step: with Adagrad, a row whose gradient is zero keeps its weights and
+    accumulators. ``update`` is called between the backward pass and the optimizer step.
+    :param model: the model, whose ``nn.Embedding`` weights are tracked.
+    :param optimizer: its optimizer (or SplitOptimizer), whose per-row states are tracked too.
+    """
+
+    def __init__(self, model, optimizer):
+        self.optimizer = optimizer
+        self.params, _ = split_embedding_parameters(model)
+        self.changed = [
+            torch.zeros(p.shape[0], dtype=torch.bool, device=p.device) for p in self.params
+        ]
+
+    def update(self):
+        for p, changed in zip(self.params, self.changed):
+            grad = p.grad
+            if grad is None:
+                continue
+            if grad.is_sparse:
+                # duplicated rows of an uncoalesced gradient are marked twice
+                changed[grad._indices()[0]] = True
+            else:
+                changed |= grad.ne(0).any(dim=1)
+
+    def reset(self):
+        for changed in self.changed:
+            changed.zero_()
+
+    def changed_rows(self):
+        # {data pointer of a weight or optimizer state tensor: [N] changed row indices}
+        optimizers = getattr(self.optimizer, 'optimizers', [self.optimizer])
+        rows = {}
+        for p, changed in zip(self.params, self.changed):
+            indices = changed.nonzero().view(-1).cpu()
+            tensors = [p] + [
+                value
+                for optimizer in optimizers
+                for value in optimizer.state.get(p, {}).values()
+                if isinstance(value, torch.Tensor)
+                and value.dim() > 0
+                and value.shape[0] == p.shape[0]
+            ]
+            for tensor in tensors:
+                rows[tensor.data_ptr()] = indices
+        return rows
+
+
+# delta of a checkpoint (as saved in full) whose tensors found in changed_rows only keep their
+# changed rows, base_path: full checkpoint relative to the directory of the delta
+def make_delta(checkpoint, changed_rows, base_path):
+    def delta(obj):
+        if isinstance(obj, torch.Tensor):
+            rows = changed_rows.get(obj.data_ptr()) if obj.dim() > 0 and obj.nelement() else None
+            if rows is None:
+                return obj
+            return {DELTA_ROWS_KEY: rows, 'values': obj.detach()[rows.to(obj.device)]}
+        if isinstance(obj, dict):
+            return {key: delta(value) for key, value in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(delta(value) for value in obj)
+        return obj
+
+    return dict(delta(checkpoint), **{DELTA_BASE_KEY: base_path})
+
+
+# full checkpoint of a delta, the changed rows are written into the tensors of base
+def apply_delta(base, delta):
+    if isinstance(delta, dict):
+        if DELTA_ROWS_KEY in delta:
+            base[delta[DELTA_ROWS_KEY]] = delta['values'].to(base.dtype)
+            return base
+        return {
+            key: apply_delta(base[key], value) if isinstance(base, dict) and key in base else value
+            for key, value in delta.items()
+        }
+    if isinstance(delta, (list, tuple)) and isinstance(base, (list, tuple)):
+        if len(base) == len(delta):
+            return type(delta)(apply_delta(b, d) for b, d in zip(base, delta))
+    return delta
+
+
+class AsyncCheckpointWriter(object):
+    """Writes checkpoints in a background thread. ``save`` returns once the checkpoint has been
+    copied to CPU memory, training can then modify the model while the copy is written.
+    At most one checkpoint is written at a time, a new ``save`` first waits for the previous
+    one, and the errors of a background write are raised by the next ``save`` or ``wait``.
+    With ``num_deltas`` > 0, every full checkpoint is followed by ``num_deltas`` delta
+    checkpoints of the rows changed since, the next full checkpoint compacts them.
+    :param num_workers: int, number of shards written in parallel.
+    :param min_shard_bytes: int, tensors of at least this size are written to their own shard.
+    :param row_tracker: EmbeddingRowTracker of the saved model, required with ``num_deltas``.
+    :param num_deltas: int, number of delta checkpoints between full checkpoints.
+    """
+
+    def __init__(self, num_workers=4, min_shard_bytes=1 << 20, row_tracker=None, num_deltas=0):
+        if num_deltas > 0 and row_tracker is None:
+            raise ValueError('Delta checkpoints require a row tracker')
+        self.num_workers = num_workers
+        self.min_shard_bytes = min_shard_bytes
+        self.row_tracker = row_tracker
+        self.num_deltas = num_deltas
+        self.base_path = None
+        self.deltas_since_base = 0
+        self._thread = None
+        self._error = None
+
+    def _write(self, state, checkpoint_dir, on_done):
+        try:
+            write_checkpoint(state, checkpoint_dir, self.num_workers, self.min_shard_bytes)
+            if on_done is not None:
+                on_done(checkpoint_dir)
+        except BaseException as error:
+            self._error = error
+
+    def save(self, checkpoint, checkpoint_dir, on_done=None):
+        # on_done: callable, checkpoint_dir -> None, run in the writer thread once written.
+        # Returns True when a delta checkpoint is written, False for a full one
+        self.wait()
+        is_delta = self.base_path is not None and self.deltas_since_base < self.num_deltas
+        if is_delta:
+            base_path = os.path.relpath(
+                self.base_path, os.path.dirname(os.path.abspath(checkpoint_dir))
+            )
+            state = snapshot_state(
+                make_delta(checkpoint, self.row_tracker.changed_rows(), base_path)
+            )
+            self.deltas_since_base += 1
+        else:
+            state = snapshot_state(checkpoint)
+            if self.row_tracker is not None:
+                self.row_tracker.reset()
+            self.base_path = os.path.abspath(checkpoint_dir)
+            self.deltas_since_base = 0
+        self._thread = threading.Thread(
+            target=self._write, args=(state, checkpoint_dir, on_done), daemon=True
+        )
+        self._thread.start()
+        return is_delta
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception(f'Checkpoint write failed: {error!r}') from error
+
+    def close(self):
+        self.wait()
@@ -0,0 +1,199 @@
+# Accuracy and throughput of bf16 autocast against fp32 on the same shards.
+# A model is trained for one pass over the train shards in each precision, from the same
+# initial weights and in the same batch order, then evaluated on the validation shards.
+# Shards are decoded once before the runs, so that only the model computations are timed
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import argparse
+import copy
+import time
+import torch
+import random
+import numpy as np
+import torch.nn.functional as F
+from sklearn.metrics import roc_auc_score
+
+from inputs import VarLenSparseFeat, trim_histories
+from manifest import find_manifest, load_manifest
+from optimizers import build_optimizer
+from precision import PRECISIONS, autocast
+from shard_loader import iterate_shard_batches
+from main import build_model, count_shards, load_feature_columns, load_shard_tensors
+
+
+# train the model for one pass over the shards, -> (avg batch loss, samples per second)
+def train_pass(model, optimizer, shards, load_shard, batch_size, precision, trim_columns):
+    model.train(True)
+    losses, num_samples, train_time = [], 0, 0.0
+    for x, y in iterate_shard_batches(shards, load_shard, batch_size, shuffle=True, verbose=False):
+        if trim_columns:
+            x = trim_histories(x, trim_columns)
+        y = y.float()
+        start_time = time.perf_counter()
+        with autocast(precision):
+            y_pred = model(x)
+        optimizer.zero_grad()
+        loss = F.binary_cross_entropy(y_pred.squeeze(), y.squeeze(), reduction='sum')
+        loss.backward()
+        optimizer.step()
+        train_time += time.perf_counter() - start_time
+        losses.append(loss.item())
+        num_samples += len(y)
+    return sum(losses) / max(len(losses), 1), num_samples / max(train_time, 1e-9)
+
+
+# predictions of the model on the shards, -> (predictions, labels, samples per second)
+def evaluate_pass(model, shards, load_shard, batch_size, precision, trim_columns):
+    model.train(False)
+    predictions, labels, eval_time = [], [], 0.0
+    with torch.no_grad():
+        for x, y in iterate_shard_batches(
+            shards, load_shard, batch_size, shuffle=False, verbose=False
+        ):
+            if trim_columns:
+                x = trim_histories(x, trim_columns)
+            start_time = time.perf_counter()
+            with autocast(precision):
+                y_pred = model(x)
+            eval_time += time.perf_counter() - start_time
+            predictions.append(y_pred.view(-1))
+            labels.append(y.view(-1).float())
+    predictions, labels = torch.cat(predictions), torch.cat(labels)
+    return predictions, labels, len(labels) / max(eval_time, 1e-9)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # name of model, choose from DIN, DIEN or DIFM
+    parser.add_argument('--model_name', action='store', nargs=1, dest='model_name', required=True)
+    # sum or attention
+    parser.add_argument('--model_type', action='store', nargs=1, dest='model_type', required=True)
+    # 1M, 10M, 20M or 25M
+    parser.add_argument('--data_type', action='store', nargs=1, dest='data_type', required=True)
+    # IC or UC
+    parser.add_argument(
+        '--feature_type', action='store', nargs=1, dest='feature_type', required=True
+    )
+    parser.add_argument('--train_dir', action='store', nargs=1, dest='train_dir', required=True)
+    parser.add_argument('--val_dir', action='store', nargs=1, dest='val_dir', required=True)
+    # number of train and validation shards used, 0 for all of them
+    parser.add_argument('--num_shards', action='store', nargs=1, dest='num_shards')
+    parser.add_argument('--batch_size', action='store', nargs=1, dest='batch_size')
+    # dataset manifest, defaults to manifest.json in the train dir
+    parser.add_argument('--manifest_path', action='store', nargs=1, dest='manifest_path')
+    # keep only the N most recent items of every history, 0 for the full histories
+    parser.add_argument('--max_hist_len', action='store', nargs=1, dest='max_hist_len')
+    # cut the histories of every batch to the longest history of the batch
+    parser.add_argument('--trim_history', action='store_true', dest='trim_history', default=False)
+    parser.add_argument('--seed', action='store', nargs=1, dest='seed')
+    args = parser.parse_args()
+    model_name = args.model_name[0]
+    model_type = args.model_type[0]
+    data_type = args.data_type[0]
+    feature_type = args.feature_type[0]
+    train_dir = args.train_dir[0]
+    val_dir = args.val_dir[0]
+    if args.num_shards:
+        num_shards = int(args.num_shards[0])
+    else:
+        num_shards = 1
+    if args.batch_size:
+        batch_size = int(args.batch_size[0])
+    else:
+        batch_size = 256
+    if args.max_hist_len:
+        max_hist_len = int(args.max_hist_len[0])
+    else:
+        max_hist_len = 0
+    if args.seed:
+        seed = int(args.seed[0])
+    else:
+        seed = 10
+    if args.manifest_path:
+        manifest = load_manifest(args.manifest_path[0])
+    else:
+        manifest = find_manifest(train_dir)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    # the same first shards of both splits in every run
+    shards = {}
+    for split, data_dir, file_split in [('train', train_dir, 'train'), ('val', val_dir, 'test')]:
+        num_files = count_shards(data_dir)
+        indices = range(num_files if num_shards <= 0 else min(num_shards, num_files))
+        prefix = os.path.join(data_dir, f'movie_lens_{data_type}')
+        shards[split] = [
+            (
+                i,
+                f'{prefix}_sparse_features_{file_split}_{i}.csv',
+                f'{prefix}_IC_UC_features_{file_split}_{i}.npz',
+            )
+            for i in indices
+        ]
+
+    feature_columns, behavior_feature_list = load_feature_columns(
+        data_type,
+        feature_type,
+        manifest,
+        shards['train'][0][1],
+        shards['train'][0][2],
+        max_hist_len,
+    )
+    model = build_model(model_name, model_type, feature_columns, behavior_feature_list, 'cpu')
+    initial_state = copy.deepcopy(model.state_dict())
+    trim_columns = []
+    if args.trim_history:
+        trim_columns = [
+            fc for fc in model.dnn_feature_columns if isinstance(fc, VarLenSparseFeat)
+        ]
+
+    # decoded once, outside of the timings
+    loaded = {
+        shard: load_shard_tensors(
+            data_type, shard[1], shard[2], feature_type, model.input_plan, manifest, max_hist_len
+        )
+        for shard in shards['train'] + shards['val']
+    }
+    load_shard = loaded.__getitem__
+    print(
+        f'{model_name} {model_type} {feature_type} {data_type}: '
+        f'{sum(len(loaded[shard][1]) for shard in shards["train"])} train samples, '
+        f'{sum(len(loaded[shard][1]) for shard in shards["val"])} val samples, '
+        f'{torch.get_num_threads()} threads'
+    )
+
+    results = {}
+    for precision in PRECISIONS:
+        model.load_state_dict(initial_state)
+        optimizer = build_optimizer(model, lr=0.01)
+        # same batch order in every precision
+        torch.manual_seed(seed)
+        train_loss, train_speed = train_pass(
+            model, optimizer, shards['train'], load_shard, batch_size, precision, trim_columns
+        )
+        predictions, labels, eval_speed = evaluate_pass(
+            model, shards['val'], load_shard, batch_size, precision, trim_columns
+        )
+        results[precision] = {
+            'train_loss': train_loss,
+            'train_speed': train_speed,
+            'eval_speed': eval_speed,
+            'val_loss': F.binary_cross_entropy(predictions, labels).item(),
+            'val_auc': roc_auc_score(labels.numpy(), predictions.numpy()),
+            'predictions': predictions,
+        }
+
+    reference = results['fp32']
+    for precision, result in results.items():
+        diff = (result['predictions'] - reference['predictions']).abs()
+        print(
+            f'{precision}: train {result["train_speed"]:.0f} samples/s '
+            f'({result["train_speed"] / reference["train_speed"]:.2f}x), '
+            f'eval {result["eval_speed"]:.0f} samples/s '
+            f'({result["eval_speed"] / reference["eval_speed"]:.2f}x), '
+            f'avg train loss {result["train_loss"]:.5f}, '
+            f'val loss {result["val_loss"]:.5f}, val AUC {result["val_auc"]:.5f}, '
+            f'prediction diff to fp32 {diff.mean().item():.2e} mean / {diff.max().item():.2e} max'
+        )
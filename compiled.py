@@ -0,0 +1,29 @@
+# Compiled forward passes with torch.compile. The forward pass of a model, FeatureBatch column
+# lookups included, is traced into graphs of fused kernels that are guarded by the shapes,
+# dtypes and input plans they were traced with, a new combination triggers a recompilation.
+# Batch sizes are marked dynamic, so that the last partial batch of every shard reuses the
+# graph of the full batches, and trimmed histories are rounded to powers of two (see
+# trim_histories) so that only a few history lengths are compiled
+import torch
+
+from inputs import FeatureBatch
+
+
+def compile_model(model, mode=None):
+    # mode: torch.compile mode, e.g. 'reduce-overhead' or 'max-autotune', None for the default.
+    # The returned module shares the parameters of model, whose state dict is unchanged
+    if not hasattr(torch, 'compile'):
+        raise ValueError('Compiled models require torch.compile (torch >= 2.0)')
+    return torch.compile(model, mode=mode)
+
+
+def mark_dynamic_batch(X):
+    # the batch dimension of the input tensors of a compiled model is traced as dynamic
+    tensors = X.blocks.values() if isinstance(X, FeatureBatch) else [X]
+    mark = getattr(torch._dynamo, 'maybe_mark_dynamic', None)
+    for tensor in tensors:
+        if mark is not None:
+            mark(tensor, 0)
+        elif tensor.shape[0] > 1:
+            # batches of one row are specialized by the tracer
+            torch._dynamo.mark_dynamic(tensor, 0)
@@ -34,6 +34,7 @@ class DIEN(BaseModel):
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
     :param gpus: list of int or torch.device for multiple gpus. If None, run on `device`. `gpus[0]` should be the same gpu with `device`.
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, holding only the rows looked up in the batch.
     :return: A PyTorch model instance.
     """
 
@@ -58,6 +59,7 @@ class DIEN(BaseModel):
         task='binary',
         device='cpu',
         gpus=None,
+        sparse_embedding=False,
     ):
         super(DIEN, self).__init__(
             [],
@@ -69,6 +71,7 @@ class DIEN(BaseModel):
             task=task,
             device=device,
             gpus=gpus,
+            sparse_embedding=sparse_embedding,
         )
 
         self.item_features = history_feature_list
@@ -137,20 +140,10 @@ class DIEN(BaseModel):
         return y_pred
 
     def _get_emb(self, X):
-        # history feature columns : pos, neg
-        history_feature_columns = []
-        neg_history_feature_columns = []
-        sparse_varlen_feature_columns = []
-        history_fc_names = list(map(lambda x: 'hist_' + x, self.item_features))
-        neg_history_fc_names = list(map(lambda x: 'neg_' + x, history_fc_names))
-        for fc in self.varlen_sparse_feature_columns:
-            feature_name = fc.name
-            if feature_name in history_fc_names:
-                history_feature_columns.append(fc)
-            elif feature_name in neg_history_fc_names:
-                neg_history_feature_columns.append(fc)
-            else:
-                sparse_varlen_feature_columns.append(fc)
+        history_fc_names = self.history_fc_names
+        neg_history_fc_names = self.neg_history_fc_names
+        history_feature_columns = self.history_feature_columns
+        neg_history_feature_columns = self.neg_history_feature_columns
 
         # convert input to emb
         features = self.feature_index
@@ -176,13 +169,8 @@ class DIEN(BaseModel):
         # [batch_size, max_len, dim]
         keys_emb = concat_fun(keys_emb_list)
 
-        keys_length_feature_name = [
-            feat.length_name
-            for feat in self.varlen_sparse_feature_columns
-            if feat.length_name is not None
-        ]
         # [batch_size]
-        keys_length = torch.squeeze(maxlen_lookup(X, features, keys_length_feature_name), 1)
+        keys_length = torch.squeeze(maxlen_lookup(X, features, self.keys_length_feature_name), 1)
 
         if self.use_negsampling:
             neg_keys_emb_list = embedding_lookup(
@@ -216,6 +204,21 @@ class DIEN(BaseModel):
             else []
         )
 
+        # history feature columns : pos, neg, split once instead of in every forward pass
+        self.history_fc_names = list(map(lambda x: 'hist_' + x, self.item_features))
+        self.neg_history_fc_names = list(map(lambda x: 'neg_' + x, self.history_fc_names))
+        self.history_feature_columns = [
+            fc for fc in self.varlen_sparse_feature_columns if fc.name in self.history_fc_names
+        ]
+        self.neg_history_feature_columns = [
+            fc for fc in self.varlen_sparse_feature_columns if fc.name in self.neg_history_fc_names
+        ]
+        self.keys_length_feature_name = [
+            feat.length_name
+            for feat in self.varlen_sparse_feature_columns
+            if feat.length_name is not None
+        ]
+
     def _compute_interest_dim(self):
         interest_dim = 0
         for feat in self.sparse_feature_columns:
@@ -348,7 +351,7 @@ class InterestExtractor(nn.Module):
         noclick_target = torch.zeros(noclick_p.size(), dtype=torch.float, device=noclick_p.device)
 
         loss = F.binary_cross_entropy(
-            torch.cat([click_p, noclick_p], dim=0),
+            torch.cat([click_p, noclick_p], dim=0).float(),
             torch.cat([click_target, noclick_target], dim=0),
         )
 
@@ -480,5 +483,6 @@ class InterestEvolving(nn.Module):
             # pick last state
             outputs = InterestEvolving._get_last_state(outputs, keys_length)   # [b, H]
         # [b, H] -> [B, H]
-        zero_outputs[mask] = outputs
+        # float32 outputs, under autocast the interests may be half precision
+        zero_outputs[mask] = outputs.to(zero_outputs.dtype)
         return zero_outputs
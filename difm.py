@@ -31,6 +31,7 @@ class DIFM(BaseModel):
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
     :param gpus: list of int or torch.device for multiple gpus. If None, run on ``device`` . ``gpus[0]`` should be the same gpu with ``device`` .
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, holding only the rows looked up in the batch.
     :return: A PyTorch model instance.
     """
 
@@ -52,6 +53,7 @@ class DIFM(BaseModel):
         task='binary',
         device='cpu',
         gpus=None,
+        sparse_embedding=False,
     ):
         super(DIFM, self).__init__(
             linear_feature_columns,
@@ -63,6 +65,7 @@ class DIFM(BaseModel):
             task=task,
             device=device,
             gpus=gpus,
+            sparse_embedding=sparse_embedding,
         )
 
         if not len(dnn_hidden_units) > 0:
@@ -31,6 +31,8 @@ class DIN(BaseModel):
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
     :param gpus: list of int or torch.device for multiple gpus. If None, run on `device`. `gpus[0]` should be the same gpu with `device`.
+    :param sparse_embedding: bool. Whether the embedding tables produce sparse gradients, holding only the rows looked up in the batch.
+    :param sum_pool_history: bool. Whether non-attention pooling pools the history embeddings instead of the candidate embedding (the original behaviour, kept by default so that existing checkpoints predict the same). Required by pooled history tables.
     :return:  A PyTorch model instance.
     """
 
@@ -38,9 +40,11 @@ class DIN(BaseModel):
                  dnn_hidden_units=(256, 128), dnn_activation='relu', att_hidden_size=(64, 16),
                  att_activation='Dice', att_weight_normalization=False, l2_reg_dnn=0.0,
                  l2_reg_embedding=1e-6, dnn_dropout=0, init_std=0.0001,
-                 seed=1024, task='binary', device='cpu', gpus=None):
+                 seed=1024, task='binary', device='cpu', gpus=None, sparse_embedding=False,
+                 sum_pool_history=False):
         super(DIN, self).__init__([], dnn_feature_columns, l2_reg_linear=0, l2_reg_embedding=l2_reg_embedding,
-                                  init_std=init_std, seed=seed, task=task, device=device, gpus=gpus)
+                                  init_std=init_std, seed=seed, task=task, device=device, gpus=gpus,
+                                  sparse_embedding=sparse_embedding)
 
         self.sparse_feature_columns = list(
             filter(lambda x: isinstance(x, SparseFeat), dnn_feature_columns)) if dnn_feature_columns else []
@@ -50,6 +54,7 @@ class DIN(BaseModel):
         self.history_feature_list = history_feature_list
 
         self.pooling_type = pooling_type
+        self.sum_pool_history = sum_pool_history
 
         self.history_feature_columns = []
         self.sparse_varlen_feature_columns = []
@@ -63,6 +68,10 @@ class DIN(BaseModel):
             else:
                 self.sparse_varlen_feature_columns.append(fc)
 
+        # split once instead of in every forward pass
+        self.keys_length_feature_name = [feat.length_name for feat in self.varlen_sparse_feature_columns if
+                                         feat.length_name is not None]
+
         att_emb_dim = self._compute_interest_dim()
 
         if self.pooling_type == 'attention':
@@ -86,8 +95,19 @@ class DIN(BaseModel):
                        l2_reg=l2_reg_dnn,
                        use_bn=dnn_use_bn)
         self.dnn_linear = nn.Linear(dnn_hidden_units[-1], 1, bias=False).to(device)
+        # precomputed pooled history of every entity, see history_table.py
+        self.pooled_history = None
         self.to(device)
 
+    def set_pooled_history(self, pooled_history):
+        # the pooled history does not depend on the candidate only with sum pooling
+        if pooled_history is not None and self.pooling_type != 'sum':
+            raise ValueError('pooled history tables are only supported with sum pooling')
+        # the table caches the pooled history embeddings
+        if pooled_history is not None and not self.sum_pool_history:
+            raise ValueError('pooled history tables require sum_pool_history')
+        self.pooled_history = pooled_history
+
 
     def forward(self, X):
 
@@ -96,8 +116,6 @@ class DIN(BaseModel):
         # sequence pooling part
         query_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.sparse_feature_columns,
                                           return_feat_list=self.history_feature_list, to_list=True)
-        keys_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.history_feature_columns,
-                                         return_feat_list=self.history_fc_names, to_list=True)
         dnn_input_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.sparse_feature_columns,
                                               to_list=True)
 
@@ -105,23 +123,31 @@ class DIN(BaseModel):
                                                       self.sparse_varlen_feature_columns)
 
         sequence_embed_list = get_varlen_pooling_list(sequence_embed_dict, X, self.feature_index,
-                                                      self.sparse_varlen_feature_columns, self.device)
+                                                      self.sparse_varlen_feature_columns, self.device,
+                                                      pooling_layers=self.varlen_pooling_layers)
 
         dnn_input_emb_list += sequence_embed_list
         deep_input_emb = torch.cat(dnn_input_emb_list, dim=-1)
 
         # concatenate
         query_emb = torch.cat(query_emb_list, dim=-1)                     # [B, 1, E]
-        keys_emb = torch.cat(keys_emb_list, dim=-1)                       # [B, T, E]
 
-        keys_length_feature_name = [feat.length_name for feat in self.varlen_sparse_feature_columns if
-                                    feat.length_name is not None]
-        keys_length = torch.squeeze(maxlen_lookup(X, self.feature_index, keys_length_feature_name), 1)  # [B, 1]
-
-        if self.pooling_type == 'attention':
-            hist = self.attention(query_emb, keys_emb, keys_length)           # [B, 1, E]
+        if self.pooled_history is not None:
+            # one precomputed row per example instead of embedding and pooling the history
+            hist = self.pooled_history.lookup(X, self.feature_index, self.embedding_dict)  # [B, 1, E]
         else:
-            hist = self.pooling_layer([query_emb, keys_length.view(-1, 1)])   # [B, 1, E]
+            keys_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.history_feature_columns,
+                                             return_feat_list=self.history_fc_names, to_list=True)
+            keys_emb = torch.cat(keys_emb_list, dim=-1)                   # [B, T, E]
+
+            keys_length = torch.squeeze(maxlen_lookup(X, self.feature_index, self.keys_length_feature_name), 1)  # [B, 1]
+
+            if self.pooling_type == 'attention':
+                hist = self.attention(query_emb, keys_emb, keys_length)       # [B, 1, E]
+            elif self.sum_pool_history:
+                hist = self.pooling_layer([keys_emb, keys_length.view(-1, 1)])  # [B, 1, E]
+            else:
+                hist = self.pooling_layer([query_emb, keys_length.view(-1, 1)])  # [B, 1, E]
 
         # deep part
         deep_input_emb = torch.cat((deep_input_emb, hist), dim=-1)
@@ -0,0 +1,117 @@
+# Multi-process data-parallel training on CPU with torch.distributed over gloo.
+# Every process trains a DistributedDataParallel replica of the model on its own subset of
+# the shards, and gradients are all-reduced after every backward pass. Workers are either
+# launched by launch_workers (which runs the current script again in each local process) or by
+# torchrun, both describe the process group through the usual environment variables
+import os
+import sys
+import time
+import subprocess
+
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return int(os.environ.get('WORLD_SIZE', '1')) > 1
+
+
+# (rank, local rank, world size) of the current process
+def get_world():
+    rank = int(os.environ.get('RANK', '0'))
+    local_rank = int(os.environ.get('LOCAL_RANK', str(rank)))
+    world_size = int(os.environ.get('WORLD_SIZE', '1'))
+    return rank, local_rank, world_size
+
+
+# run the current script again in num_procs local worker processes and wait for them,
+# the workers of node node_rank get the ranks node_rank*num_procs ... (node_rank+1)*num_procs-1.
+# Returns the exit code of the first failed worker, 0 if all of them succeeded
+def launch_workers(
+    num_procs, num_nodes=1, node_rank=0, master_addr='127.0.0.1', master_port=29500
+):
+    world_size = num_procs * num_nodes
+    # cores are split between the local processes
+    num_threads = max(1, (os.cpu_count() or 1) // num_procs)
+    workers = []
+    for local_rank in range(num_procs):
+        env = dict(
+            os.environ,
+            MASTER_ADDR=master_addr,
+            MASTER_PORT=str(master_port),
+            WORLD_SIZE=str(world_size),
+            RANK=str(node_rank * num_procs + local_rank),
+            LOCAL_RANK=str(local_rank),
+            LOCAL_WORLD_SIZE=str(num_procs),
+        )
+        env.setdefault('OMP_NUM_THREADS', str(num_threads))
+        workers.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+    print(f'Launched {num_procs} workers (ranks {node_rank * num_procs}-'
+          f'{(node_rank + 1) * num_procs - 1} of {world_size})')
+
+    exit_code = 0
+    try:
+        while workers:
+            for worker in list(workers):
+                code = worker.poll()
+                if code is None:
+                    continue
+                workers.remove(worker)
+                if code != 0 and exit_code == 0:
+                    # the other workers would wait forever in their collectives
+                    exit_code = code
+                    for other in workers:
+                        other.terminate()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        exit_code = 1
+    return exit_code
+
+
+# join the process group described by the environment, returns (rank, world size)
+def init_distributed(backend='gloo'):
+    rank, _, world_size = get_world()
+    dist.init_process_group(backend, init_method='env://', rank=rank, world_size=world_size)
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', str(world_size)))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return rank, world_size
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.barrier()
+        dist.destroy_process_group()
+
+
+# disjoint subsets of shards with balanced row counts, one per rank.
+# Largest shards are placed first, each on the rank with the fewest rows so far, and every
+# subset keeps the order of ``shards`` (e.g. the shuffled order of the epoch)
+def assign_shards(shards, num_rows, world_size):
+    loads = [0] * world_size
+    assigned = [[] for _ in range(world_size)]
+    for i in sorted(range(len(shards)), key=lambda i: -num_rows[i]):
+        rank = loads.index(min(loads))
+        assigned[rank].append(i)
+        loads[rank] += num_rows[i]
+    return [[shards[i] for i in sorted(indices)] for indices in assigned]
+
+
+# mean of the values of all ranks (the local mean without process group), nan without values
+def all_reduce_mean(values):
+    totals = torch.tensor([float(sum(values)), float(len(values))], dtype=torch.float64)
+    if dist.is_initialized():
+        dist.all_reduce(totals)
+    if totals[1] == 0:
+        return float('nan')
+    return (totals[0] / totals[1]).item()
+
+
+# the object of rank src on every rank
+def broadcast_object(obj, src=0):
+    if not dist.is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
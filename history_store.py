@@ -0,0 +1,171 @@
+# Real-time IC/UC history store. The latest positive/negative movies of every user and the
+# latest positive/negative users of every movie are kept in preallocated ring buffers, so that
+# rating events are appended in O(1) and histories of a whole batch are read with a few
+# vectorized gathers, without going through the offline npz files
+import os
+import json
+import numpy as np
+
+# ratings at or above this value are positive engagements, see process_data.py
+POSITIVE_RATING = 4.0
+
+# history arrays (named as in the IC/UC npz files) -> (polarity, entity side)
+HIST_ARRAY_KEYS = {
+    'positive_ic_feature': ('positive', 'user'),
+    'negative_ic_feature': ('negative', 'user'),
+    'positive_uc_feature': ('positive', 'movie'),
+    'negative_uc_feature': ('negative', 'movie'),
+}
+
+STORE_META_NAME = 'history_store.json'
+
+
+class RingBufferHistoryStore(object):
+    """Latest IC/UC histories of every user and movie, in one ring buffer per entity and polarity.
+    Each ring holds the last ``feature_length`` ids of its entity, older ids are overwritten.
+    Ids outside of the vocabularies are never stored, so the memory is fixed at construction.
+    :param num_users: int, user vocabulary size (0 is mask value).
+    :param num_movies: int, movie vocabulary size (0 is mask value).
+    :param feature_length: int, maximum history length kept per entity.
+    :param arrays: dict, existing buffers (e.g. memory-mapped by ``restore``), allocated if None.
+    """
+
+    def __init__(self, num_users, num_movies, feature_length, arrays=None):
+        self.num_users = int(num_users)
+        self.num_movies = int(num_movies)
+        self.feature_length = int(feature_length)
+        num_entities = {'user': self.num_users, 'movie': self.num_movies}
+
+        if arrays is None:
+            arrays = {}
+            for key, (_, side) in HIST_ARRAY_KEYS.items():
+                # ids, next write position and number of valid ids of every ring
+                arrays[key] = np.zeros((num_entities[side], self.feature_length), dtype=np.int32)
+                arrays[f'{key}_head'] = np.zeros(num_entities[side], dtype=np.int32)
+                arrays[f'{key}_length'] = np.zeros(num_entities[side], dtype=np.int32)
+        self.arrays = arrays
+
+        # column offsets from the newest id of a ring, reused by every read
+        self._offsets = np.arange(1, self.feature_length + 1, dtype=np.int64)
+
+    def accepts(self, user_id, movie_id):
+        # 0 is mask value
+        return 0 < user_id < self.num_users and 0 < movie_id < self.num_movies
+
+    def _append(self, key, entity_id, value):
+        head = self.arrays[f'{key}_head']
+        length = self.arrays[f'{key}_length']
+        position = head[entity_id]
+        self.arrays[key][entity_id, position] = value
+        head[entity_id] = (position + 1) % self.feature_length
+        if length[entity_id] < self.feature_length:
+            length[entity_id] += 1
+
+    def add(self, user_id, movie_id, rating):
+        # one rating event, O(1)
+        polarity = 'positive' if rating >= POSITIVE_RATING else 'negative'
+        self._append(f'{polarity}_ic_feature', user_id, movie_id)
+        self._append(f'{polarity}_uc_feature', movie_id, user_id)
+
+    def add_batch(self, user_ids, movie_ids, ratings):
+        # rating events in the order they happened
+        for user_id, movie_id, rating in zip(user_ids, movie_ids, ratings):
+            self.add(int(user_id), int(movie_id), float(rating))
+
+    def read(self, user_ids, movie_ids):
+        # {npz history key: [B, feature_length] ids, f'{key}_length': [B] lengths}
+        # ids are ordered from the most recent (as in process_data.py) and padded with 0
+        entity_ids = {
+            'user': np.asarray(user_ids, dtype=np.int64).reshape(-1),
+            'movie': np.asarray(movie_ids, dtype=np.int64).reshape(-1),
+        }
+        outputs = {}
+        for key, (_, side) in HIST_ARRAY_KEYS.items():
+            ids = entity_ids[side]
+            head = self.arrays[f'{key}_head'][ids].astype(np.int64)
+            length = self.arrays[f'{key}_length'][ids].astype(np.int64)
+            positions = (head[:, None] - self._offsets[None, :]) % self.feature_length
+            feature = self.arrays[key][ids[:, None], positions]
+            feature[self._offsets[None, :] > length[:, None]] = 0
+            outputs[key] = feature
+            outputs[f'{key}_length'] = length
+        return outputs
+
+    def read_features(self, user_ids, movie_ids, hist_columns, feature_index=None):
+        # {model input name: array} of the history inputs, in the build_input_features layout:
+        # hist_* inputs are [B, maxlen] and length inputs are [B, 1]
+        # hist_columns: {model input name: (npz history key, length column)}
+        # feature_index: model feature_index, used to cut the histories to the model's maxlen
+        histories = self.read(user_ids, movie_ids)
+        features = {}
+        for name, (hist_key, length_name) in hist_columns.items():
+            feature = histories[hist_key]
+            length = histories[f'{hist_key}_length']
+            if feature_index is not None:
+                maxlen = feature_index[name][1] - feature_index[name][0]
+                if maxlen > feature.shape[1]:
+                    raise ValueError(
+                        f'{name} has maxlen {maxlen}, the store only keeps {feature.shape[1]} ids'
+                    )
+                feature = feature[:, :maxlen]
+                length = np.minimum(length, maxlen)
+            features[name] = feature
+            features[length_name] = length.reshape(-1, 1)
+        return features
+
+    def snapshot(self, snapshot_dir):
+        # write every buffer to a new .npy file, readable with memory mapping. The files of a
+        # snapshot never change once written, later appends only go to the buffers in memory
+        # (buffers mapped copy-on-write from the previous snapshot keep its replaced files)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        meta_path = os.path.join(snapshot_dir, STORE_META_NAME)
+        if os.path.exists(meta_path):
+            # the previous snapshot is invalid as soon as its buffers start being replaced
+            os.remove(meta_path)
+        for name, array in self.arrays.items():
+            path = os.path.join(snapshot_dir, f'{name}.npy')
+            temp_path = f'{path}.tmp.{os.getpid()}'
+            snapshot = np.lib.format.open_memmap(
+                temp_path, mode='w+', dtype=array.dtype, shape=array.shape
+            )
+            snapshot[...] = array
+            snapshot.flush()
+            del snapshot
+            os.replace(temp_path, path)
+
+        # written last, a snapshot without it is incomplete
+        meta = {
+            'num_users': self.num_users,
+            'num_movies': self.num_movies,
+            'feature_length': self.feature_length,
+            'arrays': list(self.arrays),
+        }
+        with open(f'{meta_path}.tmp', 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(f'{meta_path}.tmp', meta_path)
+
+    @classmethod
+    def restore(cls, snapshot_dir, mmap_mode='c'):
+        # mmap_mode: 'c' maps the snapshot files copy-on-write, None loads the buffers in memory.
+        # Appends never write into the snapshot, which stays that of its model checkpoint
+        if mmap_mode not in ('c', None):
+            raise ValueError(f'Unsupported history store mmap_mode {mmap_mode}')
+        meta_path = os.path.join(snapshot_dir, STORE_META_NAME)
+        if not os.path.exists(meta_path):
+            raise Exception(f'No history store snapshot found in {snapshot_dir}')
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+
+        arrays = {
+            name: np.load(os.path.join(snapshot_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+            for name in meta['arrays']
+        }
+        return cls(
+            meta['num_users'],
+            meta['num_movies'],
+            meta['feature_length'],
+            arrays=arrays,
+        )
+
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
@@ -0,0 +1,183 @@
+# Per-entity history tables. IC histories only depend on the user and UC histories only on
+# the movie, so they can be stored once per entity instead of once per rating
+import numpy as np
+import torch
+
+from inputs import VarLenSparseFeat, get_input
+
+# input column holding the entity that owns the history, for each feature type
+HIST_ENTITY_COLUMNS = {
+    'IC': 'positive_user_id',
+    'UC': 'positive_movie_id',
+}
+
+
+class EntityHistoryTable(object):
+    """History ids and lengths of every entity, collected from processed feature inputs.
+    :param key_feature: str, name of the input column holding the entity id.
+    :param history_feature_columns: list of VarLenSparseFeat, the history features to collect.
+    :param num_entities: int, number of entity ids (vocabulary size of ``key_feature``).
+    """
+
+    def __init__(self, key_feature, history_feature_columns, num_entities):
+        self.key_feature = key_feature
+        self.history_feature_columns = [
+            fc for fc in history_feature_columns if isinstance(fc, VarLenSparseFeat)
+        ]
+        self.num_entities = int(num_entities)
+        self.hist_ids = {
+            fc.name: np.zeros((self.num_entities, fc.maxlen), dtype=np.int32)
+            for fc in self.history_feature_columns
+        }
+        self.hist_length = {
+            fc.length_name: np.zeros(self.num_entities, dtype=np.int32)
+            for fc in self.history_feature_columns
+            if fc.length_name is not None
+        }
+        self.has_history = np.zeros(self.num_entities, dtype=bool)
+
+    def add(self, data_input):
+        # data_input: {feature name: array}, as returned by main.process_features
+        entity_ids = np.asarray(data_input[self.key_feature]).reshape(-1).astype(np.int64)
+        if len(entity_ids) == 0:
+            return
+
+        # keep the first row of every entity that has not been seen yet
+        unique_ids, first_rows = np.unique(entity_ids, return_index=True)
+        new_entities = ~self.has_history[unique_ids]
+        unique_ids, first_rows = unique_ids[new_entities], first_rows[new_entities]
+
+        for name, hist_ids in self.hist_ids.items():
+            rows = np.asarray(data_input[name])[first_rows]
+            width = min(rows.shape[1], hist_ids.shape[1])
+            hist_ids[unique_ids, :width] = rows[:, :width]
+        for length_name, hist_length in self.hist_length.items():
+            hist_length[unique_ids] = np.asarray(data_input[length_name]).reshape(-1)[first_rows]
+        self.has_history[unique_ids] = True
+
+    def gather(self, entity_ids):
+        # {feature name: [B, T] ids} and {length name: [B] lengths} of the given entities
+        entity_ids = np.asarray(entity_ids).reshape(-1).astype(np.int64)
+        hist_ids = {name: ids[entity_ids] for name, ids in self.hist_ids.items()}
+        hist_length = {name: length[entity_ids] for name, length in self.hist_length.items()}
+        return hist_ids, hist_length
+
+    def __len__(self):
+        return int(self.has_history.sum())
+
+
+class _StalePooledLookup(torch.autograd.Function):
+    # forward gathers the cached pooled rows, backward sends the gradient to the embedding
+    # rows of the entities' histories as if they had been pooled in this step
+    # (as sparse gradients for embeddings with sparse=True)
+    @staticmethod
+    def forward(ctx, entity_ids, pooled, hist_ids, hist_mask, splits, sparse, *weights):
+        ctx.save_for_backward(entity_ids)
+        ctx.hist_ids = hist_ids
+        ctx.hist_mask = hist_mask
+        ctx.splits = splits
+        ctx.sparse = sparse
+        ctx.weight_shapes = [(w.shape, w.dtype, w.device) for w in weights]
+        return pooled[entity_ids]
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        entity_ids, = ctx.saved_tensors
+        # [B, 1, E] -> one [B, E_i] block per history feature
+        grad_blocks = torch.split(grad_output.squeeze(1), ctx.splits, dim=-1)
+        mask = ctx.hist_mask[entity_ids].unsqueeze(-1)  # [B, T, 1]
+        weight_grads = []
+        for hist_ids, grad_block, (shape, dtype, device) in zip(
+            ctx.hist_ids, grad_blocks, ctx.weight_shapes
+        ):
+            ids = hist_ids[entity_ids].long()  # [B, T]
+            grad_rows = grad_block.unsqueeze(1).to(dtype) * mask[:, : ids.shape[1]].to(dtype)
+            if ctx.sparse:
+                weight_grad = torch.sparse_coo_tensor(
+                    ids.reshape(1, -1), grad_rows.reshape(-1, shape[1]), shape
+                )
+            else:
+                weight_grad = torch.zeros(shape, dtype=dtype, device=device)
+                weight_grad.index_add_(0, ids.reshape(-1), grad_rows.reshape(-1, shape[1]))
+            weight_grads.append(weight_grad)
+        return (None, None, None, None, None, None) + tuple(weight_grads)
+
+
+class PooledHistoryTable(object):
+    """Sum-pooled history embedding of every entity, refreshed from the current embeddings.
+    Models with sum pooling gather one row per example instead of embedding and pooling the
+    whole history. Rows go stale between refreshes, which trades freshness against speed.
+    :param history_table: EntityHistoryTable holding the history ids of every entity.
+    :param history_feature_columns: list of VarLenSparseFeat pooled (and concatenated) by the model.
+    :param length_name: str, length column used to mask the histories.
+    :param refresh_steps: int, refresh every ``refresh_steps`` training steps, 0 to only refresh explicitly.
+    :param backprop: bool. Whether the history embeddings still receive gradients.
+    :param device: str, ``"cpu"`` or ``"cuda:0"``
+    """
+
+    def __init__(
+        self,
+        history_table,
+        history_feature_columns,
+        length_name,
+        refresh_steps=0,
+        backprop=True,
+        device='cpu',
+    ):
+        self.key_feature = history_table.key_feature
+        self.num_entities = history_table.num_entities
+        self.history_feature_columns = list(history_feature_columns)
+        self.refresh_steps = refresh_steps
+        self.backprop = backprop
+        self.device = device
+
+        self.splits = [fc.embedding_dim for fc in self.history_feature_columns]
+        self.hist_ids = [
+            torch.from_numpy(history_table.hist_ids[fc.name]).to(device)
+            for fc in self.history_feature_columns
+        ]
+        maxlen = max(ids.shape[1] for ids in self.hist_ids)
+        hist_length = torch.from_numpy(history_table.hist_length[length_name]).to(device)
+        self.hist_mask = torch.arange(maxlen, device=device).unsqueeze(0) < hist_length.unsqueeze(1)
+        self.entities = torch.from_numpy(np.flatnonzero(history_table.has_history)).to(device)
+
+        self.pooled = torch.zeros((self.num_entities, sum(self.splits)), device=device)
+        self.steps_since_refresh = 0
+
+    def refresh(self, embedding_dict, chunk_size=4096):
+        # recompute the pooled rows of every entity with the current embeddings
+        with torch.no_grad():
+            for start in range(0, len(self.entities), chunk_size):
+                entities = self.entities[start : start + chunk_size]
+                mask = self.hist_mask[entities].unsqueeze(-1)  # [C, T, 1]
+                pooled_list = []
+                for fc, hist_ids in zip(self.history_feature_columns, self.hist_ids):
+                    emb = embedding_dict[fc.embedding_name](hist_ids[entities].long())  # [C, T, E_i]
+                    pooled_list.append(torch.sum(emb * mask[:, : emb.shape[1]], dim=1))
+                self.pooled[entities] = torch.cat(pooled_list, dim=-1).to(self.pooled.dtype)
+        self.steps_since_refresh = 0
+
+    def step(self, embedding_dict):
+        # called after every optimizer step
+        self.steps_since_refresh += 1
+        if self.refresh_steps > 0 and self.steps_since_refresh >= self.refresh_steps:
+            self.refresh(embedding_dict)
+
+    def lookup(self, X, feature_index, embedding_dict):
+        # [B, 1, E] pooled history of the entity of every example
+        entity_ids = get_input(X, feature_index, self.key_feature)[:, 0].long()
+        if self.backprop and torch.is_grad_enabled():
+            embeddings = [embedding_dict[fc.embedding_name] for fc in self.history_feature_columns]
+            sparse = all(embedding.sparse for embedding in embeddings)
+            pooled = _StalePooledLookup.apply(
+                entity_ids,
+                self.pooled,
+                self.hist_ids,
+                self.hist_mask,
+                self.splits,
+                sparse,
+                *[embedding.weight for embedding in embeddings],
+            )
+        else:
+            pooled = self.pooled[entity_ids]
+        return pooled.unsqueeze(1)
@@ -0,0 +1,213 @@
+# Hogwild-style training: the model and its Adagrad state live in shared memory, and several
+# worker processes pull shards from a queue and apply their updates asynchronously, without
+# locks. Embedding updates only touch the rows of their batch, so concurrent updates rarely
+# collide. The parent process coordinates the epochs, and runs validation and checkpointing
+# on the shared model between them
+import os
+import queue
+import threading
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from optimizers import SplitOptimizer
+from precision import autocast
+
+
+class HogwildTrainer(object):
+    """Asynchronous shared-memory training of a model with Adagrad, in ``num_workers`` processes.
+    Workers are forked once at construction, before the parent starts other threads (e.g. to
+    prefetch shards or write checkpoints), and kept across epochs. They inherit the shard loading
+    callables (and their caches) of the parent.
+    :param model: the model, moved to shared memory.
+    :param optimizer: Adagrad optimizer over all the model parameters (or SplitOptimizer), its
+        state is moved to shared memory and updated by the workers, so it can be saved as usual.
+    :param iterate_batches: callable, shard -> iterable of (input, label) training batches.
+    :param loss_function: callable, (y_pred, y, reduction) -> loss.
+    :param metric_function: callable, (y, y_pred) -> metric, or None.
+    :param num_workers: int, number of worker processes.
+    :param sync_dense: bool. Whether the parameters outside of ``embedding_dict`` are updated
+        under a lock shared by the workers (embeddings are always updated without lock).
+    :param prepare_batch: callable, (input, label) -> (input, label) applied to every batch before
+        the forward pass (e.g. negative sampling), or None.
+    :param worker_init: callable, worker index -> None, run in every worker after the fork
+        (e.g. to reseed random generators), or None.
+    :param regularize: bool. Whether the model's regularization loss is added to the loss.
+    :param precision: str, precision of the forward passes (see precision.py).
+    """
+
+    def __init__(
+        self,
+        model,
+        optimizer,
+        iterate_batches,
+        loss_function,
+        metric_function=None,
+        num_workers=2,
+        sync_dense=False,
+        prepare_batch=None,
+        worker_init=None,
+        regularize=False,
+        precision='fp32',
+    ):
+        if not isinstance(optimizer, (torch.optim.Adagrad, SplitOptimizer)):
+            raise ValueError('Hogwild training shares Adagrad optimizer states only')
+        self.model = model
+        self.optimizer = optimizer
+        self.iterate_batches = iterate_batches
+        self.loss_function = loss_function
+        self.metric_function = metric_function
+        self.num_workers = num_workers
+        self.prepare_batch = prepare_batch
+        self.worker_init = worker_init
+        self.regularize = regularize
+        self.precision = precision
+
+        model.share_memory()
+        optimizer.share_memory()
+        if isinstance(optimizer, SplitOptimizer):
+            self.embedding_optimizer = optimizer.embedding_optimizer
+            self.dense_optimizer = optimizer.dense_optimizer
+        else:
+            # two views of the shared optimizer state, so that dense parameters can be stepped
+            # under the lock while embedding rows are not
+            embedding_ids = set(id(p) for p in model.embedding_dict.parameters())
+            params = [p for group in optimizer.param_groups for p in group['params']]
+            self.embedding_optimizer = self._view(
+                [p for p in params if id(p) in embedding_ids]
+            )
+            self.dense_optimizer = self._view([p for p in params if id(p) not in embedding_ids])
+
+        # fork keeps the closures of the callables, which spawn could not pickle
+        self.context = mp.get_context('fork')
+        self.dense_lock = self.context.Lock() if sync_dense else None
+        # workers wait for each other at the end of an epoch, so that no worker takes the
+        # end marker of another one while it is still training
+        self.epoch_barrier = self.context.Barrier(num_workers)
+        self.tasks = None
+        self.results = None
+        self.workers = []
+        self.start()
+
+    def _view(self, params):
+        if not params:
+            return None
+        hyperparams = {k: v for k, v in self.optimizer.param_groups[0].items() if k != 'params'}
+        view = torch.optim.Adagrad(params, **hyperparams)
+        for p in params:
+            view.state[p] = self.optimizer.state[p]
+        return view
+
+    def start(self):
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        for n in range(self.num_workers):
+            worker = self.context.Process(target=self._work, args=(n,), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self, n):
+        # cores are split between the workers
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.num_workers))
+        if self.worker_init is not None:
+            self.worker_init(n)
+        losses, metrics = [], []
+        while True:
+            shard = self.tasks.get()
+            if shard is None:
+                return
+            if shard == 'end_epoch':
+                self.results.put(('done', losses, metrics))
+                losses, metrics = [], []
+                try:
+                    self.epoch_barrier.wait()
+                except threading.BrokenBarrierError:
+                    return
+                continue
+            try:
+                self._train_shard(shard, losses, metrics)
+            except Exception:
+                self.results.put(('error', traceback.format_exc(), None))
+                return
+
+    def _train_shard(self, shard, losses, metrics):
+        self.model.train(True)
+        for x, y in self.iterate_batches(shard):
+            if self.prepare_batch is not None:
+                x, y = self.prepare_batch(x, y)
+            y = y.float()
+            with autocast(self.precision):
+                y_pred = self.model(x)
+            self.model.zero_grad()
+            loss = self.loss_function(y_pred.squeeze(), y.squeeze(), reduction='sum')
+            losses.append(loss.item())
+            if self.metric_function is not None:
+                try:
+                    metrics.append(
+                        self.metric_function(y.cpu().data.numpy(), y_pred.cpu().data.numpy())
+                    )
+                except ValueError:
+                    pass
+            if self.regularize:
+                loss = loss + self.model.get_regularization_loss(x)
+            loss.backward()
+
+            # lock-free updates of the embedding rows
+            if self.embedding_optimizer is not None:
+                self.embedding_optimizer.step()
+            if self.dense_optimizer is not None:
+                if self.dense_lock is not None:
+                    with self.dense_lock:
+                        self.dense_optimizer.step()
+                else:
+                    self.dense_optimizer.step()
+
+    def _get_result(self):
+        # next result of a worker, raises when a worker died without posting one (e.g. killed
+        # when out of memory), instead of waiting for it forever
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [worker for worker in self.workers if not worker.is_alive()]
+                if not dead:
+                    continue
+                try:
+                    # posted just before exiting
+                    return self.results.get(timeout=1)
+                except queue.Empty:
+                    pass
+                self.epoch_barrier.abort()
+                self.close()
+                raise Exception(f'Hogwild worker exited unexpectedly with code {dead[0].exitcode}')
+
+    def train_epoch(self, shards):
+        # -> (per batch losses, per batch metrics) of all the workers
+        if not self.workers:
+            self.start()
+        for shard in shards:
+            self.tasks.put(shard)
+        for _ in self.workers:
+            self.tasks.put('end_epoch')
+
+        losses, metrics = [], []
+        for _ in self.workers:
+            status, worker_losses, worker_metrics = self._get_result()
+            if status == 'error':
+                self.epoch_barrier.abort()
+                self.close()
+                raise Exception(f'Hogwild worker failed:\n{worker_losses}')
+            losses += worker_losses
+            metrics += worker_metrics
+        return losses, metrics
+
+    def close(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
@@ -16,6 +16,9 @@ from utils import concat_fun
 
 DEFAULT_GROUP_NAME = "default_group"
 
+# dtype of every block of a FeatureBatch: sparse/history ids, history lengths, dense values
+INPUT_BLOCK_DTYPES = OrderedDict([("ids", np.int32), ("lengths", np.int32), ("dense", np.float32)])
+
 
 class SparseFeat(namedtuple('SparseFeat',
                             ['name', 'vocabulary_size', 'embedding_dim', 'use_hash', 'dtype', 'embedding_name',
@@ -123,6 +126,177 @@ def build_input_features(feature_columns):
     return features
 
 
+def build_input_plan(feature_columns):
+    # Return OrderedDict: {feature_name:(block, start, start+dimension)}
+    # same features as build_input_features, placed in the typed blocks of a FeatureBatch
+
+    plan = OrderedDict()
+    block_start = {block: 0 for block in INPUT_BLOCK_DTYPES}
+
+    def add(feature_name, block, dimension):
+        plan[feature_name] = (block, block_start[block], block_start[block] + dimension)
+        block_start[block] += dimension
+
+    for feat in feature_columns:
+        feat_name = feat.name
+        if feat_name in plan:
+            continue
+        if isinstance(feat, SparseFeat):
+            add(feat_name, "ids", 1)
+        elif isinstance(feat, DenseFeat):
+            add(feat_name, "dense", feat.dimension)
+        elif isinstance(feat, VarLenSparseFeat):
+            add(feat_name, "ids", feat.maxlen)
+            if feat.length_name is not None and feat.length_name not in plan:
+                add(feat.length_name, "lengths", 1)
+        else:
+            raise TypeError("Invalid feature column type,got", type(feat))
+    return plan
+
+
+class FeatureBatch(object):
+    """Model input kept as typed tensors instead of one float matrix holding ids.
+    Ids, history lengths and dense values are stored in separate contiguous blocks (see
+    ``INPUT_BLOCK_DTYPES``), and the columns of every feature are found through its plan.
+    Rows can be sliced, gathered and assigned like those of a tensor.
+    :param blocks: dict, {block name: tensor [batch_size, block width]}
+    :param plan: OrderedDict, {feature_name:(block, start, start+dimension)} from build_input_plan
+    """
+
+    def __init__(self, blocks, plan):
+        self.blocks = blocks
+        self.plan = plan
+
+    @classmethod
+    def from_arrays(cls, arrays, plan):
+        # arrays: {feature_name: array [batch_size] or [batch_size, dimension]}
+        num_rows = len(arrays[next(iter(plan))])
+        widths = {block: 0 for block in INPUT_BLOCK_DTYPES}
+        for block, _, end in plan.values():
+            widths[block] = max(widths[block], end)
+        blocks = {block: np.zeros((num_rows, widths[block]), dtype=dtype)
+                  for block, dtype in INPUT_BLOCK_DTYPES.items()}
+        for feature_name, (block, start, end) in plan.items():
+            # histories shorter than the feature's maxlen are padded with 0, longer ones are cut
+            values = np.asarray(arrays[feature_name]).reshape(num_rows, -1)[:, :end - start]
+            blocks[block][:, start:start + values.shape[1]] = values
+        return cls({block: torch.from_numpy(values) for block, values in blocks.items()}, plan)
+
+    @classmethod
+    def cat(cls, batches):
+        return cls({block: torch.cat([batch.blocks[block] for batch in batches], dim=0)
+                    for block in batches[0].blocks}, batches[0].plan)
+
+    def column(self, feature_name):
+        block, start, end = self.plan[feature_name]
+        return self.blocks[block][:, start:end]
+
+    def _map(self, fn):
+        return FeatureBatch({block: fn(values) for block, values in self.blocks.items()}, self.plan)
+
+    def to(self, device, non_blocking=False):
+        return self._map(lambda values: values.to(device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        return self._map(lambda values: values.pin_memory())
+
+    def index_select(self, dim, index):
+        if dim != 0:
+            raise ValueError("FeatureBatch only supports selecting rows")
+        return self._map(lambda values: values.index_select(0, index))
+
+    def repeat_interleave(self, repeats, dim=0):
+        if dim != 0:
+            raise ValueError("FeatureBatch only supports repeating rows")
+        return self._map(lambda values: values.repeat_interleave(repeats, dim=0))
+
+    def new_empty(self, num_rows):
+        return self._map(lambda values: values.new_empty((num_rows,) + tuple(values.shape[1:])))
+
+    def nbytes(self):
+        return sum(values.element_size() * values.nelement() for values in self.blocks.values())
+
+    @property
+    def device(self):
+        return next(iter(self.blocks.values())).device
+
+    def __len__(self):
+        return len(next(iter(self.blocks.values())))
+
+    def __getitem__(self, rows):
+        return self._map(lambda values: values[rows])
+
+    def __setitem__(self, rows, other):
+        for block, values in self.blocks.items():
+            values[rows] = other.blocks[block]
+
+
+def get_input(X, feature_index, feature_name):
+    # columns of one feature, from a FeatureBatch or from a single concatenated input tensor
+    if isinstance(X, FeatureBatch):
+        return X.column(feature_name)
+    return X[:, feature_index[feature_name][0]:feature_index[feature_name][1]]
+
+
+def concat_inputs(inputs):
+    if isinstance(inputs[0], FeatureBatch):
+        return FeatureBatch.cat(inputs)
+    return torch.cat(inputs, dim=0)
+
+
+def input_to_device(X, device):
+    # a FeatureBatch keeps the dtypes of its blocks, a concatenated input tensor is used as float
+    if isinstance(X, FeatureBatch):
+        return X.to(device)
+    return X.to(device).float()
+
+
+def get_history_length(X, feature_index, varlen_sparse_feature_columns):
+    # [B] longest history of every row, over the length columns of the history features
+    lengths = [get_input(X, feature_index, fc.length_name)[:, 0].long()
+               for fc in varlen_sparse_feature_columns if fc.length_name is not None]
+    if len(lengths) == 0:
+        return None
+    return torch.stack(lengths, dim=1).max(dim=1)[0]
+
+
+def trim_histories(X, varlen_sparse_feature_columns, round_pow2=False):
+    # FeatureBatch whose history ids are cut to the longest history of the batch, so that the
+    # sequence layers do not work on positions that are padding in every row.
+    # With round_pow2, the kept length is rounded up to a power of two, so that a compiled model
+    # only sees a few history shapes.
+    # Histories without length column are masked by their ids and kept as they are, and so is
+    # a concatenated input tensor, whose layout is fixed by the model's feature_index
+    if not isinstance(X, FeatureBatch) or len(varlen_sparse_feature_columns) == 0:
+        return X
+    if any(fc.length_name is None for fc in varlen_sparse_feature_columns):
+        return X
+    hist_names = set(fc.name for fc in varlen_sparse_feature_columns)
+    lengths = get_history_length(X, None, varlen_sparse_feature_columns)
+    maxlen = max(int(lengths.max()), 1) if len(lengths) > 0 else 1
+    if round_pow2:
+        maxlen = 1 << (maxlen - 1).bit_length()
+    if all(X.plan[name][2] - X.plan[name][1] <= maxlen for name in hist_names):
+        return X
+
+    # the ids block is rebuilt with the kept columns, the other blocks are shared
+    plan = OrderedDict()
+    columns = []
+    width = 0
+    for feature_name, (block, start, end) in X.plan.items():
+        if block != "ids":
+            plan[feature_name] = (block, start, end)
+            continue
+        if feature_name in hist_names:
+            end = min(end, start + maxlen)
+        columns.append(X.blocks["ids"][:, start:end])
+        plan[feature_name] = ("ids", width, width + end - start)
+        width += end - start
+    blocks = dict(X.blocks)
+    blocks["ids"] = torch.cat(columns, dim=1)
+    return FeatureBatch(blocks, plan)
+
+
 def combined_dnn_input(sparse_embedding_list, dense_value_list):
     if len(sparse_embedding_list) > 0 and len(dense_value_list) > 0:
         sparse_dnn_input = torch.flatten(
@@ -138,20 +312,44 @@ def combined_dnn_input(sparse_embedding_list, dense_value_list):
         raise NotImplementedError
 
 
-def get_varlen_pooling_list(embedding_dict, features, feature_index, varlen_sparse_feature_columns, device):
+def split_feature_columns(feature_columns):
+    # Return (sparse, dense, varlen sparse) feature columns, in their order
+    sparse_feature_columns = list(
+        filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
+    dense_feature_columns = list(
+        filter(lambda x: isinstance(x, DenseFeat), feature_columns)) if len(feature_columns) else []
+    varlen_sparse_feature_columns = list(
+        filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if len(feature_columns) else []
+    return sparse_feature_columns, dense_feature_columns, varlen_sparse_feature_columns
+
+
+def build_varlen_pooling_layers(varlen_sparse_feature_columns, device='cpu'):
+    # Return nn.ModuleDict: {feature_name: SequencePoolingLayer} used by get_varlen_pooling_list,
+    # built once with the model so that no module is constructed in its forward pass
+    return nn.ModuleDict(
+        {feat.name: SequencePoolingLayer(mode=feat.combiner, supports_masking=feat.length_name is None,
+                                         device=device)
+         for feat in varlen_sparse_feature_columns})
+
+
+def get_varlen_pooling_list(embedding_dict, features, feature_index, varlen_sparse_feature_columns, device,
+                            pooling_layers=None):
     varlen_sparse_embedding_list = []
     for feat in varlen_sparse_feature_columns:
         seq_emb = embedding_dict[feat.name]
+        if pooling_layers is not None:
+            pooling_layer = pooling_layers[feat.name]
+        else:
+            pooling_layer = SequencePoolingLayer(mode=feat.combiner, supports_masking=feat.length_name is None,
+                                                 device=device)
         if feat.length_name is None:
-            seq_mask = features[:, feature_index[feat.name][0]:feature_index[feat.name][1]].long() != 0
-            emb = SequencePoolingLayer(mode=feat.combiner, supports_masking=True, device=device)(
-                [seq_emb, seq_mask])
+            seq_mask = get_input(features, feature_index, feat.name).long() != 0
+            emb = pooling_layer([seq_emb, seq_mask])
         else:
             # print(features.shape)
             # exit()
-            seq_length = features[:, feature_index[feat.length_name][0]:feature_index[feat.length_name][1]].long()
-            emb = SequencePoolingLayer(mode=feat.combiner, supports_masking=False, device=device)(
-                [seq_emb, seq_length])
+            seq_length = get_input(features, feature_index, feat.length_name).long()
+            emb = pooling_layer([seq_emb, seq_length])
         varlen_sparse_embedding_list.append(emb)
     return varlen_sparse_embedding_list
 
@@ -202,8 +400,7 @@ def embedding_lookup(X, sparse_embedding_dict, sparse_input_dict, sparse_feature
             # TODO: add hash function
             # if fc.use_hash:
             #     raise NotImplementedError("hash function is not implemented in this version!")
-            lookup_idx = np.array(sparse_input_dict[feature_name])
-            input_tensor = X[:, lookup_idx[0]:lookup_idx[1]].long()
+            input_tensor = get_input(X, sparse_input_dict, feature_name).long()
             emb = sparse_embedding_dict[embedding_name](input_tensor)
             group_embedding_dict[fc.group_name].append(emb)
     if to_list:
@@ -216,14 +413,11 @@ def varlen_embedding_lookup(X, embedding_dict, sequence_input_dict, varlen_spars
     for fc in varlen_sparse_feature_columns:
         feature_name = fc.name
         embedding_name = fc.embedding_name
-        if fc.use_hash:
-            # lookup_idx = Hash(fc.vocabulary_size, mask_zero=True)(sequence_input_dict[feature_name])
-            # TODO: add hash function
-            lookup_idx = sequence_input_dict[feature_name]
-        else:
-            lookup_idx = sequence_input_dict[feature_name]
+        # TODO: add hash function
+        # if fc.use_hash:
+        #     lookup_idx = Hash(fc.vocabulary_size, mask_zero=True)(sequence_input_dict[feature_name])
         varlen_embedding_vec_dict[feature_name] = embedding_dict[embedding_name](
-            X[:, lookup_idx[0]:lookup_idx[1]].long())  # (lookup_idx)
+            get_input(X, sequence_input_dict, feature_name).long())
 
     return varlen_embedding_vec_dict
 
@@ -233,8 +427,7 @@ def get_dense_input(X, features, feature_columns):
         x, DenseFeat), feature_columns)) if feature_columns else []
     dense_input_list = []
     for fc in dense_feature_columns:
-        lookup_idx = np.array(features[fc.name])
-        input_tensor = X[:, lookup_idx[0]:lookup_idx[1]].float()
+        input_tensor = get_input(X, features, fc.name).float()
         dense_input_list.append(input_tensor)
     return dense_input_list
 
@@ -242,5 +435,4 @@ def get_dense_input(X, features, feature_columns):
 def maxlen_lookup(X, sparse_input_dict, maxlen_column):
     if maxlen_column is None or len(maxlen_column)==0:
         raise ValueError('please add max length column for VarLenSparseFeat of DIN/DIEN input')
-    lookup_idx = np.array(sparse_input_dict[maxlen_column[0]])
-    return X[:, lookup_idx[0]:lookup_idx[1]].long()
\ No newline at end of file
+    return get_input(X, sparse_input_dict, maxlen_column[0]).long()
\ No newline at end of file
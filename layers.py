@@ -135,7 +135,8 @@ class DNN(nn.Module):
             fc = self.linears[i](deep_input)
 
             if self.use_bn:
-                fc = self.bn[i](fc)
+                # batch statistics in float32, under autocast fc may be half precision
+                fc = self.bn[i](fc.float())
 
             fc = self.activation_layers[i](fc)
 
@@ -162,7 +163,8 @@ class PredictionLayer(nn.Module):
             self.bias = nn.Parameter(torch.zeros((1,)))
 
     def forward(self, X):
-        output = X
+        # in float32 under autocast, a half precision sigmoid saturates to 0 or 1 too early
+        output = X.float()
         if self.use_bias:
             output += self.bias
         if self.task == 'binary':
@@ -1,5 +1,6 @@
 # for some tf warnings
 import os
+import sys
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import argparse
@@ -10,15 +11,43 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from collections import defaultdict
-import torch.utils.data as Data
+from contextlib import nullcontext
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
 
 # from deepctr_torch.inputs import (DenseFeat, SparseFeat, VarLenSparseFeat,
 #                                   get_feature_names)
 # from deepctr_torch.models.din import DIN
 from sklearn.metrics import roc_auc_score
-from inputs import DenseFeat, SparseFeat, VarLenSparseFeat, get_feature_names
+from inputs import DenseFeat, SparseFeat, VarLenSparseFeat, FeatureBatch, get_feature_names
+from inputs import get_history_length, trim_histories
+from manifest import find_manifest, load_manifest
+from history_table import HIST_ENTITY_COLUMNS, EntityHistoryTable, PooledHistoryTable
+from negative_sampling import NegativeSampler
+from history_store import STORE_META_NAME, RingBufferHistoryStore
+from online import RatingLog, train_online
+from shard_loader import LazyFeatureDict, ShardCache, ShuffleBuffer, iterate_shard_batches
+from hogwild import HogwildTrainer
+from optimizers import build_optimizer
+from precision import PRECISIONS, autocast
+from compiled import compile_model, mark_dynamic_batch
+from checkpoint import (
+    AsyncCheckpointWriter,
+    EmbeddingRowTracker,
+    load_checkpoint,
+    read_checkpoint_tags,
+    tag_checkpoint,
+)
+from validation import AsyncValidator
+from distributed import (
+    all_reduce_mean,
+    assign_shards,
+    broadcast_object,
+    cleanup_distributed,
+    init_distributed,
+    is_distributed,
+    launch_workers,
+)
 from din import DIN
 from dien import DIEN
 from difm import DIFM
@@ -27,83 +56,81 @@ random.seed(10)
 np.random.seed(10)
 
 
-# process features into format for DIN
-def process_features(
-    data_type,
-    sparse_feature_path,
-    hist_feature_path,
-    hist_feature_type,
-    verbose=False,
-):
+# list to indicate sequence sparse field for each ic/uc feature type
+BEHAVIOR_FEATURE_LISTS = {
+    'IC': ['positive_movie_id', 'negative_movie_id'],
+    'UC': ['positive_user_id', 'negative_user_id'],
+    'Hybrid': ['positive_movie_id', 'negative_movie_id', 'positive_user_id', 'negative_user_id'],
+}
 
-    # loaded features keys can be found in process_data.py
-    sparse_features = pd.read_csv(
-        sparse_feature_path,
-        engine='python',
-        header='infer',
-    )
-    # IC/UC features
-    hist_features = np.load(hist_feature_path, allow_pickle=True)
+# (npz history array, length column) that feeds each behavior feature above
+HIST_FEATURE_KEYS = {
+    'IC': [
+        ('positive_ic_feature', 'positive_seq_length'),
+        ('negative_ic_feature', 'negative_seq_length'),
+    ],
+    'UC': [
+        ('positive_uc_feature', 'positive_seq_length'),
+        ('negative_uc_feature', 'negative_seq_length'),
+    ],
+    'Hybrid': [
+        ('positive_ic_feature', 'positive_ic_seq_length'),
+        ('negative_ic_feature', 'negative_ic_seq_length'),
+        ('positive_uc_feature', 'positive_uc_seq_length'),
+        ('negative_uc_feature', 'negative_uc_seq_length'),
+    ],
+}
 
-    # users
-    user_id = sparse_features['user_id'].to_numpy()
-    if data_type == '1M':
-        gender = sparse_features['gender'].to_numpy()
-        age = sparse_features['age'].to_numpy()
-        occupation = sparse_features['occupation'].to_numpy()
-
-    # movies
-    movie_id = sparse_features['movie_id'].to_numpy()  # 0 is mask value
-    score = sparse_features['rating'].to_numpy()
-    # movie_name = sparse_features['movie_name'].to_numpy()
-    # genre = sparse_features['genre'].to_numpy()
-
-    # ic/uc features
-    if hist_feature_type == 'IC':
-        positive_behavior_feature = hist_features['positive_ic_feature'].astype(int)
-        positive_behavior_length = hist_features['positive_ic_feature_length'].astype(int)
-        negative_behavior_feature = hist_features['negative_ic_feature'].astype(int)
-        negative_behavior_length = hist_features['negative_ic_feature_length'].astype(int)
-    elif hist_feature_type == 'UC':
-        positive_behavior_feature = hist_features['positive_uc_feature'].astype(int)
-        positive_behavior_length = hist_features['positive_uc_feature_length'].astype(int)
-        negative_behavior_feature = hist_features['negative_uc_feature'].astype(int)
-        negative_behavior_length = hist_features['negative_uc_feature_length'].astype(int)
-    elif hist_feature_type == 'Hybrid':
-        positive_ic_feature = hist_features['positive_ic_feature'].astype(int)
-        positive_ic_feature_length = hist_features['positive_ic_feature_length'].astype(int)
-        negative_ic_feature = hist_features['negative_ic_feature'].astype(int)
-        negative_ic_feature_length = hist_features['negative_ic_feature_length'].astype(int)
-        positive_uc_feature = hist_features['positive_uc_feature'].astype(int)
-        positive_uc_feature_length = hist_features['positive_uc_feature_length'].astype(int)
-        negative_uc_feature = hist_features['negative_uc_feature'].astype(int)
-        negative_uc_feature_length = hist_features['negative_uc_feature_length'].astype(int)
-    else:
-        raise Exception(f'Unrecognized feature type {hist_feature_type}')
 
-    # Make sure that the sparse and IC/UC features should have the same length
-    # if len(sparse_features) != len(positive_behavior_feature):
-    #     raise Exception(
-    #         f"Sparse ({len(sparse_features)}) and IC/UC ({len(positive_behavior_feature)}) features should have the same length"
-    #     )
+# csv column that feeds each sparse/dense model input, see process_data.py
+SPARSE_SOURCE_COLUMNS = {
+    'positive_user_id': 'user_id',
+    'negative_user_id': 'user_id',
+    'gender': 'gender',
+    'age': 'age',
+    'occupation': 'occupation',
+    'positive_movie_id': 'movie_id',
+    'negative_movie_id': 'movie_id',
+    'score': 'rating',
+}
 
-    # labels
-    labels = sparse_features['labels'].to_numpy()
+# user demographics, only available in the 1M dataset
+DEMOGRAPHIC_COLUMNS = ['gender', 'age', 'occupation']
+
+
+# histories are ordered from the most recent (see process_data.py), so capping their length
+# at load time keeps the latest max_hist_len items. None or 0 for no cap
+def cap_hist_maxlen(maxlen, max_hist_len=None):
+    if not max_hist_len:
+        return maxlen
+    return min(maxlen, max_hist_len)
+
+
+# count the shards of a feature folder (one csv and one npz per shard)
+def count_shards(data_dir):
+    return len([f for f in os.listdir(data_dir) if f.endswith('.npz')])
+
+
+# DNN feature columns for the deep part of the models
+# vocab: {'user_id', 'movie_id', 'hist_<behavior>'} -> vocabulary size
+# hist_maxlen: {length column name} -> history length
+def get_feature_columns(data_type, hist_feature_type, vocab, hist_maxlen):
+    if hist_feature_type not in BEHAVIOR_FEATURE_LISTS:
+        raise Exception(f'Unrecognized feature type {hist_feature_type}')
 
-    # DNN feature columns for the deep part of DIN
     # duplicate user_id and movie_id for both positive and negative
     if data_type == '1M':
         feature_columns = [
-            SparseFeat('positive_user_id', len(user_id), embedding_dim=32),
-            SparseFeat('negative_user_id', len(user_id), embedding_dim=32),
+            SparseFeat('positive_user_id', vocab['user_id'], embedding_dim=32),
+            SparseFeat('negative_user_id', vocab['user_id'], embedding_dim=32),
             SparseFeat('gender', 2, embedding_dim=8),
             SparseFeat('age', 57, embedding_dim=8),
             SparseFeat('occupation', 21, embedding_dim=8),
             SparseFeat(
-                'positive_movie_id', len(movie_id) + 1, embedding_dim=32
+                'positive_movie_id', vocab['movie_id'], embedding_dim=32
             ),  # 0 is mask value
             SparseFeat(
-                'negative_movie_id', len(movie_id) + 1, embedding_dim=32
+                'negative_movie_id', vocab['movie_id'], embedding_dim=32
             ),  # 0 is mask value
             DenseFeat('score', 1),
             # SparseFeat('movie_name', len(set(movie_name)), embedding_dim=8),
@@ -111,162 +138,467 @@ def process_features(
         ]
     else:
         feature_columns = [
-            SparseFeat('positive_user_id', len(user_id), embedding_dim=32),
-            SparseFeat('negative_user_id', len(user_id), embedding_dim=32),
-            SparseFeat('positive_movie_id', len(movie_id) + 1, embedding_dim=32),
-            SparseFeat('negative_movie_id', len(movie_id) + 1, embedding_dim=32),
+            SparseFeat('positive_user_id', vocab['user_id'], embedding_dim=32),
+            SparseFeat('negative_user_id', vocab['user_id'], embedding_dim=32),
+            SparseFeat('positive_movie_id', vocab['movie_id'], embedding_dim=32),
+            SparseFeat('negative_movie_id', vocab['movie_id'], embedding_dim=32),
             DenseFeat('score', 1),
             # SparseFeat('movie_name', len(set(movie_name)), embedding_dim=8),
             # SparseFeat('genre', len(set(genre)), embedding_dim=8),
         ]
 
     # ic/uc feature
-    # list to indicate sequence sparse field
-    if hist_feature_type == 'IC':
-        behavior_feature_list = [
-            'positive_movie_id',
-            'negative_movie_id',
-        ]
-    elif hist_feature_type == 'UC':
-        behavior_feature_list = [
-            'positive_user_id',
-            'negative_user_id',
-        ]
-    elif hist_feature_type == 'Hybrid':
-        behavior_feature_list = [
-            'positive_movie_id',
-            'negative_movie_id',
-            'positive_user_id',
-            'negative_user_id',
-        ]
-
-    if hist_feature_type == 'IC' or hist_feature_type == 'UC':
-        feature_columns += [
-            VarLenSparseFeat(
-                SparseFeat(
-                    f'hist_{behavior_feature_list[0]}',
-                    len(positive_behavior_feature) + 1,
-                    embedding_dim=32,
-                ),
-                maxlen=max(positive_behavior_length),
-                length_name='positive_seq_length',
-            ),
-            VarLenSparseFeat(
-                SparseFeat(
-                    f'hist_{behavior_feature_list[1]}',
-                    len(negative_behavior_feature) + 1,
-                    embedding_dim=32,
-                ),
-                maxlen=max(negative_behavior_length),
-                length_name='negative_seq_length',
-            ),
-        ]
-    elif hist_feature_type == 'Hybrid':
-        feature_columns += [
-            VarLenSparseFeat(
-                SparseFeat(
-                    f'hist_{behavior_feature_list[0]}',
-                    len(positive_ic_feature) + 1,
-                    embedding_dim=32,
-                ),
-                maxlen=max(positive_ic_feature_length),
-                length_name='positive_ic_seq_length',
-            ),
-            VarLenSparseFeat(
-                SparseFeat(
-                    f'hist_{behavior_feature_list[1]}',
-                    len(negative_ic_feature) + 1,
-                    embedding_dim=32,
-                ),
-                maxlen=max(negative_ic_feature_length),
-                length_name='negative_ic_seq_length',
-            ),
-            VarLenSparseFeat(
-                SparseFeat(
-                    f'hist_{behavior_feature_list[2]}',
-                    len(positive_uc_feature) + 1,
-                    embedding_dim=32,
-                ),
-                maxlen=max(positive_uc_feature_length),
-                length_name='positive_uc_seq_length',
-            ),
+    behavior_feature_list = BEHAVIOR_FEATURE_LISTS[hist_feature_type]
+    for behavior, (_, length_name) in zip(
+        behavior_feature_list, HIST_FEATURE_KEYS[hist_feature_type]
+    ):
+        feature_columns.append(
             VarLenSparseFeat(
                 SparseFeat(
-                    f'hist_{behavior_feature_list[3]}',
-                    len(negative_uc_feature) + 1,
+                    f'hist_{behavior}',
+                    vocab[f'hist_{behavior}'],
                     embedding_dim=32,
                 ),
-                maxlen=max(negative_uc_feature_length),
-                length_name='negative_uc_seq_length',
-            ),
-        ]
+                maxlen=hist_maxlen[length_name],
+                length_name=length_name,
+            )
+        )
 
-    # feature dictrionary
-    if data_type == '1M':
-        feature_dict = {
-            'positive_user_id': user_id,
-            'negative_user_id': user_id,
-            'gender': gender,
-            'age': age,
-            'occupation': occupation,
-            'positive_movie_id': movie_id,
-            'negative_movie_id': movie_id,
-            'score': score,
-            # 'movie_name': movie_name,
-            # 'genre': genre,
-            f'hist_{behavior_feature_list[0]}': positive_behavior_feature,
-            'positive_seq_length': positive_behavior_length,
-            f'hist_{behavior_feature_list[1]}': negative_behavior_feature,
-            'negative_seq_length': negative_behavior_length,
+    return feature_columns, behavior_feature_list
+
+
+# feature columns built from the dataset manifest (see manifest.py), without touching any shard
+def get_feature_columns_from_manifest(data_type, hist_feature_type, manifest, max_hist_len=None):
+    if hist_feature_type not in BEHAVIOR_FEATURE_LISTS:
+        raise Exception(f'Unrecognized feature type {hist_feature_type}')
+
+    vocab = {
+        'user_id': manifest['vocab']['user_id'],
+        'movie_id': manifest['vocab']['movie_id'],
+    }
+    hist_keys = HIST_FEATURE_KEYS[hist_feature_type]
+    for behavior, (hist_key, _) in zip(BEHAVIOR_FEATURE_LISTS[hist_feature_type], hist_keys):
+        # IC histories are lists of movies, UC histories are lists of users
+        if '_ic_' in hist_key:
+            vocab[f'hist_{behavior}'] = vocab['movie_id']
+        else:
+            vocab[f'hist_{behavior}'] = vocab['user_id']
+
+    # history embeddings are concatenated by DIN/DIEN, so all histories share one length
+    maxlen = max(
+        [manifest['history'][f'{hist_key}_length']['max'] for hist_key, _ in hist_keys] + [1]
+    )
+    maxlen = cap_hist_maxlen(maxlen, max_hist_len)
+    hist_maxlen = {length_name: maxlen for _, length_name in hist_keys}
+
+    return get_feature_columns(data_type, hist_feature_type, vocab, hist_maxlen)
+
+
+# process features into format for DIN
+# feature_names: model inputs to load (e.g. the model's input_plan), None for all of them.
+# Only the csv columns and npz arrays behind these inputs are read, and every array is only
+# converted the first time it is accessed
+# max_hist_len: load-time cap of the history length, see cap_hist_maxlen
+def process_features(
+    data_type,
+    sparse_feature_path,
+    hist_feature_path,
+    hist_feature_type,
+    verbose=False,
+    manifest=None,
+    feature_names=None,
+    max_hist_len=None,
+):
+    if hist_feature_type not in BEHAVIOR_FEATURE_LISTS:
+        raise Exception(f'Unrecognized feature type {hist_feature_type}')
+
+    behavior_feature_list = BEHAVIOR_FEATURE_LISTS[hist_feature_type]
+    hist_keys = HIST_FEATURE_KEYS[hist_feature_type]
+    sparse_names = [
+        name
+        for name, column in SPARSE_SOURCE_COLUMNS.items()
+        if data_type == '1M' or column not in DEMOGRAPHIC_COLUMNS
+    ]
+    if feature_names is None:
+        feature_names = sparse_names + [f'hist_{behavior}' for behavior in behavior_feature_list]
+        feature_names += [length_name for _, length_name in hist_keys]
+    feature_names = set(feature_names)
+
+    # loaded features keys can be found in process_data.py
+    # string columns (movie_name, genre) are never parsed
+    csv_columns = {SPARSE_SOURCE_COLUMNS[name] for name in sparse_names if name in feature_names}
+    sparse_features = pd.read_csv(
+        sparse_feature_path,
+        header='infer',
+        usecols=sorted(csv_columns | {'labels'}),
+    )
+    # IC/UC features, npz members are only read when accessed
+    hist_features = np.load(hist_feature_path, allow_pickle=True)
+
+    # labels
+    labels = sparse_features['labels'].to_numpy()
+
+    if manifest is not None:
+        # global vocab sizes and history lengths
+        feature_columns, _ = get_feature_columns_from_manifest(
+            data_type, hist_feature_type, manifest, max_hist_len
+        )
+        hist_maxlen = {
+            feat.length_name: feat.maxlen
+            for feat in feature_columns
+            if isinstance(feat, VarLenSparseFeat)
         }
     else:
-        if hist_feature_type == 'IC' or hist_feature_type == 'UC':
-            feature_dict = {
-                'positive_user_id': user_id,
-                'negative_user_id': user_id,
-                'positive_movie_id': movie_id,
-                'negative_movie_id': movie_id,
-                'score': score,
-                # 'movie_name': movie_name,
-                # 'genre': genre,
-                f'hist_{behavior_feature_list[0]}': positive_behavior_feature,
-                'positive_seq_length': positive_behavior_length,
-                f'hist_{behavior_feature_list[1]}': negative_behavior_feature,
-                'negative_seq_length': negative_behavior_length,
-            }
-        elif hist_feature_type == 'Hybrid':
-            feature_dict = {
-                'positive_user_id': user_id,
-                'negative_user_id': user_id,
-                'positive_movie_id': movie_id,
-                'negative_movie_id': movie_id,
-                'score': score,
-                f'hist_{behavior_feature_list[0]}': positive_ic_feature,
-                'positive_ic_seq_length': positive_ic_feature_length,
-                f'hist_{behavior_feature_list[1]}': negative_ic_feature,
-                'negative_ic_seq_length': negative_ic_feature_length,
-                f'hist_{behavior_feature_list[2]}': positive_uc_feature,
-                'positive_uc_seq_length': positive_uc_feature_length,
-                f'hist_{behavior_feature_list[3]}': negative_uc_feature,
-                'negative_uc_seq_length': negative_uc_feature_length,
-            }
+        # without a manifest, sizes are derived from the current file
+        vocab = {'user_id': len(labels), 'movie_id': len(labels) + 1}
+        hist_maxlen = {}
+        for behavior, (hist_key, length_name) in zip(behavior_feature_list, hist_keys):
+            vocab[f'hist_{behavior}'] = len(labels) + 1
+            hist_maxlen[length_name] = cap_hist_maxlen(
+                max(hist_features[f'{hist_key}_length'].astype(int)), max_hist_len
+            )
+        feature_columns, _ = get_feature_columns(
+            data_type, hist_feature_type, vocab, hist_maxlen
+        )
 
-    if verbose:
-        print('Feature dict includes:')
-        for name in get_feature_names(feature_columns):
-            print(name, feature_dict[name].dtype)
+    # feature dictrionary, users/movies/score from the csv and ic/uc features from the npz
+    feature_dict = LazyFeatureDict()
+    for name in sparse_names:
+        if name in feature_names:
+            feature_dict.add(
+                name, lambda column=SPARSE_SOURCE_COLUMNS[name]: sparse_features[column].to_numpy()
+            )
+    for behavior, (hist_key, length_name) in zip(behavior_feature_list, hist_keys):
+        # histories are generated with a fixed width, keep the (most recent) part covered by
+        # the model, and clamp the lengths to it
+        width = hist_maxlen[length_name]
+        feature_dict.add(
+            f'hist_{behavior}',
+            lambda hist_key=hist_key, width=width: hist_features[hist_key][:, :width].astype(int),
+        )
+        feature_dict.add(
+            length_name,
+            lambda hist_key=hist_key, width=width: np.minimum(
+                hist_features[f'{hist_key}_length'].astype(int), width
+            ),
+        )
 
-    # get all the data with associated users
-    data_input = {name: feature_dict[name] for name in get_feature_names(feature_columns)}
+    # get all the requested data with associated users
+    data_input = feature_dict.project(
+        [name for name in get_feature_names(feature_columns) if name in feature_names]
+    )
     data_label = labels
 
+    if verbose:
+        print('Feature dict includes:')
+        for name in data_input:
+            print(name, data_input[name].dtype)
+
     return data_input, data_label, feature_columns, behavior_feature_list
 
 
+# load one shard as (FeatureBatch, label) tensors, laid out as the model's input_plan
+def load_shard_tensors(
+    data_type,
+    sparse_feature_path,
+    hist_feature_path,
+    feature_type,
+    input_plan,
+    manifest=None,
+    max_hist_len=None,
+):
+    data_input, data_label, _, _ = process_features(
+        data_type,
+        sparse_feature_path,
+        hist_feature_path,
+        feature_type,
+        manifest=manifest,
+        feature_names=input_plan,
+        max_hist_len=max_hist_len,
+    )
+
+    return FeatureBatch.from_arrays(data_input, input_plan), torch.from_numpy(data_label)
+
+
+# rows of every (file index, sparse feature path, hist feature path) shard, from the manifest
+# of their directory, or estimated from the size of the csv files when it misses some shards
+def shard_num_rows(shards, manifest=None):
+    shards = list(shards)
+    shard_stats = manifest['shards'] if manifest is not None else {}
+    names = [os.path.basename(shard[1]) for shard in shards]
+    if all(name in shard_stats for name in names):
+        return [shard_stats[name]['num_rows'] for name in names]
+    return [os.path.getsize(shard[1]) for shard in shards]
+
+
+# key of the decoded content of a (file index, sparse feature path, hist feature path) shard,
+# files rewritten in place get a new key
+def shard_cache_key(shard, feature_type, max_hist_len=None):
+    _, sparse_feature_path, hist_feature_path = shard
+    return (
+        sparse_feature_path,
+        os.path.getmtime(sparse_feature_path),
+        hist_feature_path,
+        os.path.getmtime(hist_feature_path),
+        feature_type,
+        max_hist_len,
+    )
+
+
+# construct the model from its feature columns
+def build_model(
+    model_name,
+    model_type,
+    feature_columns,
+    behavior_feature_list,
+    device,
+    sparse_embedding=False,
+    sum_pool_history=False,
+):
+    if model_name == 'DIN':
+        model = DIN(
+            dnn_feature_columns=feature_columns,
+            history_feature_list=behavior_feature_list,
+            pooling_type=model_type,
+            device=device,
+            att_weight_normalization=True,
+            sparse_embedding=sparse_embedding,
+            sum_pool_history=sum_pool_history,
+        )
+    elif model_name == 'DIEN':
+        model = DIEN(
+            dnn_feature_columns=feature_columns,
+            history_feature_list=behavior_feature_list,
+            device=device,
+            att_weight_normalization=True,
+            sparse_embedding=sparse_embedding,
+        )
+    elif model_name == 'DIFM':
+        model = DIFM(
+            linear_feature_columns=feature_columns,
+            dnn_feature_columns=feature_columns,
+            device=device,
+            sparse_embedding=sparse_embedding,
+        )
+    else:
+        raise Exception(f'Unrecognized model name {model_name}')
+
+    return model
+
+
+# per-entity pooled history table of a sum pooling DIN model, see history_table.py
+def build_pooled_history(
+    model,
+    data_type,
+    feature_type,
+    sparse_feature_paths,
+    hist_feature_paths,
+    manifest,
+    refresh_steps,
+    device,
+    max_hist_len=None,
+):
+    if not isinstance(model, DIN) or model.pooling_type != 'sum':
+        raise Exception('Pooled history tables require the DIN model with sum pooling')
+    if feature_type not in HIST_ENTITY_COLUMNS:
+        raise Exception(f'Pooled history tables are not supported for feature type {feature_type}')
+
+    key_feature = HIST_ENTITY_COLUMNS[feature_type]
+    num_entities = [
+        feat.vocabulary_size for feat in model.sparse_feature_columns if feat.name == key_feature
+    ][0]
+    history_table = EntityHistoryTable(key_feature, model.history_feature_columns, num_entities)
+    feature_names = [key_feature] + list(history_table.hist_ids) + list(history_table.hist_length)
+    for sparse_feature_path, hist_feature_path in zip(sparse_feature_paths, hist_feature_paths):
+        data_input, _, _, _ = process_features(
+            data_type,
+            sparse_feature_path,
+            hist_feature_path,
+            feature_type,
+            manifest=manifest,
+            feature_names=feature_names,
+            max_hist_len=max_hist_len,
+        )
+        history_table.add(data_input)
+
+    # same length column as the one used by DIN to mask the histories
+    length_name = [
+        feat.length_name
+        for feat in model.varlen_sparse_feature_columns
+        if feat.length_name is not None
+    ][0]
+    pooled_history = PooledHistoryTable(
+        history_table,
+        model.history_feature_columns,
+        length_name,
+        refresh_steps=refresh_steps,
+        device=device,
+    )
+    model.set_pooled_history(pooled_history)
+    print(f'Pooled history table built for {len(history_table)} entities')
+
+    return pooled_history
+
+
+# batch-time negative sampler over the movies of the given shards, see negative_sampling.py
+def build_negative_sampler(
+    model,
+    data_type,
+    feature_type,
+    sparse_feature_paths,
+    hist_feature_paths,
+    manifest,
+    num_negatives,
+    power,
+    max_hist_len=None,
+):
+    # UC histories belong to the candidate movie and have to be replaced for sampled movies
+    candidate_hist_names = [
+        f'hist_{behavior}'
+        for behavior, (hist_key, _) in zip(
+            BEHAVIOR_FEATURE_LISTS[feature_type], HIST_FEATURE_KEYS[feature_type]
+        )
+        if '_uc_' in hist_key
+    ]
+    candidate_hist_columns = [
+        feat
+        for feat in model.dnn_feature_columns
+        if isinstance(feat, VarLenSparseFeat) and feat.name in candidate_hist_names
+    ]
+    num_movies = [
+        feat.vocabulary_size
+        for feat in model.dnn_feature_columns
+        if feat.name == 'positive_movie_id'
+    ][0]
+
+    movie_table = EntityHistoryTable('positive_movie_id', candidate_hist_columns, num_movies)
+    movie_counts = np.zeros(num_movies, dtype=np.int64)
+    feature_names = ['positive_movie_id'] + list(movie_table.hist_ids)
+    feature_names += list(movie_table.hist_length)
+    # ratings of the negative examples, the sampled negatives get their ratings from them
+    score_counts = defaultdict(int)
+    if 'score' in model.feature_index:
+        feature_names.append('score')
+    for sparse_feature_path, hist_feature_path in zip(sparse_feature_paths, hist_feature_paths):
+        data_input, data_label, _, _ = process_features(
+            data_type,
+            sparse_feature_path,
+            hist_feature_path,
+            feature_type,
+            manifest=manifest,
+            feature_names=feature_names,
+            max_hist_len=max_hist_len,
+        )
+        movie_table.add(data_input)
+        movie_counts += np.bincount(
+            data_input['positive_movie_id'].astype(np.int64), minlength=num_movies
+        )[:num_movies]
+        if 'score' in data_input:
+            scores = np.asarray(data_input['score']).reshape(-1)[np.asarray(data_label) == 0]
+            for value, count in zip(*np.unique(scores, return_counts=True)):
+                score_counts[float(value)] += int(count)
+
+    print(f'Negative sampler built over {len(movie_table)} movies')
+    return NegativeSampler(
+        movie_table,
+        movie_counts,
+        model.feature_index,
+        num_negatives=num_negatives,
+        power=power,
+        score_values=list(score_counts),
+        score_counts=list(score_counts.values()),
+    )
+
+
+# number of occurrences of every id of the model's embedding tables over the given shards,
+# used by the frequency scaled regularization (see BaseModel.set_regularization_mode)
+def build_feature_counts(
+    model,
+    data_type,
+    feature_type,
+    sparse_feature_paths,
+    hist_feature_paths,
+    manifest,
+    max_hist_len=None,
+):
+    embedding_sizes = {}
+    embedding_input_names = {}
+    for embedding_dict in (model.embedding_dict, model.linear_model.embedding_dict):
+        for embedding_name, embedding in embedding_dict.items():
+            embedding_sizes[embedding_name] = embedding.num_embeddings
+    for embedding_name, names, _ in model.embedding_inputs.values():
+        embedding_input_names.setdefault(embedding_name, set()).update(names)
+
+    feature_counts = {
+        name: np.zeros(size, dtype=np.int64) for name, size in embedding_sizes.items()
+    }
+    feature_names = set().union(*embedding_input_names.values())
+    for sparse_feature_path, hist_feature_path in zip(sparse_feature_paths, hist_feature_paths):
+        data_input, _, _, _ = process_features(
+            data_type,
+            sparse_feature_path,
+            hist_feature_path,
+            feature_type,
+            manifest=manifest,
+            feature_names=feature_names,
+            max_hist_len=max_hist_len,
+        )
+        for embedding_name, names in embedding_input_names.items():
+            size = embedding_sizes[embedding_name]
+            for name in names:
+                ids = np.asarray(data_input[name]).reshape(-1).astype(np.int64)
+                feature_counts[embedding_name] += np.bincount(ids, minlength=size)[:size]
+
+    return feature_counts
+
+
+# model feature columns, from the manifest when available, otherwise from the first shard
+def load_feature_columns(
+    data_type, feature_type, manifest, sparse_feature_path, hist_feature_path, max_hist_len=None
+):
+    if manifest is not None:
+        return get_feature_columns_from_manifest(data_type, feature_type, manifest, max_hist_len)
+
+    print('No dataset manifest found, using the first shard to initialize the model')
+    _, _, feature_columns, behavior_feature_list = process_features(
+        data_type,
+        sparse_feature_path,
+        hist_feature_path,
+        feature_type,
+        feature_names=[],
+        max_hist_len=max_hist_len,
+    )
+    return feature_columns, behavior_feature_list
+
+
+# states of the random generators used by training, saved to resume it mid-epoch
+def get_rng_states(negative_sampler=None):
+    states = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    if negative_sampler is not None:
+        states['negative_sampler'] = negative_sampler.alias_table.rng.bit_generator.state
+    return states
+
+
+def set_rng_states(states, negative_sampler=None):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+    if negative_sampler is not None and 'negative_sampler' in states:
+        negative_sampler.alias_table.rng.bit_generator.state = states['negative_sampler']
+
+
 if __name__ == '__main__':
     # input arguments
     parser = argparse.ArgumentParser()
-    # mode as either train or test
+    # mode as either train, test or online
     parser.add_argument('--mode', action='store', nargs=1, dest='mode', required=True)
     # name of model, choose from DIN, DIEN or DIFM
     parser.add_argument('--model_name', action='store', nargs=1, dest='model_name', required=True)
@@ -295,6 +627,103 @@ if __name__ == '__main__':
     parser.add_argument('--num_epoch', action='store', nargs=1, dest='num_epoch')
     parser.add_argument('--batch_size', action='store', nargs=1, dest='batch_size')
     parser.add_argument('--save_freq', action='store', nargs=1, dest='save_freq')
+    # dataset manifest, defaults to manifest.json in the train (or test) dir
+    parser.add_argument('--manifest_path', action='store', nargs=1, dest='manifest_path')
+    # gather precomputed per-entity pooled histories (DIN with sum pooling only)
+    parser.add_argument(
+        '--pooled_history', action='store_true', dest='pooled_history', default=False
+    )
+    # DIN sum pooling pools the history embeddings instead of the candidate embedding
+    # (implied by --pooled_history), its checkpoints are not compatible with the default ones
+    parser.add_argument(
+        '--sum_pool_history', action='store_true', dest='sum_pool_history', default=False
+    )
+    # refresh the pooled histories every N training steps, 0 for once per epoch
+    parser.add_argument(
+        '--pooled_refresh_steps', action='store', nargs=1, dest='pooled_refresh_steps'
+    )
+    # number of negative movies sampled per positive at batch time (training only)
+    parser.add_argument('--num_negatives', action='store', nargs=1, dest='num_negatives')
+    # popularity smoothing exponent of the negative sampling distribution
+    parser.add_argument('--neg_power', action='store', nargs=1, dest='neg_power')
+    # rows of the cross-shard shuffle buffer, 0 to shuffle within each shard only
+    parser.add_argument(
+        '--shuffle_buffer_size', action='store', nargs=1, dest='shuffle_buffer_size'
+    )
+    # number of shards interleaved by the shuffle buffer
+    parser.add_argument('--num_open_shards', action='store', nargs=1, dest='num_open_shards')
+    # number of shards loaded ahead in background threads, 0 to load them synchronously
+    parser.add_argument('--prefetch_depth', action='store', nargs=1, dest='prefetch_depth')
+    # memory cap (in MB) of the shards loaded ahead, 0 for no cap
+    parser.add_argument(
+        '--prefetch_memory_mb', action='store', nargs=1, dest='prefetch_memory_mb'
+    )
+    # append-only ratings log (file or Unix socket) read in online mode
+    parser.add_argument('--ratings_log', action='store', nargs=1, dest='ratings_log')
+    # replay the existing ratings of the log before following it (online mode)
+    parser.add_argument('--from_start', action='store_true', dest='from_start', default=False)
+    # online mode checkpoint interval in training steps
+    parser.add_argument('--checkpoint_steps', action='store', nargs=1, dest='checkpoint_steps')
+    # stop online training after N steps, 0 to run until interrupted
+    parser.add_argument('--max_steps', action='store', nargs=1, dest='max_steps')
+    # seconds before an incomplete online batch is trained on
+    parser.add_argument('--max_batch_wait', action='store', nargs=1, dest='max_batch_wait')
+    # online history store snapshot, restored if present and updated with every checkpoint
+    parser.add_argument(
+        '--history_snapshot_dir', action='store', nargs=1, dest='history_snapshot_dir'
+    )
+    # group the shuffled rows of every shard by history length within buckets of N batches
+    parser.add_argument('--bucket_batches', action='store', nargs=1, dest='bucket_batches')
+    # cut the histories of every batch to the longest history of the batch
+    parser.add_argument('--trim_history', action='store_true', dest='trim_history', default=False)
+    # keep only the N most recent items of every history, 0 for the full histories
+    parser.add_argument('--max_hist_len', action='store', nargs=1, dest='max_hist_len')
+    # memory budget (in MB) of the decoded shards kept across epochs, 0 to decode every epoch
+    parser.add_argument('--shard_cache_mb', action='store', nargs=1, dest='shard_cache_mb')
+    # never evict the validation shards from the shard cache
+    parser.add_argument(
+        '--pin_val_shards', action='store_true', dest='pin_val_shards', default=False
+    )
+    # number of local data-parallel training processes (torch.distributed over gloo)
+    parser.add_argument('--num_procs', action='store', nargs=1, dest='num_procs')
+    # number of nodes running --num_procs training processes each, and the rank of this node
+    parser.add_argument('--num_nodes', action='store', nargs=1, dest='num_nodes')
+    parser.add_argument('--node_rank', action='store', nargs=1, dest='node_rank')
+    # address and port of the node with rank 0
+    parser.add_argument('--master_addr', action='store', nargs=1, dest='master_addr')
+    parser.add_argument('--master_port', action='store', nargs=1, dest='master_port')
+    # number of hogwild worker processes updating the model in shared memory without locks,
+    # 0 to train in the main process
+    parser.add_argument('--hogwild_workers', action='store', nargs=1, dest='hogwild_workers')
+    # update the dense (non-embedding) parameters of hogwild workers under a lock
+    parser.add_argument(
+        '--hogwild_sync_dense', action='store_true', dest='hogwild_sync_dense', default=False
+    )
+    # sparse embedding gradients, with an optimizer that only updates the rows of every batch
+    parser.add_argument(
+        '--sparse_embedding', action='store_true', dest='sparse_embedding', default=False
+    )
+    # L2 regularization added to the training loss: none, full (whole embedding tables),
+    # batch (embedding rows of the batch only) or batch_freq (batch, scaled by id frequency)
+    parser.add_argument('--regularization', action='store', nargs=1, dest='regularization')
+    # optimizer of the embedding tables: adagrad or rowwise_adagrad (one accumulator per row)
+    parser.add_argument(
+        '--embedding_optimizer', action='store', nargs=1, dest='embedding_optimizer'
+    )
+    # precision of the forward passes: fp32, or bf16 (autocast, float32 weights)
+    parser.add_argument('--precision', action='store', nargs=1, dest='precision')
+    # compile the forward pass of the model with torch.compile (train and test modes)
+    parser.add_argument('--compile', action='store_true', dest='compile', default=False)
+    # number of delta checkpoints (changed embedding rows only) saved after every full one
+    parser.add_argument('--delta_checkpoints', action='store', nargs=1, dest='delta_checkpoints')
+    # also save a checkpoint every N training steps, resumed mid-epoch, 0 to only save epochs
+    parser.add_argument('--save_steps', action='store', nargs=1, dest='save_steps')
+    # validate every epoch in a separate process while the next epoch trains ('train' mode)
+    parser.add_argument(
+        '--async_validation', action='store_true', dest='async_validation', default=False
+    )
+    # number of threads of the validation process, taken from the training threads
+    parser.add_argument('--val_threads', action='store', nargs=1, dest='val_threads')
     parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', default=False)
     args = parser.parse_args()
     mode = args.mode[0]
@@ -314,6 +743,16 @@ if __name__ == '__main__':
     if mode == 'test':
         input_model_path = args.input_model_path[0]
         test_dir = args.test_dir[0]
+    if mode == 'online':
+        output_model_dir = args.output_model_dir[0]
+        ratings_log_path = args.ratings_log[0]
+        history_snapshot_dir = None
+        if args.history_snapshot_dir:
+            history_snapshot_dir = args.history_snapshot_dir[0]
+        continue_training = False
+        if args.input_model_path:
+            input_model_path = args.input_model_path[0]
+            continue_training = True
     if args.num_epoch:
         num_epoch = int(args.num_epoch[0])
     else:
@@ -327,8 +766,164 @@ if __name__ == '__main__':
     else:
         save_freq = 5
     verbose = args.verbose
+    use_pooled_history = args.pooled_history
+    sum_pool_history = args.sum_pool_history or use_pooled_history
+    if args.pooled_refresh_steps:
+        pooled_refresh_steps = int(args.pooled_refresh_steps[0])
+    else:
+        pooled_refresh_steps = 0
+    if args.num_negatives:
+        num_negatives = int(args.num_negatives[0])
+    else:
+        num_negatives = 0
+    if args.neg_power:
+        neg_power = float(args.neg_power[0])
+    else:
+        neg_power = 0.75
+    if args.shuffle_buffer_size:
+        shuffle_buffer_size = int(args.shuffle_buffer_size[0])
+    else:
+        shuffle_buffer_size = 0
+    if args.num_open_shards:
+        num_open_shards = int(args.num_open_shards[0])
+    else:
+        num_open_shards = 4
+    if args.prefetch_depth:
+        prefetch_depth = int(args.prefetch_depth[0])
+    else:
+        prefetch_depth = 1
+    if args.prefetch_memory_mb:
+        prefetch_max_bytes = int(float(args.prefetch_memory_mb[0]) * 2**20)
+    else:
+        prefetch_max_bytes = None
+    if args.checkpoint_steps:
+        checkpoint_steps = int(args.checkpoint_steps[0])
+    else:
+        checkpoint_steps = 1000
+    if args.max_steps:
+        max_steps = int(args.max_steps[0])
+    else:
+        max_steps = 0
+    if args.max_batch_wait:
+        max_batch_wait = float(args.max_batch_wait[0])
+    else:
+        max_batch_wait = 1.0
+    if args.bucket_batches:
+        bucket_batches = int(args.bucket_batches[0])
+    else:
+        bucket_batches = 0
+    trim_history = args.trim_history
+    if args.max_hist_len:
+        max_hist_len = int(args.max_hist_len[0])
+    else:
+        max_hist_len = 0
+    if args.shard_cache_mb:
+        shard_cache_bytes = int(float(args.shard_cache_mb[0]) * 2**20)
+    else:
+        shard_cache_bytes = 0
+    pin_val_shards = args.pin_val_shards
+    if args.num_procs:
+        num_procs = int(args.num_procs[0])
+    else:
+        num_procs = 1
+    if args.num_nodes:
+        num_nodes = int(args.num_nodes[0])
+    else:
+        num_nodes = 1
+    if args.node_rank:
+        node_rank = int(args.node_rank[0])
+    else:
+        node_rank = 0
+    if args.master_addr:
+        master_addr = args.master_addr[0]
+    else:
+        master_addr = '127.0.0.1'
+    if args.master_port:
+        master_port = int(args.master_port[0])
+    else:
+        master_port = 29500
 
-    if torch.cuda.is_available():
+    if args.hogwild_workers:
+        hogwild_workers = int(args.hogwild_workers[0])
+    else:
+        hogwild_workers = 0
+    hogwild_sync_dense = args.hogwild_sync_dense
+    sparse_embedding = args.sparse_embedding
+    if args.regularization:
+        regularization = args.regularization[0]
+    else:
+        regularization = 'none'
+    if regularization not in ['none', 'full', 'batch', 'batch_freq']:
+        raise Exception(f'Unrecognized regularization {regularization}')
+    if regularization == 'full' and sparse_embedding:
+        # the penalty of the whole tables would give them dense gradients at every step
+        raise Exception(
+            '--regularization full can not be combined with --sparse_embedding, use batch'
+        )
+    if args.embedding_optimizer:
+        embedding_optimizer = args.embedding_optimizer[0]
+    else:
+        embedding_optimizer = 'adagrad'
+    if embedding_optimizer not in ['adagrad', 'rowwise_adagrad']:
+        raise Exception(f'Unrecognized embedding optimizer {embedding_optimizer}')
+    if args.precision:
+        precision = args.precision[0]
+    else:
+        precision = 'fp32'
+    if precision not in PRECISIONS:
+        raise Exception(f'Unrecognized precision {precision}')
+    compile_forward = args.compile
+    if args.delta_checkpoints:
+        delta_checkpoints = int(args.delta_checkpoints[0])
+    else:
+        delta_checkpoints = 0
+    if hogwild_workers > 0 and delta_checkpoints > 0:
+        raise Exception('Hogwild training can not be combined with --delta_checkpoints')
+    if args.save_steps:
+        save_steps = int(args.save_steps[0])
+    else:
+        save_steps = 0
+    if save_steps > 0 and (hogwild_workers > 0 or num_procs * num_nodes > 1):
+        raise Exception('--save_steps is not supported by hogwild and distributed training')
+    async_validation = args.async_validation
+    if args.val_threads:
+        val_threads = int(args.val_threads[0])
+    else:
+        val_threads = max(1, (os.cpu_count() or 1) // 4)
+    if async_validation and num_procs * num_nodes > 1:
+        raise Exception('--async_validation is not supported by distributed training')
+    if async_validation and use_pooled_history:
+        raise Exception('--async_validation can not be combined with --pooled_history')
+    if hogwild_workers > 0 and compile_forward:
+        raise Exception('Hogwild training can not be combined with --compile')
+    if hogwild_workers > 0 and num_procs * num_nodes > 1:
+        raise Exception('Hogwild training can not be combined with --num_procs/--num_nodes')
+
+    # data-parallel training, this process only launches the workers (that run this script again)
+    if mode == 'train' and num_procs * num_nodes > 1 and not is_distributed():
+        sys.exit(
+            launch_workers(num_procs, num_nodes, node_rank, master_addr, master_port)
+        )
+    distributed = mode == 'train' and is_distributed()
+    if distributed:
+        rank, world_size = init_distributed('gloo')
+        # same shard order on every rank, each rank then takes its own part of it
+        random.seed(broadcast_object(random.randrange(2**31)))
+    else:
+        rank, world_size = 0, 1
+    if args.manifest_path:
+        manifest = load_manifest(args.manifest_path[0])
+    elif mode == 'train':
+        manifest = find_manifest(train_dir)
+    elif mode == 'test':
+        manifest = find_manifest(test_dir)
+    elif mode == 'online' and args.train_dir:
+        manifest = find_manifest(args.train_dir[0])
+    else:
+        manifest = None
+
+    # distributed and hogwild training share CPU memory
+    if torch.cuda.is_available() and not distributed and hogwild_workers == 0:
         device = 'cuda:0'
     else:
         device = 'cpu'
@@ -337,8 +932,8 @@ if __name__ == '__main__':
     if mode == 'train':
         # load features
         # get the number of files in folder
-        train_num_files = len(os.listdir(train_dir)) // 2
-        val_num_files = len(os.listdir(val_dir)) // 2
+        train_num_files = count_shards(train_dir)
+        val_num_files = count_shards(val_dir)
         # file indices
         train_file_indices = [i for i in range(train_num_files)]
         val_file_indices = [i for i in range(val_num_files)]
@@ -364,70 +959,321 @@ if __name__ == '__main__':
                 os.path.join(val_dir, f'movie_lens_{data_type}_IC_UC_features_test_{i}.npz')
             )
 
-        if model_name == 'DIN':
-            # use the first path to initialize the DIN model
-            sparse_feature_path = train_sparse_feature_paths[0]
-            hist_feature_path = train_hist_feature_paths[0]
-            _, _, feature_columns, behavior_feature_list = process_features(
-                data_type, sparse_feature_path, hist_feature_path, feature_type
-            )
-            model = DIN(
-                dnn_feature_columns=feature_columns,
-                history_feature_list=behavior_feature_list,
-                pooling_type=model_type,
-                device=device,
-                att_weight_normalization=True,
-            )
-        elif model_name == 'DIEN':
-            # use the first path to initialize the DIEN model
-            sparse_feature_path = train_sparse_feature_paths[0]
-            hist_feature_path = train_hist_feature_paths[0]
-            _, _, feature_columns, behavior_feature_list = process_features(
-                data_type, sparse_feature_path, hist_feature_path, feature_type
-            )
-            model = DIEN(
-                dnn_feature_columns=feature_columns,
-                history_feature_list=behavior_feature_list,
-                device=device,
-                att_weight_normalization=True,
-            )
-        elif model_name == 'DIFM':
-            # use the first path to initialize the DIFM model
-            sparse_feature_path = train_sparse_feature_paths[0]
-            hist_feature_path = train_hist_feature_paths[0]
-            _, _, feature_columns, _ = process_features(
-                data_type, sparse_feature_path, hist_feature_path, feature_type
-            )
-            model = DIFM(
-                linear_feature_columns=feature_columns,
-                dnn_feature_columns=feature_columns,
-                device=device,
-            )
+        feature_columns, behavior_feature_list = load_feature_columns(
+            data_type,
+            feature_type,
+            manifest,
+            train_sparse_feature_paths[0],
+            train_hist_feature_paths[0],
+            max_hist_len,
+        )
+        model = build_model(
+            model_name,
+            model_type,
+            feature_columns,
+            behavior_feature_list,
+            device,
+            sparse_embedding,
+            sum_pool_history,
+        )
+        train_model = model
+        if distributed:
+            # some inputs (e.g. the user of the negative side) may not reach the output,
+            # their parameters are then excluded from the gradient all-reduce
+            train_model = DistributedDataParallel(model, find_unused_parameters=True)
+            print(f'Rank {rank}/{world_size} joined the process group')
+        eval_model = model
+        if compile_forward:
+            # compiled on the first batches, the parameters and state dict stay those of model
+            train_model = compile_model(train_model)
+            eval_model = compile_model(model) if distributed else train_model
 
         # define training attributes
-        optimizer = torch.optim.Adagrad(model.parameters(), lr=0.01)
+        optimizer = build_optimizer(
+            model,
+            lr=0.01,
+            sparse_embedding=sparse_embedding,
+            embedding_optimizer=embedding_optimizer,
+        )
         loss_function = F.binary_cross_entropy
         metric_function = roc_auc_score
         print(f'\nModel constructed successfully. Running on {device}')
 
         if continue_training:
-            checkpoint = torch.load(input_model_path)
+            checkpoint = load_checkpoint(input_model_path)
             model.load_state_dict(checkpoint['model_state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
             trained_epoch = int(checkpoint['num_epoch'])
-            history = checkpoint['history']
+            trained_steps = int(checkpoint.get('num_steps', 0))
+            history = defaultdict(list, checkpoint['history'])
+            # validation of the checkpoint epoch that finished after the checkpoint was saved
+            tags = read_checkpoint_tags(input_model_path)
+            if 'val_loss' in tags and len(history['all_val_losses']) < trained_epoch:
+                history['all_val_losses'].append(tags['val_loss'])
+                history['all_val_metrics'].append(tags['val_auc'])
+            # position in epoch trained_epoch of a checkpoint saved every --save_steps steps
+            data_cursor = checkpoint.get('data_cursor')
+            if data_cursor is not None and (distributed or hogwild_workers > 0):
+                raise Exception(
+                    'Mid-epoch checkpoints can not be resumed by hogwild or distributed training'
+                )
         else:
             trained_epoch = 0
+            trained_steps = 0
+            data_cursor = None
             # training loss and validation metric for each epoch
             history = defaultdict(list)
 
+        pooled_history = None
+        if use_pooled_history:
+            # entities of both splits, validation users/movies have their own histories
+            pooled_history = build_pooled_history(
+                model,
+                data_type,
+                feature_type,
+                train_sparse_feature_paths + val_sparse_feature_paths,
+                train_hist_feature_paths + val_hist_feature_paths,
+                manifest,
+                pooled_refresh_steps,
+                device,
+                max_hist_len,
+            )
+
+        if regularization == 'batch_freq':
+            feature_counts = build_feature_counts(
+                model,
+                data_type,
+                feature_type,
+                train_sparse_feature_paths,
+                train_hist_feature_paths,
+                manifest,
+                max_hist_len,
+            )
+            model.set_regularization_mode(regularization, feature_counts)
+        elif regularization != 'none':
+            model.set_regularization_mode(regularization)
+
+        negative_sampler = None
+        if num_negatives > 0:
+            negative_sampler = build_negative_sampler(
+                model,
+                data_type,
+                feature_type,
+                train_sparse_feature_paths,
+                train_hist_feature_paths,
+                manifest,
+                num_negatives,
+                neg_power,
+                max_hist_len,
+            )
+
+        # history inputs of the model, used to bucket and trim the batches by history length
+        hist_feature_columns = [
+            fc for fc in model.dnn_feature_columns if isinstance(fc, VarLenSparseFeat)
+        ]
+
+        def history_length(x):
+            return get_history_length(x, model.feature_index, hist_feature_columns)
+
+        def load_shard(shard):
+            return load_shard_tensors(
+                data_type,
+                shard[1],
+                shard[2],
+                feature_type,
+                model.input_plan,
+                manifest,
+                max_hist_len,
+            )
+
+        shard_cache = None
+        if shard_cache_bytes > 0:
+            # decoded shards are reused by the next epochs, up to the memory budget
+            shard_cache = ShardCache(
+                load_shard,
+                lambda shard: shard_cache_key(shard, feature_type, max_hist_len),
+                shard_cache_bytes,
+            )
+            if pin_val_shards:
+                shard_cache.pin(
+                    zip(val_file_indices, val_sparse_feature_paths, val_hist_feature_paths)
+                )
+            load_shard = shard_cache
+
+        hogwild_trainer = None
+        if hogwild_workers > 0:
+            if pooled_history is not None:
+                raise Exception('Pooled history tables are not supported by hogwild training')
+
+            def iterate_hogwild_batches(shard):
+                return iterate_shard_batches(
+                    [shard],
+                    load_shard,
+                    batch_size,
+                    shuffle=True,
+                    verbose=verbose,
+                    sort_key_fn=history_length if hist_feature_columns else None,
+                    bucket_batches=bucket_batches,
+                )
+
+            def prepare_hogwild_batch(x_train, y_train):
+                if negative_sampler is not None:
+                    x_train, y_train = negative_sampler.sample_batch(x_train, y_train)
+                if trim_history:
+                    x_train = trim_histories(x_train, hist_feature_columns)
+                return x_train, y_train
+
+            def init_hogwild_worker(n):
+                # workers would otherwise draw the same negatives and row orders
+                torch.manual_seed(random.randrange(2**31) + n)
+                if negative_sampler is not None:
+                    negative_sampler.alias_table.rng = np.random.default_rng(
+                        random.randrange(2**31) + n
+                    )
+
+            hogwild_trainer = HogwildTrainer(
+                model,
+                optimizer,
+                iterate_hogwild_batches,
+                loss_function,
+                metric_function,
+                num_workers=hogwild_workers,
+                sync_dense=hogwild_sync_dense,
+                prepare_batch=prepare_hogwild_batch,
+                worker_init=init_hogwild_worker,
+                regularize=regularization != 'none',
+                precision=precision,
+            )
+            print(f'Hogwild training with {hogwild_workers} workers')
+
+        if distributed:
+            # balance the shards of every rank by rows, validation shards get a fixed assignment
+            train_shards = list(
+                zip(train_file_indices, train_sparse_feature_paths, train_hist_feature_paths)
+            )
+            train_num_rows = dict(
+                zip(train_sparse_feature_paths, shard_num_rows(train_shards, manifest))
+            )
+            val_shards = sorted(
+                zip(val_file_indices, val_sparse_feature_paths, val_hist_feature_paths)
+            )
+            val_rank_shards = assign_shards(
+                val_shards, shard_num_rows(val_shards, find_manifest(val_dir)), world_size
+            )[rank]
+
+        # checkpoints are copied to memory and written in the background while training goes on,
+        # delta checkpoints only write the embedding rows changed since the last full one
+        row_tracker = None
+        if delta_checkpoints > 0:
+            row_tracker = EmbeddingRowTracker(model, optimizer)
+        checkpoint_writer = AsyncCheckpointWriter(
+            row_tracker=row_tracker, num_deltas=delta_checkpoints
+        )
+
+        # per batch validation losses and metrics of eval_model on val_shards
+        def validate(eval_model, val_shards, device=device, verbose=True):
+            val_losses, val_metrics = [], []
+            val_batches = iterate_shard_batches(
+                val_shards,
+                load_shard,
+                batch_size,
+                shuffle=False,
+                verbose=verbose,
+                prefetch_depth=prefetch_depth,
+                prefetch_max_bytes=prefetch_max_bytes,
+            )
+            with torch.no_grad():
+                for x_val, y_val in tqdm(
+                    val_batches, desc='Mini batch', disable=rank > 0 or not verbose
+                ):
+                    if trim_history:
+                        x_val = trim_histories(
+                            x_val, hist_feature_columns, round_pow2=compile_forward
+                        )
+                    # send data to training device
+                    x = x_val.to(device)
+                    y = y_val.to(device).float()
+                    if compile_forward:
+                        mark_dynamic_batch(x)
+                    with autocast(precision, device):
+                        y_pred = eval_model(x)
+                    val_batch_loss = loss_function(y_pred.squeeze(), y.squeeze(), reduction='sum')
+                    val_losses.append(val_batch_loss.item())
+                    try:
+                        val_batch_metric = metric_function(
+                            y.cpu().data.numpy(), y_pred.cpu().data.numpy()
+                        )
+                        val_metrics.append(val_batch_metric)
+                    except ValueError:
+                        pass
+            return val_losses, val_metrics
+
+        validator = None
+        if async_validation:
+            # forked before any loader, checkpoint or hogwild thread and process is started,
+            # it validates a CPU copy of the weights while the next epoch trains
+            validator = AsyncValidator(
+                model,
+                lambda val_model, val_shards: validate(val_model, val_shards, 'cpu', False),
+                num_threads=val_threads,
+            )
+            validator.start()
+            torch.set_num_threads(max(1, torch.get_num_threads() - val_threads))
+            print(f'Validation in a separate process with {val_threads} threads')
+        # epoch -> path of its checkpoint, until the validation of the epoch is done
+        unvalidated_checkpoints = {}
+
+        # validation results of the worker, added to the history and to the epoch checkpoint
+        def merge_validation(results):
+            for epoch, (val_losses, val_metrics) in results:
+                val_loss = all_reduce_mean(val_losses)
+                val_metric = all_reduce_mean(val_metrics)
+                history['all_val_losses'].append(val_loss)
+                history['all_val_metrics'].append(val_metric)
+                print(f'\nEpoch {epoch+1} Avg Val Loss: {val_loss}, Avg Val AUC: {val_metric}')
+                if epoch in unvalidated_checkpoints:
+                    tag_checkpoint(
+                        unvalidated_checkpoints.pop(epoch),
+                        {'val_loss': val_loss, 'val_auc': val_metric},
+                    )
+
+        # checkpoint after num_epoch completed epochs and num_steps training steps,
+        # data_cursor: position in the next epoch, for the checkpoints saved every save_steps
+        def training_checkpoint(num_epoch, num_steps, data_cursor=None):
+            if torch.cuda.device_count() > 1:
+                model_state_dict = model.module.state_dict()
+            else:
+                model_state_dict = model.state_dict()
+            model_checkpoint = {
+                'num_epoch': num_epoch,
+                'num_steps': num_steps,
+                'model_state_dict': model_state_dict,
+                'optimizer_state_dict': optimizer.state_dict(),
+                'history': history,
+            }
+            if data_cursor is not None:
+                model_checkpoint['data_cursor'] = data_cursor
+            return model_checkpoint
+
+        num_steps = trained_steps
         # outer loop as epoch
         for e in range(trained_epoch, trained_epoch + num_epoch):
             print(f'\nEpoch {e+1}/{trained_epoch+num_epoch}')
             epoch_start_time = time.time()
-            # for each epoch, re-shuffle data files ordering
-            random.shuffle(train_file_indices)
-            random.shuffle(val_file_indices)
+            resumed = data_cursor is not None and data_cursor['epoch'] == e
+            if resumed:
+                # same file orders and row shuffles as the interrupted epoch
+                train_file_indices = list(data_cursor['train_file_indices'])
+                val_file_indices = list(data_cursor['val_file_indices'])
+                epoch_seed = data_cursor['epoch_seed']
+                shuffle_seed = data_cursor['shuffle_seed']
+            else:
+                # for each epoch, re-shuffle data files ordering
+                random.shuffle(train_file_indices)
+                random.shuffle(val_file_indices)
+                # seeds of the row shuffles of the epoch, so that they can be drawn again
+                epoch_seed = random.randrange(2**31)
+                shuffle_seed = random.randint(0, 2**31 - 1)
             # train feature paths
             train_sparse_feature_paths, train_hist_feature_paths = [], []
             for i in train_file_indices:
@@ -449,185 +1295,236 @@ if __name__ == '__main__':
                     os.path.join(val_dir, f'movie_lens_{data_type}_IC_UC_features_test_{i}.npz')
                 )
 
-            # each batch's loss in this epoch
-            cur_epoch_train_losses = []
-            cur_epoch_train_metrics = []
+            # each batch's loss in this epoch, including those before a mid-epoch checkpoint
+            if resumed:
+                cur_epoch_train_losses = list(data_cursor['train_losses'])
+                cur_epoch_train_metrics = list(data_cursor['train_metrics'])
+            else:
+                cur_epoch_train_losses = []
+                cur_epoch_train_metrics = []
 
             # set model to train
             model.train(True)
+            if pooled_history is not None:
+                pooled_history.refresh(model.embedding_dict)
 
             # start training on all files
-            for n in range(train_num_files):
-                # current data file path
-                sparse_feature_path = train_sparse_feature_paths[n]
-                hist_feature_path = train_hist_feature_paths[n]
-
-                # process features
-                train_input, train_label, _, _ = process_features(
-                    data_type, sparse_feature_path, hist_feature_path, feature_type
-                )
-
-                # process input format, double check on shapes
-                if isinstance(train_input, dict):
-                    train_input = [train_input[feature] for feature in model.feature_index]
-
-                if len(train_input[0]) == 0:
-                    continue
-
-                for i in range(len(train_input)):
-                    if len(train_input[i].shape) == 1:
-                        train_input[i] = np.expand_dims(train_input[i], axis=1)
+            train_shards = list(
+                zip(train_file_indices, train_sparse_feature_paths, train_hist_feature_paths)
+            )
+            if distributed:
+                train_shards = assign_shards(
+                    train_shards, [train_num_rows[shard[1]] for shard in train_shards], world_size
+                )[rank]
 
-                # create training tensors
-                train_data = Data.TensorDataset(
-                    torch.from_numpy(np.concatenate(train_input, axis=-1)),
-                    torch.from_numpy(train_label),
-                )
-                # create dataloader
-                train_loader = DataLoader(dataset=train_data, shuffle=True, batch_size=batch_size)
-                print(
-                    f'Batch {n+1}/{train_num_files}: file {train_file_indices[n]}, {len(train_data)} samples'
+            if hogwild_trainer is not None:
+                # shards are pulled by the workers, which update the shared model
+                cur_epoch_train_losses, cur_epoch_train_metrics = hogwild_trainer.train_epoch(
+                    train_shards
                 )
-                for mini_batch_idx, (x_train, y_train) in tqdm(
-                    enumerate(train_loader), desc='Mini batch'
-                ):
-                    # send data to training device
-                    x = x_train.to(device).float()
-                    y = y_train.to(device).float()
-                    # train model prediction
-                    y_pred = model(x)
-                    # zero grad before back prop
-                    optimizer.zero_grad()
-                    # compute loss and save it
-                    train_batch_loss = loss_function(
-                        y_pred.squeeze(), y.squeeze(), reduction='sum'
+            else:
+                # position right after the last trained batch, saved in mid-epoch checkpoints
+                progress = {'shard': 0, 'batch': 0}
+                if resumed:
+                    progress.update(shard=data_cursor['shard'], batch=data_cursor['batch'])
+                if shuffle_buffer_size > 0:
+                    # batches mixed across several open shards, the batches trained before a
+                    # mid-epoch checkpoint are drawn again and skipped
+                    train_batches = ShuffleBuffer(
+                        train_shards,
+                        load_shard,
+                        batch_size,
+                        buffer_size=shuffle_buffer_size,
+                        num_open_shards=num_open_shards,
+                        seed=shuffle_seed,
+                        prefetch_depth=prefetch_depth,
+                        prefetch_max_bytes=prefetch_max_bytes,
+                        start_batch=progress['batch'],
+                        progress=progress,
                     )
-                    cur_epoch_train_losses.append(train_batch_loss.item())
-                    try:
-                        train_batch_metric = metric_function(
-                            y.cpu().data.numpy(), y_pred.cpu().data.numpy()
-                        )
-                        cur_epoch_train_metrics.append(train_batch_metric)
-                    except ValueError:
-                        pass
-
-                    # backprop and update optimizer
-                    train_batch_loss.backward()
-                    optimizer.step()
-
-            # after training on all the files, compute average loss
-            epoch_avg_train_loss = sum(cur_epoch_train_losses) / len(cur_epoch_train_losses)
-            epoch_avg_train_metric = sum(cur_epoch_train_metrics) / len(cur_epoch_train_metrics)
-            history['all_training_losses'].append(epoch_avg_train_loss)
-            history['all_training_metrics'].append(epoch_avg_train_metric)
-
-            # run validation
-            print('Running Validation')
-            cur_epoch_val_losses = []
-            cur_epoch_val_metrics = []
-            model.train(False)
-            for n in range(val_num_files):
-                # current data file path
-                sparse_feature_path = val_sparse_feature_paths[n]
-                hist_feature_path = val_hist_feature_paths[n]
-
-                val_input, val_label, _, _ = process_features(
-                    data_type, sparse_feature_path, hist_feature_path, feature_type
-                )
-
-                # process input format, double check on shapes
-                if isinstance(val_input, dict):
-                    val_input = [val_input[feature] for feature in model.feature_index]
-
-                if len(val_input[0]) == 0:
-                    continue
-
-                for i in range(len(val_input)):
-                    if len(val_input[i].shape) == 1:
-                        val_input[i] = np.expand_dims(val_input[i], axis=1)
-
-                # create validation tensors
-                val_data = Data.TensorDataset(
-                    torch.from_numpy(np.concatenate(val_input, axis=-1)),
-                    torch.from_numpy(val_label),
-                )
-
-                # create dataloader
-                val_loader = DataLoader(dataset=val_data, shuffle=True, batch_size=batch_size)
-                print(
-                    f'Batch {n+1}/{val_num_files}: file {val_file_indices[n]}, {len(val_data)} samples'
-                )
+                else:
+                    train_batches = iterate_shard_batches(
+                        train_shards,
+                        load_shard,
+                        batch_size,
+                        shuffle=True,
+                        prefetch_depth=prefetch_depth,
+                        prefetch_max_bytes=prefetch_max_bytes,
+                        sort_key_fn=history_length if hist_feature_columns else None,
+                        bucket_batches=bucket_batches,
+                        seed=epoch_seed,
+                        start_shard=progress['shard'],
+                        start_batch=progress['batch'],
+                        progress=progress,
+                    )
+                if resumed:
+                    # dropout, negatives etc. continue from the state after the last trained batch
+                    set_rng_states(data_cursor['rng_states'], negative_sampler)
+                    print(
+                        f'Resuming epoch {e+1} at shard {progress["shard"]+1}, '
+                        f'after batch {progress["batch"]}'
+                    )
+                    data_cursor = None
 
-                with torch.no_grad():
-                    for mini_batch_idx, (x_val, y_val) in tqdm(
-                        enumerate(val_loader), desc='Mini batch'
-                    ):
+                # ranks may run out of batches at different steps, the ones done first keep
+                # taking part in the gradient all-reduce of the others
+                join_ranks = train_model.join() if distributed else nullcontext()
+                with join_ranks:
+                    train_batches = tqdm(train_batches, desc='Mini batch', disable=rank > 0)
+                    for x_train, y_train in train_batches:
+                        # negatives are sampled before trimming, their histories may be longer
+                        if negative_sampler is not None:
+                            x_train, y_train = negative_sampler.sample_batch(x_train, y_train)
+                        if trim_history:
+                            x_train = trim_histories(
+                                x_train, hist_feature_columns, round_pow2=compile_forward
+                            )
                         # send data to training device
-                        x = x_val.to(device).float()
-                        y = y_val.to(device).float()
-                        y_pred = model(x)
-                        val_batch_loss = loss_function(
+                        x = x_train.to(device)
+                        if compile_forward:
+                            mark_dynamic_batch(x)
+                        y = y_train.to(device).float()
+                        # train model prediction, predictions are float32 in any precision
+                        with autocast(precision, device):
+                            y_pred = train_model(x)
+                        # zero grad before back prop
+                        optimizer.zero_grad()
+                        # compute loss and save it
+                        train_batch_loss = loss_function(
                             y_pred.squeeze(), y.squeeze(), reduction='sum'
                         )
-                        cur_epoch_val_losses.append(val_batch_loss.item())
+                        cur_epoch_train_losses.append(train_batch_loss.item())
                         try:
-                            val_batch_metric = metric_function(
+                            train_batch_metric = metric_function(
                                 y.cpu().data.numpy(), y_pred.cpu().data.numpy()
                             )
-                            cur_epoch_val_metrics.append(val_batch_metric)
+                            cur_epoch_train_metrics.append(train_batch_metric)
                         except ValueError:
                             pass
 
-            # after training on all the files, compute average loss
-            epoch_avg_val_loss = sum(cur_epoch_val_losses) / len(cur_epoch_val_losses)
-            epoch_avg_val_metric = sum(cur_epoch_val_metrics) / len(cur_epoch_val_metrics)
-            history['all_val_losses'].append(epoch_avg_val_loss)
-            history['all_val_metrics'].append(epoch_avg_val_metric)
+                        # backprop and update optimizer
+                        if regularization != 'none':
+                            train_batch_loss = train_batch_loss + model.get_regularization_loss(x)
+                        train_batch_loss.backward()
+                        if row_tracker is not None:
+                            row_tracker.update()
+                        optimizer.step()
+                        if pooled_history is not None:
+                            pooled_history.step(model.embedding_dict)
+
+                        num_steps += 1
+                        if validator is not None:
+                            merge_validation(validator.poll())
+                        if save_steps > 0 and num_steps % save_steps == 0:
+                            # everything needed to resume right after this batch
+                            cursor = {
+                                'epoch': e,
+                                'train_file_indices': list(train_file_indices),
+                                'val_file_indices': list(val_file_indices),
+                                'epoch_seed': epoch_seed,
+                                'shuffle_seed': shuffle_seed,
+                                'shard': progress['shard'],
+                                'batch': progress['batch'],
+                                'train_losses': list(cur_epoch_train_losses),
+                                'train_metrics': list(cur_epoch_train_metrics),
+                                'rng_states': get_rng_states(negative_sampler),
+                            }
+                            model_path = os.path.join(
+                                output_model_dir,
+                                f'{model_name}_{model_type}_{feature_type}_{data_type}_{e+1}_'
+                                f'{batch_size}_step_{num_steps}.ckpt',
+                            )
+                            is_delta = checkpoint_writer.save(
+                                training_checkpoint(e, num_steps, cursor), model_path
+                            )
+                            print(
+                                f'\nStep {num_steps} model {"delta " if is_delta else ""}'
+                                f'checkpoint is being saved to {model_path}\n'
+                            )
+
+            # after training on all the files, compute average loss (over all ranks)
+            epoch_avg_train_loss = all_reduce_mean(cur_epoch_train_losses)
+            epoch_avg_train_metric = all_reduce_mean(cur_epoch_train_metrics)
+            history['all_training_losses'].append(epoch_avg_train_loss)
+            history['all_training_metrics'].append(epoch_avg_train_metric)
+
+            if distributed:
+                val_shards = val_rank_shards
+            else:
+                val_shards = list(
+                    zip(val_file_indices, val_sparse_feature_paths, val_hist_feature_paths)
+                )
+            if validator is not None:
+                # the weights are snapshotted and validated while the next epoch trains,
+                # submit first waits for the validation of the previous epoch
+                print('Validation submitted to the validation process')
+                validator.submit(model, val_shards, e)
+                merge_validation(validator.poll())
+            else:
+                # run validation
+                print('Running Validation')
+                model.train(False)
+                if pooled_history is not None:
+                    pooled_history.refresh(model.embedding_dict)
+                cur_epoch_val_losses, cur_epoch_val_metrics = validate(eval_model, val_shards)
+
+                # after training on all the files, compute average loss (over all ranks)
+                epoch_avg_val_loss = all_reduce_mean(cur_epoch_val_losses)
+                epoch_avg_val_metric = all_reduce_mean(cur_epoch_val_metrics)
+                history['all_val_losses'].append(epoch_avg_val_loss)
+                history['all_val_metrics'].append(epoch_avg_val_metric)
             epoch_end_time = time.time()
             epoch_time_cost = epoch_end_time - epoch_start_time
+            if shard_cache is not None:
+                print(
+                    f'Shard cache: {len(shard_cache)} shards, {shard_cache.nbytes / 2**20:.1f} MB, '
+                    f'{shard_cache.num_hits} hits, {shard_cache.num_misses} misses'
+                )
             print(f'Epoch {e+1}/{num_epoch} Completed. Took {epoch_time_cost} seconds')
             print(
                 f'Avg Train Loss: {epoch_avg_train_loss}, Avg Train AUC: {epoch_avg_train_metric}'
             )
-            print(f'Avg Val Loss: {epoch_avg_val_loss}, Avg Val AUC: {epoch_avg_val_metric}')
+            if validator is None:
+                print(f'Avg Val Loss: {epoch_avg_val_loss}, Avg Val AUC: {epoch_avg_val_metric}')
 
-            # save trained model every save_freq epoch
-            if (e + 1) % save_freq == 0:
+            # save trained model every save_freq epoch, replicas are identical so only rank 0 saves
+            if (e + 1) % save_freq == 0 and rank == 0:
                 model_path = os.path.join(
                     output_model_dir,
-                    f'{model_name}_{model_type}_{feature_type}_{data_type}_{e+1}_{batch_size}.pt',
+                    f'{model_name}_{model_type}_{feature_type}_{data_type}_{e+1}_{batch_size}.ckpt',
+                )
+                is_delta = checkpoint_writer.save(training_checkpoint(e + 1, num_steps), model_path)
+                if validator is not None:
+                    # tagged with the validation results of the epoch once they arrive
+                    unvalidated_checkpoints[e] = model_path
+                print(
+                    f'\nTrained model {"delta " if is_delta else ""}checkpoint is being saved '
+                    f'to {model_path}\n'
                 )
-                if torch.cuda.device_count() > 1:
-                    model_checkpoint = {
-                        'num_epoch': e + 1,
-                        'model_state_dict': model.module.state_dict(),
-                        'optimizer_state_dict': optimizer.state_dict(),
-                        'history': history,
-                    }
-                else:
-                    model_checkpoint = {
-                        'num_epoch': e + 1,
-                        'model_state_dict': model.state_dict(),
-                        'optimizer_state_dict': optimizer.state_dict(),
-                        'history': history,
-                    }
 
-                torch.save(model_checkpoint, model_path)
-                print(f'\nTrained model checkpoint has been saved to {model_path}\n')
+        if validator is not None:
+            merge_validation(validator.wait())
+            validator.close()
+        if hogwild_trainer is not None:
+            hogwild_trainer.close()
+        checkpoint_writer.close()
 
         # save the history by pandas
-        history_df = pd.DataFrame(history)
-        hist_csv_path = os.path.join(
-            output_hist_dir,
-            f'hist_{model_name}_{model_type}_{feature_type}_{data_type}_{trained_epoch+num_epoch}_{batch_size}.csv',
-        )
-        history_df.to_csv(hist_csv_path)
-        print(f'\nAssociated model history has been saved to {hist_csv_path}\n')
+        if rank == 0:
+            history_df = pd.DataFrame(history)
+            hist_csv_path = os.path.join(
+                output_hist_dir,
+                f'hist_{model_name}_{model_type}_{feature_type}_{data_type}_{trained_epoch+num_epoch}_{batch_size}.csv',
+            )
+            history_df.to_csv(hist_csv_path)
+            print(f'\nAssociated model history has been saved to {hist_csv_path}\n')
+        if distributed:
+            cleanup_distributed()
 
     elif mode == 'test':
         # load features
         # get the number of files in folder
-        test_num_files = len(os.listdir(test_dir)) // 2
+        test_num_files = count_shards(test_dir)
         # file indices
         test_file_indices = [i for i in range(test_num_files)]
         # shuffle both indices
@@ -636,113 +1533,236 @@ if __name__ == '__main__':
         test_sparse_feature_paths, test_hist_feature_paths = [], []
         for i in test_file_indices:
             test_sparse_feature_paths.append(
-                os.path.join(train_dir, f'movie_lens_{data_type}_sparse_features_test_{i}.csv')
+                os.path.join(test_dir, f'movie_lens_{data_type}_sparse_features_test_{i}.csv')
             )
             test_hist_feature_paths.append(
-                os.path.join(train_dir, f'movie_lens_{data_type}_IC_UC_features_test_{i}.npz')
+                os.path.join(test_dir, f'movie_lens_{data_type}_IC_UC_features_test_{i}.npz')
             )
 
-        if model_name == 'DIN':
-            # use the first path to initialize the DIN model
-            sparse_feature_path = test_sparse_feature_paths[0]
-            hist_feature_path = test_hist_feature_paths[0]
-            _, _, feature_columns, behavior_feature_list = process_features(
-                data_type, sparse_feature_path, hist_feature_path, feature_type
-            )
-            model = DIN(
-                dnn_feature_columns=feature_columns,
-                history_feature_list=behavior_feature_list,
-                pooling_type=model_type,
-                device=device,
-                att_weight_normalization=True,
-            )
-        elif model_name == 'DIEN':
-            # use the first path to initialize the DIEN model
-            sparse_feature_path = test_sparse_feature_paths[0]
-            hist_feature_path = test_hist_feature_paths[0]
-            _, _, feature_columns, behavior_feature_list = process_features(
-                data_type, sparse_feature_path, hist_feature_path, feature_type
-            )
-            model = DIEN(
-                dnn_feature_columns=feature_columns,
-                history_feature_list=behavior_feature_list,
-                device=device,
-                att_weight_normalization=True,
-            )
-        elif model_name == 'DIFM':
-            # use the first path to initialize the DIFM model
-            sparse_feature_path = test_sparse_feature_paths[0]
-            hist_feature_path = test_sparse_feature_paths[0]
-            _, _, feature_columns, _ = process_features(
-                data_type, sparse_feature_path, hist_feature_path, feature_type
-            )
-            model = DIFM(
-                linear_feature_columns=feature_columns,
-                dnn_feature_columns=feature_columns,
-                device=device,
-            )
+        feature_columns, behavior_feature_list = load_feature_columns(
+            data_type,
+            feature_type,
+            manifest,
+            test_sparse_feature_paths[0],
+            test_hist_feature_paths[0],
+            max_hist_len,
+        )
+        model = build_model(
+            model_name,
+            model_type,
+            feature_columns,
+            behavior_feature_list,
+            device,
+            sum_pool_history=sum_pool_history,
+        )
 
         # define training attributes
         loss_function = F.binary_cross_entropy
         metric_function = roc_auc_score
         # load trained model
-        checkpoint = torch.load(input_model_path)
+        checkpoint = load_checkpoint(input_model_path)
         model.load_state_dict(checkpoint['model_state_dict'])
         print(f'\nModel constructed successfully. Running on {device}')
 
+        if use_pooled_history:
+            pooled_history = build_pooled_history(
+                model,
+                data_type,
+                feature_type,
+                test_sparse_feature_paths,
+                test_hist_feature_paths,
+                manifest,
+                0,
+                device,
+                max_hist_len,
+            )
+            pooled_history.refresh(model.embedding_dict)
+
         test_losses = []
         test_metrics = []
         model.train(False)
-        for n in range(test_num_files):
-            # current data file path
-            sparse_feature_path = test_sparse_feature_paths[n]
-            hist_feature_path = test_hist_feature_paths[n]
+        test_model = compile_model(model) if compile_forward else model
+        test_shards = list(
+            zip(test_file_indices, test_sparse_feature_paths, test_hist_feature_paths)
+        )
 
-            test_input, test_label, _, _ = process_features(
-                data_type, sparse_feature_path, hist_feature_path, feature_type
+        def load_shard(shard):
+            return load_shard_tensors(
+                data_type,
+                shard[1],
+                shard[2],
+                feature_type,
+                model.input_plan,
+                manifest,
+                max_hist_len,
             )
 
-            # process input format, double check on shapes
-            if isinstance(test_input, dict):
-                test_input = [test_input[feature] for feature in model.feature_index]
+        hist_feature_columns = [
+            fc for fc in model.dnn_feature_columns if isinstance(fc, VarLenSparseFeat)
+        ]
+        test_batches = iterate_shard_batches(
+            test_shards,
+            load_shard,
+            batch_size,
+            shuffle=False,
+            prefetch_depth=prefetch_depth,
+            prefetch_max_bytes=prefetch_max_bytes,
+        )
+        with torch.no_grad():
+            for x_test, y_test in tqdm(test_batches, desc='Mini batch'):
+                if trim_history:
+                    x_test = trim_histories(x_test, hist_feature_columns, round_pow2=compile_forward)
+                # send data to training device
+                x = x_test.to(device)
+                y = y_test.to(device).float()
+                if compile_forward:
+                    mark_dynamic_batch(x)
+                with autocast(precision, device):
+                    y_pred = test_model(x)
+                test_batch_loss = loss_function(y_pred.squeeze(), y.squeeze(), reduction='sum')
+                test_losses.append(test_batch_loss.item())
+                test_batch_metric = metric_function(
+                    y.cpu().data.numpy(), y_pred.cpu().data.numpy()
+                )
+                test_metrics.append(test_batch_metric)
+
+        # after training on all the files, compute average loss
+        avg_test_loss = sum(test_losses) / len(test_losses)
+        avg_test_metric = sum(test_metrics) / len(test_metrics)
+        print(f'Avg Test Loss: {avg_test_loss}, Avg Test AUC: {avg_test_metric}')
+
+    elif mode == 'online':
+        # vocab sizes and history lengths can not be derived from a stream
+        if manifest is None:
+            raise Exception(
+                'Online mode requires a dataset manifest (--manifest_path or --train_dir)'
+            )
+        if data_type == '1M':
+            raise Exception(
+                'Online mode does not support 1M, user attributes are not in the ratings log'
+            )
 
-            if len(test_input[0]) == 0:
-                continue
+        feature_columns, behavior_feature_list = get_feature_columns_from_manifest(
+            data_type, feature_type, manifest, max_hist_len
+        )
+        model = build_model(
+            model_name,
+            model_type,
+            feature_columns,
+            behavior_feature_list,
+            device,
+            sparse_embedding,
+            sum_pool_history,
+        )
+        optimizer = build_optimizer(
+            model,
+            lr=0.01,
+            sparse_embedding=sparse_embedding,
+            embedding_optimizer=embedding_optimizer,
+        )
+        loss_function = F.binary_cross_entropy
+        metric_function = roc_auc_score
+        print(f'\nModel constructed successfully. Running on {device}')
 
-            for i in range(len(test_input)):
-                if len(test_input[i].shape) == 1:
-                    test_input[i] = np.expand_dims(test_input[i], axis=1)
+        # usually warm started from a model trained offline
+        if continue_training:
+            checkpoint = load_checkpoint(input_model_path)
+            model.load_state_dict(checkpoint['model_state_dict'])
+            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            trained_epoch = int(checkpoint['num_epoch'])
+            trained_steps = int(checkpoint.get('num_steps', 0))
+            history = defaultdict(list, checkpoint['history'])
+        else:
+            trained_epoch = 0
+            trained_steps = 0
+            history = defaultdict(list)
 
-            # create validation tensors
-            test_data = Data.TensorDataset(
-                torch.from_numpy(np.concatenate(test_input, axis=-1)), torch.from_numpy(test_label)
+        # model inputs fed by each history array of the selected feature type
+        hist_columns = {
+            f'hist_{behavior}': (hist_key, length_name)
+            for behavior, (hist_key, length_name) in zip(
+                behavior_feature_list, HIST_FEATURE_KEYS[feature_type]
+            )
+        }
+        vocabulary_size = {feat.name: feat.vocabulary_size for feat in feature_columns}
+        hist_maxlen = max(
+            model.feature_index[name][1] - model.feature_index[name][0] for name in hist_columns
+        )
+        if history_snapshot_dir is not None and os.path.exists(
+            os.path.join(history_snapshot_dir, STORE_META_NAME)
+        ):
+            # histories are appended to copy-on-write mappings of the snapshot files
+            online_history = RingBufferHistoryStore.restore(history_snapshot_dir)
+            print(f'History store restored from {history_snapshot_dir}')
+        else:
+            online_history = RingBufferHistoryStore(
+                vocabulary_size['positive_user_id'],
+                vocabulary_size['positive_movie_id'],
+                hist_maxlen,
             )
+        print(f'History store takes {online_history.nbytes() / 2**20:.1f} MB')
 
-            # create dataloader
-            test_loader = DataLoader(dataset=test_data, shuffle=True, batch_size=batch_size)
+        row_tracker = None
+        if delta_checkpoints > 0:
+            row_tracker = EmbeddingRowTracker(model, optimizer)
+        checkpoint_writer = AsyncCheckpointWriter(
+            row_tracker=row_tracker, num_deltas=delta_checkpoints
+        )
+
+        def save_online_checkpoint(num_steps, train_history):
+            model_path = os.path.join(
+                output_model_dir,
+                f'{model_name}_{model_type}_{feature_type}_{data_type}_online_{num_steps}_{batch_size}.ckpt',
+            )
+            model_checkpoint = {
+                'num_epoch': trained_epoch,
+                'num_steps': num_steps,
+                'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'history': dict(train_history),
+            }
+            is_delta = checkpoint_writer.save(model_checkpoint, model_path)
             print(
-                f'Batch {n+1}/{test_num_files}: file {test_file_indices[n]}, {len(test_data)} samples'
+                f'\nOnline model {"delta " if is_delta else ""}checkpoint is being saved '
+                f'to {model_path}\n'
             )
+            if history_snapshot_dir is not None:
+                online_history.snapshot(history_snapshot_dir)
 
-            with torch.no_grad():
-                for mini_batch_idx, (x_test, y_test) in tqdm(
-                    enumerate(test_loader), desc='Mini batch'
-                ):
-                    # send data to training device
-                    x = x_test.to(device).float()
-                    y = y_test.to(device).float()
-                    y_pred = model(x)
-                    test_batch_loss = loss_function(y_pred.squeeze(), y.squeeze(), reduction='sum')
-                    test_losses.append(test_batch_loss.item())
-                    test_batch_metric = metric_function(
-                        y.cpu().data.numpy(), y_pred.cpu().data.numpy()
-                    )
-                    test_metrics.append(test_batch_metric)
+        print(f'Following ratings log {ratings_log_path}')
+        num_steps, history = train_online(
+            model,
+            optimizer,
+            loss_function,
+            RatingLog(ratings_log_path, from_start=args.from_start),
+            online_history,
+            hist_columns,
+            batch_size,
+            device,
+            metric_function=metric_function,
+            max_batch_wait=max_batch_wait,
+            checkpoint_fn=save_online_checkpoint,
+            checkpoint_steps=checkpoint_steps,
+            max_steps=max_steps,
+            num_steps=trained_steps,
+            train_history=history,
+            verbose=verbose,
+            precision=precision,
+            row_tracker=row_tracker,
+        )
+        checkpoint_writer.close()
 
-        # after training on all the files, compute average loss
-        avg_test_loss = sum(test_losses) / len(test_losses)
-        avg_test_metric = sum(test_metrics) / len(test_metrics)
-        print(f'Avg Test Loss: {avg_test_loss}, Avg Test AUC: {avg_test_metric}')
+        # save the online history by pandas, one row per checkpoint interval
+        online_keys = ['online_steps', 'online_losses', 'online_metrics']
+        history_df = pd.DataFrame(
+            {key: pd.Series(history[key], dtype=float) for key in online_keys if key in history}
+        )
+        hist_csv_path = os.path.join(
+            output_hist_dir,
+            f'hist_{model_name}_{model_type}_{feature_type}_{data_type}_online_{num_steps}_{batch_size}.csv',
+        )
+        history_df.to_csv(hist_csv_path)
+        print(f'\nAssociated online history has been saved to {hist_csv_path}\n')
 
     else:
         raise Exception(f'Unrecognized mode {mode}')
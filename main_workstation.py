@@ -2,11 +2,13 @@
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 import argparse
+import zipfile
 import torch
 import random
 import numpy as np
 import pandas as pd
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 # from deepctr_torch.inputs import (DenseFeat, SparseFeat, VarLenSparseFeat,
 #                                   get_feature_names)
 # from deepctr_torch.models.din import DIN
@@ -14,11 +16,90 @@ from sklearn.metrics import roc_auc_score
 from inputs import (DenseFeat, SparseFeat, VarLenSparseFeat,
                                   get_feature_names)
 from din import DIN
+from manifest import find_manifest
 
 random.seed(10)
 np.random.seed(10)
 
 
+# shape and dtype of every array of a npz file, read from the npy headers without loading data
+def read_npz_headers(npz_path):
+    headers = {}
+    with zipfile.ZipFile(npz_path) as archive:
+        for member in archive.namelist():
+            with archive.open(member) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+            headers[member[: -len('.npy')]] = (shape, dtype)
+    return headers
+
+
+# load several shards into arrays allocated once with the final size
+# the work is O(total rows) and only one copy of the data is alive
+def load_shards(
+    sparse_feature_paths,
+    hist_feature_paths,
+    sparse_columns,
+    hist_keys,
+    manifest=None,
+    num_workers=4,
+):
+    # row counts, from the manifest or from the npy headers
+    num_rows = []
+    for sparse_feature_path, hist_feature_path in zip(sparse_feature_paths, hist_feature_paths):
+        shard_name = os.path.basename(sparse_feature_path)
+        if manifest is not None and shard_name in manifest['shards']:
+            num_rows.append(manifest['shards'][shard_name]['num_rows'])
+        else:
+            num_rows.append(read_npz_headers(hist_feature_path)[hist_keys[0]][0][0])
+    offsets = np.concatenate([[0], np.cumsum(num_rows)]).astype(int)
+    total_rows = int(offsets[-1])
+
+    def read_shard(i):
+        cur_sparse_features = pd.read_csv(
+            sparse_feature_paths[i],
+            header='infer',
+            usecols=sparse_columns,
+        )
+        cur_hist_features = np.load(hist_feature_paths[i], allow_pickle=True)
+        if len(cur_sparse_features) != num_rows[i]:
+            raise Exception(
+                f'{sparse_feature_paths[i]} has {len(cur_sparse_features)} rows, expected {num_rows[i]}'
+            )
+        return cur_sparse_features, cur_hist_features
+
+    # the first shard gives the column dtypes and history widths
+    first_sparse_features, first_hist_features = read_shard(0)
+    sparse_features = {
+        column: np.empty(total_rows, dtype=first_sparse_features[column].dtype)
+        for column in sparse_columns
+    }
+    hist_features = {
+        key: np.empty((total_rows,) + first_hist_features[key].shape[1:], dtype=int)
+        for key in hist_keys
+    }
+
+    def fill_shard(i, cur_sparse_features=None, cur_hist_features=None):
+        if cur_sparse_features is None:
+            cur_sparse_features, cur_hist_features = read_shard(i)
+        start, end = offsets[i], offsets[i + 1]
+        for column in sparse_columns:
+            sparse_features[column][start:end] = cur_sparse_features[column].to_numpy()
+        for key in hist_keys:
+            hist_features[key][start:end] = cur_hist_features[key]
+
+    fill_shard(0, first_sparse_features, first_hist_features)
+    del first_sparse_features, first_hist_features
+    # every shard writes its own disjoint slice
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(fill_shard, range(1, len(sparse_feature_paths))))
+
+    return sparse_features, hist_features
+
+
 # process features into format for DIN
 def process_features_din(
     mode,
@@ -29,47 +110,31 @@ def process_features_din(
     hist_feature_type,
     split=0.2,
     verbose=False,
+    manifest=None,
+    num_workers=4,
 ):
     # loading multiple files
     if type(sparse_feature_path) == list:
-        for i in range(len(sparse_feature_path)):
-
-            cur_sparse_feature_path = sparse_feature_path[i]
-            cur_hist_feature_path = hist_feature_path[i]
+        sparse_columns = ['user_id', 'movie_id', 'rating', 'labels']
+        if data_type == '1M':
+            sparse_columns += ['gender', 'age', 'occupation']
+        if hist_feature_type == 'IC':
+            hist_keys = ['positive_ic_feature', 'positive_ic_feature_length',
+                         'negative_ic_feature', 'negative_ic_feature_length']
+        elif hist_feature_type == 'UC':
+            hist_keys = ['positive_uc_feature', 'positive_uc_feature_length',
+                         'negative_uc_feature', 'negative_uc_feature_length']
+        else:
+            raise Exception(f'Unrecognized feature type {hist_feature_type}')
 
-            # loaded features keys can be found in process_data.py
-            cur_sparse_features = pd.read_csv(
-                cur_sparse_feature_path,
-                engine='python',
-                header='infer',
-            )
-            # IC/UC features
-            cur_hist_features = np.load(cur_hist_feature_path, allow_pickle=True)
-
-            # if first path
-            if i == 0:
-                sparse_features = cur_sparse_features
-                hist_features = {}
-                for array_name in cur_hist_features.files:
-                    hist_features[array_name] = cur_hist_features[array_name]
-            else:
-                # concatenate
-                sparse_features = pd.concat(
-                    objs=[sparse_features, cur_sparse_features],
-                    axis=0,
-                    join="outer", # outer for union
-                    ignore_index=False,
-                    keys=None,
-                    levels=None,
-                    names=None,
-                    verify_integrity=False,
-                    copy=True,
-                )
-
-                for array_name in hist_features.keys():
-                    hist_features[array_name] = np.concatenate(
-                        (hist_features[array_name], cur_hist_features[array_name])
-                    )
+        sparse_features, hist_features = load_shards(
+            sparse_feature_path,
+            hist_feature_path,
+            sparse_columns,
+            hist_keys,
+            manifest=manifest,
+            num_workers=num_workers,
+        )
 
     else:
         # loaded features keys can be found in process_data.py
@@ -82,29 +147,29 @@ def process_features_din(
         hist_features = np.load(hist_feature_path, allow_pickle=True)
 
     # users
-    user_id = sparse_features['user_id'].to_numpy()
+    user_id = np.asarray(sparse_features['user_id'])
     if data_type == '1M':
-        gender = sparse_features['gender'].to_numpy()
-        age = sparse_features['age'].to_numpy()
-        occupation = sparse_features['occupation'].to_numpy()
+        gender = np.asarray(sparse_features['gender'])
+        age = np.asarray(sparse_features['age'])
+        occupation = np.asarray(sparse_features['occupation'])
 
     # movies
-    movie_id = sparse_features['movie_id'].to_numpy()  # 0 is mask value
-    score = sparse_features['rating'].to_numpy()
+    movie_id = np.asarray(sparse_features['movie_id'])  # 0 is mask value
+    score = np.asarray(sparse_features['rating'])
     # movie_name = sparse_features['movie_name'].to_numpy()
     # genre = sparse_features['genre'].to_numpy()
 
     # ic/uc features
     if hist_feature_type == 'IC':
-        positive_behavior_feature = hist_features['positive_ic_feature'].astype(int)
-        positive_behavior_length = hist_features['positive_ic_feature_length'].astype(int)
-        negative_behavior_feature = hist_features['negative_ic_feature'].astype(int)
-        negative_behavior_length = hist_features['negative_ic_feature_length'].astype(int)
+        positive_behavior_feature = hist_features['positive_ic_feature'].astype(int, copy=False)
+        positive_behavior_length = hist_features['positive_ic_feature_length'].astype(int, copy=False)
+        negative_behavior_feature = hist_features['negative_ic_feature'].astype(int, copy=False)
+        negative_behavior_length = hist_features['negative_ic_feature_length'].astype(int, copy=False)
     elif hist_feature_type == 'UC':
-        positive_behavior_feature = hist_features['positive_uc_feature'].astype(int)
-        positive_behavior_length = hist_features['positive_uc_feature_length'].astype(int)
-        negative_behavior_feature = hist_features['negative_uc_feature'].astype(int)
-        negative_behavior_length = hist_features['negative_uc_feature_length'].astype(int)
+        positive_behavior_feature = hist_features['positive_uc_feature'].astype(int, copy=False)
+        positive_behavior_length = hist_features['positive_uc_feature_length'].astype(int, copy=False)
+        negative_behavior_feature = hist_features['negative_uc_feature'].astype(int, copy=False)
+        negative_behavior_length = hist_features['negative_uc_feature_length'].astype(int, copy=False)
     else:
         raise Exception(f'Unrecognized feature type {hist_feature_type}')
 
@@ -112,13 +177,13 @@ def process_features_din(
         raise Exception("History data length not matched")
 
     # Make sure that the sparse and IC/UC features should have the same length
-    if len(sparse_features) != len(positive_behavior_feature):
+    if len(user_id) != len(positive_behavior_feature):
         raise Exception(
-            f"Sparse ({len(sparse_features)}) and IC/UC ({len(positive_behavior_feature)}) features should have the same length"
+            f"Sparse ({len(user_id)}) and IC/UC ({len(positive_behavior_feature)}) features should have the same length"
         )
 
     # labels
-    labels = sparse_features['labels'].to_numpy()
+    labels = np.asarray(sparse_features['labels'])
 
     # DNN feature columns for the deep part of DIN
     # duplicate user_id and movie_id for both positive and negative
@@ -309,6 +374,10 @@ if __name__ == "__main__":
     parser.add_argument(
         '--batch_size', action='store', nargs=1, dest='batch_size'
     )
+    # number of threads loading the feature files
+    parser.add_argument(
+        '--num_workers', action='store', nargs=1, dest='num_workers'
+    )
     parser.add_argument(
         '-v', '--verbose', action='store_true', dest='verbose', default=False
     )
@@ -331,7 +400,13 @@ if __name__ == "__main__":
         batch_size = int(args.batch_size[0])
     else:
         batch_size = 256
+    if args.num_workers:
+        num_workers = int(args.num_workers[0])
+    else:
+        num_workers = 4
     verbose = args.verbose
+    # row counts of the feature files, if process_data.py wrote a manifest
+    manifest = find_manifest(feature_dir)
 
     if torch.cuda.is_available():
         device = 'cuda:0'
@@ -364,7 +439,8 @@ if __name__ == "__main__":
         val_label, \
         feature_columns, \
         behavior_feature_list = process_features_din(
-            mode, data_type, feature_type, sparse_feature_path, hist_feature_path, feature_type
+            mode, data_type, feature_type, sparse_feature_path, hist_feature_path, feature_type,
+            manifest=manifest, num_workers=num_workers,
         )
 
         # model
@@ -428,7 +504,8 @@ if __name__ == "__main__":
         test_label, \
         feature_columns, \
         behavior_feature_list = process_features_din(
-            mode, data_type, feature_type, sparse_feature_path, hist_feature_path, feature_type
+            mode, data_type, feature_type, sparse_feature_path, hist_feature_path, feature_type,
+            manifest=manifest, num_workers=num_workers,
         )
         # model
         model = DIN(
@@ -0,0 +1,182 @@
+# Dataset statistics manifest kept next to the generated/splitted feature shards.
+# It records global vocab sizes, history length distributions, per-shard row counts
+# and label balance, so that models can be constructed without parsing any shard
+import os
+import json
+import fcntl
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+
+# sparse columns whose vocabulary size is derived from the largest id (0 is mask value)
+VOCAB_COLUMNS = ['user_id', 'movie_id', 'gender', 'age', 'occupation']
+
+# history length arrays saved in the IC/UC npz files, see process_data.py
+HIST_LENGTH_KEYS = [
+    'positive_ic_feature_length',
+    'negative_ic_feature_length',
+    'positive_uc_feature_length',
+    'negative_uc_feature_length',
+]
+
+HIST_PERCENTILES = [50, 90, 95, 99]
+
+
+def get_manifest_path(data_dir):
+    return os.path.join(data_dir, MANIFEST_NAME)
+
+
+def empty_manifest(data_type, feature_length):
+    return {
+        'data_type': data_type,
+        'feature_length': int(feature_length),
+        # vocab sizes seeded from the whole dataset (before splitting), if any
+        'global_vocab': {},
+        'vocab': {},
+        'history': {},
+        'labels': {},
+        'shards': {},
+    }
+
+
+# compute the statistics of one shard from its in-memory columns
+def shard_stats(sparse_features, hist_features, feature_length, hist_file_name=None):
+    labels = np.asarray(sparse_features['labels'])
+    stats = {
+        'hist_file': hist_file_name,
+        'num_rows': int(len(sparse_features)),
+        'num_positive': int(np.sum(labels >= 1)),
+        'max_id': {},
+        'length_histogram': {},
+    }
+    for column in VOCAB_COLUMNS:
+        if column not in sparse_features:
+            continue
+        values = np.asarray(sparse_features[column])
+        if len(values) and np.issubdtype(values.dtype, np.number):
+            stats['max_id'][column] = int(values.max())
+
+    for key in HIST_LENGTH_KEYS:
+        if key not in hist_features:
+            continue
+        lengths = np.asarray(hist_features[key]).astype(int)
+        stats['length_histogram'][key] = np.bincount(
+            lengths, minlength=feature_length + 1
+        ).tolist()
+
+    return stats
+
+
+# percentiles (and max) of a length distribution given as a histogram
+def _histogram_summary(histogram):
+    histogram = np.asarray(histogram, dtype=np.int64)
+    total = int(histogram.sum())
+    if total == 0:
+        summary = {'max': 0, 'mean': 0.0}
+        summary.update({f'p{q}': 0 for q in HIST_PERCENTILES})
+        return summary
+
+    nonzero = np.flatnonzero(histogram)
+    cumulative = np.cumsum(histogram)
+    summary = {
+        'max': int(nonzero[-1]),
+        'mean': float(np.dot(np.arange(len(histogram)), histogram) / total),
+    }
+    for q in HIST_PERCENTILES:
+        summary[f'p{q}'] = int(np.searchsorted(cumulative, np.ceil(total * q / 100)))
+
+    return summary
+
+
+# recompute the aggregated sections from the per-shard entries
+def _aggregate(manifest):
+    vocab = dict(manifest['global_vocab'])
+    histograms = {}
+    num_rows, num_positive = 0, 0
+    for stats in manifest['shards'].values():
+        num_rows += stats['num_rows']
+        num_positive += stats['num_positive']
+        for column, max_id in stats['max_id'].items():
+            vocab[column] = max(vocab.get(column, 0), max_id + 1)
+        for key, histogram in stats['length_histogram'].items():
+            histogram = np.asarray(histogram, dtype=np.int64)
+            if key in histograms:
+                size = max(len(histograms[key]), len(histogram))
+                histograms[key] = np.pad(histograms[key], (0, size - len(histograms[key]))) \
+                                + np.pad(histogram, (0, size - len(histogram)))
+            else:
+                histograms[key] = histogram
+
+    manifest['vocab'] = vocab
+    manifest['history'] = {key: _histogram_summary(h) for key, h in histograms.items()}
+    manifest['labels'] = {
+        'num_rows': num_rows,
+        'num_positive': num_positive,
+        'positive_rate': num_positive / num_rows if num_rows else 0.0,
+    }
+
+    return manifest
+
+
+def _write_manifest(manifest_path, manifest):
+    temp_path = f'{manifest_path}.tmp.{os.getpid()}'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+# add (or replace) the entry of a shard, safe with concurrent writer processes
+def update_manifest(
+    data_dir,
+    shard_name,
+    stats,
+    data_type,
+    feature_length,
+    global_vocab=None,
+):
+    manifest_path = get_manifest_path(data_dir)
+    with open(f'{manifest_path}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(manifest_path):
+                manifest = load_manifest(manifest_path)
+            else:
+                manifest = empty_manifest(data_type, feature_length)
+
+            if global_vocab is not None:
+                for column, size in global_vocab.items():
+                    manifest['global_vocab'][column] = max(
+                        manifest['global_vocab'].get(column, 0), int(size)
+                    )
+            if shard_name is not None:
+                manifest['shards'][shard_name] = stats
+
+            manifest = _aggregate(manifest)
+            _write_manifest(manifest_path, manifest)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return manifest
+
+
+# remove the manifest of a directory before its shards are regenerated
+def reset_manifest(data_dir):
+    manifest_path = get_manifest_path(data_dir)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+        print(f'\nRemoved previously generated manifest {manifest_path}')
+
+
+# accept either the manifest file itself or the directory that contains it
+def load_manifest(path):
+    if os.path.isdir(path):
+        path = get_manifest_path(path)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def find_manifest(data_dir):
+    manifest_path = get_manifest_path(data_dir)
+    if os.path.exists(manifest_path):
+        return load_manifest(manifest_path)
+    return None
@@ -0,0 +1,148 @@
+# On-the-fly negative sampling: negative movies are drawn at batch time from a
+# popularity-smoothed distribution, so negative volume grows without growing the shards
+import numpy as np
+import torch
+
+from inputs import concat_inputs, get_input
+
+
+class AliasTable(object):
+    """Walker's alias method, O(n) construction and O(1) per draw.
+    :param weights: 1D array of non-negative (unnormalized) weights.
+    :param seed: integer ,to use as random seed.
+    """
+
+    def __init__(self, weights, seed=None):
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.ndim != 1 or len(weights) == 0 or np.any(weights < 0) or weights.sum() <= 0:
+            raise ValueError('weights should be a non-empty 1D array with a positive sum')
+
+        num_outcomes = len(weights)
+        scaled = weights * num_outcomes / weights.sum()
+        self.prob = np.ones(num_outcomes, dtype=np.float64)
+        self.alias = np.arange(num_outcomes, dtype=np.int64)
+
+        small = [i for i in range(num_outcomes) if scaled[i] < 1.0]
+        large = [i for i in range(num_outcomes) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # leftovers are 1 up to rounding errors
+        for i in small + large:
+            self.prob[i] = 1.0
+
+        self.rng = np.random.default_rng(seed)
+
+    def sample(self, size):
+        bins = self.rng.integers(0, len(self.prob), size=size)
+        coins = self.rng.random(size=size)
+        return np.where(coins < self.prob[bins], bins, self.alias[bins])
+
+
+class NegativeSampler(object):
+    """Appends ``num_negatives`` sampled negative movies to every positive example of a batch.
+    The user side of the positive example is kept, while the candidate side (movie ids and the
+    movie's UC histories) is filled in from a per-movie EntityHistoryTable.
+    :param movie_table: EntityHistoryTable keyed by movie id, holding the candidate-side history columns.
+    :param movie_counts: 1D array, number of ratings of every movie id.
+    :param feature_index: OrderedDict, {feature_name:(start, start+dimension)} of the model input.
+    :param num_negatives: int, number of negatives drawn per positive.
+    :param power: float, popularity smoothing exponent, counts are raised to this power.
+    :param movie_columns: list, input columns holding the candidate movie id.
+    :param score_name: str or None, dense rating column. Labels are derived from the rating
+        (positive from 4 on), so every sampled negative gets a rating drawn from the ratings of
+        the negative (label 0) examples.
+    :param score_values: 1D array, ratings of the negative examples, required with score_name.
+    :param score_counts: 1D array, number of negative examples of every rating of score_values.
+    :param seed: integer ,to use as random seed.
+    """
+
+    def __init__(
+        self,
+        movie_table,
+        movie_counts,
+        feature_index,
+        num_negatives=1,
+        power=0.75,
+        movie_columns=('positive_movie_id', 'negative_movie_id'),
+        score_name='score',
+        score_values=None,
+        score_counts=None,
+        seed=1024,
+    ):
+        self.movie_table = movie_table
+        self.feature_index = feature_index
+        self.num_negatives = num_negatives
+        self.movie_columns = [name for name in movie_columns if name in feature_index]
+        self.score_name = score_name if score_name in feature_index else None
+        if self.score_name is not None:
+            if score_values is None or score_counts is None or np.sum(score_counts) <= 0:
+                raise ValueError('score_name requires the ratings of the negative examples')
+            self.score_values = np.asarray(score_values, dtype=np.float64)
+            self.score_prob = np.asarray(score_counts, dtype=np.float64) / np.sum(score_counts)
+
+        # only movies whose candidate-side features are known can be sampled
+        movie_counts = np.asarray(movie_counts, dtype=np.float64)[: movie_table.num_entities]
+        weights = np.zeros(movie_table.num_entities, dtype=np.float64)
+        weights[: len(movie_counts)] = np.power(movie_counts, power)
+        weights *= movie_table.has_history
+        weights[0] = 0  # 0 is mask value
+        self.alias_table = AliasTable(weights, seed=seed)
+
+        self.hist_ids = {
+            name: torch.from_numpy(ids) for name, ids in movie_table.hist_ids.items()
+        }
+        self.hist_length = {
+            name: torch.from_numpy(length) for name, length in movie_table.hist_length.items()
+        }
+
+    def sample_movies(self, excluded):
+        # one draw per entry of excluded, redrawn where it hits the positive movie
+        excluded = np.asarray(excluded)
+        movies = self.alias_table.sample(len(excluded))
+        collisions = np.flatnonzero(movies == excluded)
+        for _ in range(10):
+            if len(collisions) == 0:
+                break
+            movies[collisions] = self.alias_table.sample(len(collisions))
+            collisions = collisions[movies[collisions] == excluded[collisions]]
+        return movies
+
+    def sample_batch(self, x, y):
+        # x: [B, input_dim] model input or FeatureBatch, y: [B] labels
+        # -> batch with the sampled negatives appended
+        positive_rows = torch.nonzero(y.view(-1) > 0.5).view(-1)
+        if len(positive_rows) == 0 or self.num_negatives <= 0:
+            return x, y
+
+        x_neg = x.index_select(0, positive_rows).repeat_interleave(self.num_negatives, dim=0)
+        positive_movies = get_input(x_neg, self.feature_index, self.movie_columns[0])[:, 0]
+        movies = torch.from_numpy(self.sample_movies(positive_movies.long().cpu().numpy()))
+
+        # columns are views of x_neg, written in place
+        for name in self.movie_columns:
+            column = get_input(x_neg, self.feature_index, name)
+            column[:, 0] = movies.to(column.device, column.dtype)
+        for name, hist_ids in self.hist_ids.items():
+            column = get_input(x_neg, self.feature_index, name)
+            column[:] = hist_ids[movies][:, : column.shape[1]].to(column.device, column.dtype)
+        for name, hist_length in self.hist_length.items():
+            column = get_input(x_neg, self.feature_index, name)
+            column[:, 0] = hist_length[movies].to(column.device, column.dtype)
+        if self.score_name is not None:
+            # a rating of a negative example, consistent with the label 0 of the sampled rows
+            # (a constant rating would tell them apart from every real example)
+            scores = self.alias_table.rng.choice(
+                self.score_values, size=len(x_neg), p=self.score_prob
+            )
+            column = get_input(x_neg, self.feature_index, self.score_name)
+            column[:] = torch.from_numpy(scores).view(-1, 1).to(column.device, column.dtype)
+
+        y_neg = torch.zeros(len(x_neg), dtype=y.dtype, device=y.device)
+        return concat_inputs([x, x_neg]), torch.cat([y.view(-1), y_neg], dim=0)
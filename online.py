@@ -0,0 +1,255 @@
+# Online training from an append-only ratings log. Rating events are read as they are
+# appended (from a file, or a Unix socket streaming the same lines), the IC/UC histories
+# of users and movies are updated one event at a time and mini batches are formed on the fly,
+# so models keep learning from new ratings without regenerating the feature shards
+import os
+import time
+import stat
+import socket
+from collections import defaultdict, deque
+import numpy as np
+import torch
+
+from history_store import POSITIVE_RATING
+from inputs import FeatureBatch
+from precision import autocast
+
+
+# 'user::movie::rating::time' (.dat) or 'user,movie,rating,time' (.csv) -> (user, movie, rating)
+def parse_rating(line):
+    line = line.strip()
+    if not line:
+        return None
+    fields = line.split('::') if '::' in line else line.split(',')
+    if len(fields) < 3:
+        return None
+    try:
+        return int(fields[0]), int(fields[1]), float(fields[2])
+    except ValueError:
+        # csv header or corrupted line
+        return None
+
+
+class RatingLog(object):
+    """Rating events appended to a local log, yielded as they arrive.
+    None is yielded whenever no new event is available, so that consumers can act on idle time.
+    :param path: str, ratings file to tail, or a Unix socket that streams rating lines.
+    :param from_start: bool. Whether to replay the existing content of the file first.
+    :param poll_interval: float, seconds to wait before polling an idle log again.
+    :param read_size: int, number of bytes read at once.
+    """
+
+    def __init__(self, path, from_start=False, poll_interval=0.5, read_size=1 << 16):
+        self.path = path
+        self.from_start = from_start
+        self.poll_interval = poll_interval
+        self.read_size = read_size
+        self.num_malformed = 0
+
+    def _lines_from_file(self):
+        f = open(self.path, 'r')
+        if not self.from_start:
+            f.seek(0, os.SEEK_END)
+        pending = ''
+        try:
+            while True:
+                chunk = f.read(self.read_size)
+                if chunk:
+                    # a line is only complete once its newline has been written
+                    lines = (pending + chunk).split('\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        yield line
+                    continue
+
+                # the log was rotated or truncated, continue with the new file from its start
+                try:
+                    rotated = os.stat(self.path).st_ino != os.fstat(f.fileno()).st_ino
+                    truncated = os.path.getsize(self.path) < f.tell()
+                except FileNotFoundError:
+                    rotated, truncated = False, False
+                if rotated or truncated:
+                    f.close()
+                    f = open(self.path, 'r')
+                    pending = ''
+                    continue
+
+                yield None
+                time.sleep(self.poll_interval)
+        finally:
+            f.close()
+
+    def _lines_from_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.settimeout(self.poll_interval)
+        pending = b''
+        try:
+            while True:
+                try:
+                    chunk = sock.recv(self.read_size)
+                except socket.timeout:
+                    yield None
+                    continue
+                # the writer closed the stream
+                if not chunk:
+                    break
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8', errors='replace')
+        finally:
+            sock.close()
+
+    def __iter__(self):
+        if stat.S_ISSOCK(os.stat(self.path).st_mode):
+            lines = self._lines_from_socket()
+        else:
+            lines = self._lines_from_file()
+
+        for line in lines:
+            if line is None:
+                yield None
+                continue
+            event = parse_rating(line)
+            if event is None:
+                self.num_malformed += 1
+                continue
+            yield event
+
+
+# model input of a list of rating events, with the histories as they were before these events
+# history: RingBufferHistoryStore (see history_store.py)
+# hist_columns: {model input name: (npz history key, length column)} of the selected feature type
+def make_online_batch(events, history, feature_index, input_plan, hist_columns):
+    user_ids = np.array([event[0] for event in events], dtype=np.int64)
+    movie_ids = np.array([event[1] for event in events], dtype=np.int64)
+    ratings = np.array([event[2] for event in events], dtype=np.float32)
+
+    columns = {
+        'positive_user_id': user_ids,
+        'negative_user_id': user_ids,
+        'positive_movie_id': movie_ids,
+        'negative_movie_id': movie_ids,
+        'score': ratings,
+    }
+    columns.update(history.read_features(user_ids, movie_ids, hist_columns, feature_index))
+
+    for name in input_plan:
+        if name not in columns:
+            raise Exception(f'Model input {name} is not available from the ratings log')
+    y = (ratings >= POSITIVE_RATING).astype(np.float32)
+
+    return FeatureBatch.from_arrays(columns, input_plan), torch.from_numpy(y)
+
+
+# train the model continuously on the events of a rating log
+# checkpoint_fn(num_steps, train_history) is called every checkpoint_steps steps and at exit,
+# row_tracker: optional EmbeddingRowTracker updated after every backward pass (see checkpoint.py)
+def train_online(
+    model,
+    optimizer,
+    loss_function,
+    rating_log,
+    history,
+    hist_columns,
+    batch_size,
+    device,
+    metric_function=None,
+    max_batch_wait=1.0,
+    checkpoint_fn=None,
+    checkpoint_steps=1000,
+    max_steps=0,
+    num_steps=0,
+    train_history=None,
+    max_history_entries=10000,
+    verbose=True,
+    precision='fp32',
+    row_tracker=None,
+):
+    if train_history is None:
+        train_history = defaultdict(list)
+    # bounded statistics of the current checkpoint interval
+    interval_losses = deque(maxlen=max(checkpoint_steps, 1))
+    interval_metrics = deque(maxlen=max(checkpoint_steps, 1))
+    num_events, num_skipped = 0, 0
+    pending = []
+    last_batch_time = time.time()
+    model.train(True)
+
+    def save_checkpoint():
+        if interval_losses:
+            train_history['online_steps'].append(num_steps)
+            train_history['online_losses'].append(sum(interval_losses) / len(interval_losses))
+            if interval_metrics:
+                train_history['online_metrics'].append(
+                    sum(interval_metrics) / len(interval_metrics)
+                )
+            for values in train_history.values():
+                del values[:-max_history_entries]
+        if checkpoint_fn is not None:
+            checkpoint_fn(num_steps, train_history)
+        if verbose:
+            avg_loss = sum(interval_losses) / max(len(interval_losses), 1)
+            print(
+                f'Step {num_steps}: {num_events} events, {num_skipped} skipped, '
+                f'avg train loss {avg_loss}'
+            )
+        interval_losses.clear()
+        interval_metrics.clear()
+
+    try:
+        for event in rating_log:
+            if event is not None:
+                if history.accepts(event[0], event[1]):
+                    pending.append(event)
+                    num_events += 1
+                else:
+                    # ids outside of the model's vocabularies have no embedding
+                    num_skipped += 1
+
+            # train on full batches, and on incomplete ones once they waited long enough
+            waited = time.time() - last_batch_time >= max_batch_wait
+            if len(pending) < batch_size and not (pending and waited):
+                continue
+            events, pending = pending[:batch_size], pending[batch_size:]
+            last_batch_time = time.time()
+
+            # features come from the histories before the batch, which are updated right after
+            x, y = make_online_batch(
+                events, history, model.feature_index, model.input_plan, hist_columns
+            )
+            for user_id, movie_id, rating in events:
+                history.add(user_id, movie_id, rating)
+
+            x = x.to(device)
+            y = y.to(device)
+            with autocast(precision, device):
+                y_pred = model(x)
+            optimizer.zero_grad()
+            loss = loss_function(y_pred.view(-1), y.view(-1), reduction='sum')
+            interval_losses.append(loss.item())
+            if metric_function is not None:
+                try:
+                    interval_metrics.append(
+                        metric_function(y.cpu().data.numpy(), y_pred.view(-1).cpu().data.numpy())
+                    )
+                except ValueError:
+                    pass
+            loss.backward()
+            if row_tracker is not None:
+                row_tracker.update()
+            optimizer.step()
+            num_steps += 1
+
+            if checkpoint_steps > 0 and num_steps % checkpoint_steps == 0:
+                save_checkpoint()
+            if max_steps > 0 and num_steps >= max_steps:
+                break
+    except KeyboardInterrupt:
+        print('\nOnline training interrupted')
+
+    # the steps since the last checkpoint
+    if interval_losses:
+        save_checkpoint()
+    return num_steps, train_history
@@ -0,0 +1,192 @@
+# Optimizers with a separate path for the embedding tables. With sparse embedding gradients,
+# the embedding optimizer only reads and updates the rows looked up in the batch, so the cost
+# of a step does not depend on the vocabulary sizes, while the dense layers keep a standard
+# optimizer
+import torch
+import torch.nn as nn
+
+
+# parameters of the embedding tables of a model, and all its other parameters
+def split_embedding_parameters(model):
+    embedding_ids = set(
+        id(module.weight) for module in model.modules() if isinstance(module, nn.Embedding)
+    )
+    embedding_params, dense_params = [], []
+    for p in model.parameters():
+        if id(p) in embedding_ids:
+            embedding_params.append(p)
+        else:
+            dense_params.append(p)
+    return embedding_params, dense_params
+
+
+class RowWiseAdagrad(torch.optim.Optimizer):
+    """Adagrad with one accumulator per row of a 2D parameter (e.g. an embedding table), the
+    mean of the squared gradients of the row, instead of one per element. The optimizer state
+    of a table is then ``embedding_dim`` times smaller. Sparse gradients only update the rows
+    they hold.
+    :param params: iterable of 2D parameters.
+    :param lr: float, learning rate.
+    :param eps: float, added to the denominator for numerical stability.
+    :param initial_accumulator_value: float, starting value of the accumulators.
+    """
+
+    def __init__(self, params, lr=0.01, eps=1e-10, initial_accumulator_value=0.0):
+        defaults = dict(lr=lr, eps=eps, initial_accumulator_value=initial_accumulator_value)
+        super(RowWiseAdagrad, self).__init__(params, defaults)
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.dim() != 2:
+                    raise ValueError('RowWiseAdagrad only supports 2D parameters')
+                # created upfront, so that they can be moved to shared memory before any step
+                self.state[p]['sum'] = torch.full(
+                    (p.shape[0],),
+                    group['initial_accumulator_value'],
+                    dtype=p.dtype,
+                    device=p.device,
+                )
+
+    def share_memory(self):
+        for group in self.param_groups:
+            for p in group['params']:
+                self.state[p]['sum'].share_memory_()
+
+    def load_state_dict(self, state_dict):
+        super(RowWiseAdagrad, self).load_state_dict(state_dict)
+        # element-wise Adagrad accumulators (e.g. from a checkpoint saved with torch Adagrad)
+        for state in self.state.values():
+            if 'sum' in state and state['sum'].dim() == 2:
+                state['sum'] = state['sum'].mean(dim=1)
+            state.pop('step', None)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                state_sum = self.state[p]['sum']
+                if grad.is_sparse:
+                    grad = grad.coalesce()
+                    rows = grad.indices()[0]
+                    values = grad.values()
+                    state_sum.index_add_(0, rows, values.square().mean(dim=1))
+                    std = state_sum[rows].sqrt_().add_(group['eps'])
+                    p.index_add_(0, rows, values / std.unsqueeze(1), alpha=-group['lr'])
+                else:
+                    state_sum.add_(grad.square().mean(dim=1))
+                    std = state_sum.sqrt().add_(group['eps'])
+                    p.addcdiv_(grad, std.unsqueeze(1), value=-group['lr'])
+
+        return loss
+
+
+class SplitOptimizer(object):
+    """One optimizer for the embedding tables and one for the other parameters, stepped together.
+    :param embedding_optimizer: optimizer over the embedding weights, or None.
+    :param dense_optimizer: optimizer over the other parameters, or None.
+    :param params: list, all the parameters in model order, used to load the state of a single
+        optimizer over ``model.parameters()`` (e.g. a checkpoint saved without the split).
+    """
+
+    def __init__(self, embedding_optimizer, dense_optimizer, params=None):
+        self.embedding_optimizer = embedding_optimizer
+        self.dense_optimizer = dense_optimizer
+        self.params = params
+
+    @property
+    def optimizers(self):
+        return [
+            optimizer
+            for optimizer in (self.embedding_optimizer, self.dense_optimizer)
+            if optimizer is not None
+        ]
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def share_memory(self):
+        for optimizer in self.optimizers:
+            optimizer.share_memory()
+
+    def state_dict(self):
+        return {
+            'embedding': None
+            if self.embedding_optimizer is None
+            else self.embedding_optimizer.state_dict(),
+            'dense': None if self.dense_optimizer is None else self.dense_optimizer.state_dict(),
+        }
+
+    def load_state_dict(self, state_dict):
+        if 'embedding' not in state_dict:
+            state_dict = self._split_state_dict(state_dict)
+        if self.embedding_optimizer is not None:
+            self.embedding_optimizer.load_state_dict(state_dict['embedding'])
+        if self.dense_optimizer is not None:
+            self.dense_optimizer.load_state_dict(state_dict['dense'])
+
+    def _split_state_dict(self, state_dict):
+        # state of a single optimizer with one parameter group over self.params
+        if self.params is None or len(state_dict['param_groups']) != 1:
+            raise ValueError('Optimizer state does not match the split optimizer')
+        group = state_dict['param_groups'][0]
+        position = {id(p): i for i, p in enumerate(self.params)}
+        split = {}
+        for name, optimizer in (
+            ('embedding', self.embedding_optimizer),
+            ('dense', self.dense_optimizer),
+        ):
+            if optimizer is None:
+                split[name] = None
+                continue
+            params = [p for g in optimizer.param_groups for p in g['params']]
+            indices = [group['params'][position[id(p)]] for p in params]
+            hyperparams = {k: v for k, v in group.items() if k != 'params'}
+            split[name] = {
+                'state': {
+                    i: state_dict['state'][index]
+                    for i, index in enumerate(indices)
+                    if index in state_dict['state']
+                },
+                'param_groups': [dict(hyperparams, params=list(range(len(params))))],
+            }
+        return split
+
+
+EMBEDDING_OPTIMIZERS = {
+    'adagrad': torch.optim.Adagrad,
+    'rowwise_adagrad': RowWiseAdagrad,
+}
+
+
+# Adagrad over all the parameters, with a separate optimizer for the embedding tables when
+# they produce sparse gradients (Adagrad then only updates the rows of the batch) or when
+# they use another optimizer (see EMBEDDING_OPTIMIZERS)
+def build_optimizer(model, lr=0.01, sparse_embedding=False, embedding_optimizer='adagrad'):
+    if embedding_optimizer not in EMBEDDING_OPTIMIZERS:
+        raise ValueError(f'Unrecognized embedding optimizer {embedding_optimizer}')
+    if not sparse_embedding and embedding_optimizer == 'adagrad':
+        return torch.optim.Adagrad(model.parameters(), lr=lr)
+
+    embedding_params, dense_params = split_embedding_parameters(model)
+    embedding_optimizer = EMBEDDING_OPTIMIZERS[embedding_optimizer]
+    return SplitOptimizer(
+        embedding_optimizer(embedding_params, lr=lr) if embedding_params else None,
+        torch.optim.Adagrad(dense_params, lr=lr) if dense_params else None,
+        params=list(model.parameters()),
+    )
@@ -0,0 +1,21 @@
+# Precision of the forward passes. With bf16, forward passes run under torch.autocast, so that
+# linear layers, matmuls and RNN cells compute in bfloat16, while the parameters (the master
+# weights) and the optimizer states stay in float32 and receive float32 gradients.
+# bfloat16 keeps the float32 exponent range but only 8 bits of mantissa, so the layers that
+# are sensitive to rounding compute in float32 themselves: the masked attention softmax, the
+# batch norm statistics (Dice and DNN) and the output sigmoid, losses and metrics are then
+# computed on float32 predictions
+from contextlib import nullcontext
+
+import torch
+
+PRECISIONS = ['fp32', 'bf16']
+
+
+# context of the forward passes of a model on device in the given precision
+def autocast(precision, device='cpu'):
+    if precision == 'fp32':
+        return nullcontext()
+    if precision == 'bf16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    raise ValueError(f'Unrecognized precision {precision}')
@@ -7,6 +7,8 @@ import numpy as np
 import pandas as pd
 from multiprocessing import Process, cpu_count
 
+from manifest import update_manifest, reset_manifest, shard_stats
+
 
 
 # load and process MovieLens data
@@ -358,11 +360,37 @@ def make_features(data_type,
             np.savez(ic_uc_path, **arrays_to_save)
             print(f'IC/UC features has been saved to {ic_uc_path}')
 
+            # record the statistics of this shard in the dataset manifest
+            update_manifest(
+                output_dir,
+                os.path.basename(features_df_path),
+                shard_stats(
+                    features_df, arrays_to_save, feature_length, os.path.basename(ic_uc_path)
+                ),
+                data_type,
+                feature_length,
+            )
+
     # prepare multiprocessing
     print("Number of cpu : ", cpu_count())
     if num_process > cpu_count():
         raise Exception("Number of process should not exceed cpu count")
 
+    # start a fresh manifest seeded with the vocab sizes of the whole dataset
+    if save_feat:
+        reset_manifest(output_dir)
+        update_manifest(
+            output_dir,
+            None,
+            None,
+            data_type,
+            feature_length,
+            global_vocab={
+                'user_id': int(ratings_df['user_id'].max()) + 1,
+                'movie_id': int(ratings_df['movie_id'].max()) + 1,
+            },
+        )
+
     # truncate to prepare for multi-processing
     # num_truncate = int(np.floor(len(ratings_df) / 1e6))
     truncate_size = int(len(ratings_df) // num_process)
@@ -26,7 +26,8 @@ class SequencePoolingLayer(nn.Module):
         self.supports_masking = supports_masking
         self.mode = mode
         self.device = device
-        self.eps = torch.FloatTensor([1e-8]).to(device)
+        # a buffer follows the module across devices, without being saved in its state dict
+        self.register_buffer('eps', torch.FloatTensor([1e-8]).to(device), persistent=False)
         self.to(device)
 
     def _sequence_mask(self, lengths, maxlen=None, dtype=torch.bool):
@@ -64,7 +65,6 @@ class SequencePoolingLayer(nn.Module):
         hist = torch.sum(hist, dim=1, keepdim=False)
 
         if self.mode == 'mean':
-            self.eps = self.eps.to(user_behavior_length.device)
             hist = torch.div(hist, user_behavior_length.type(torch.float32) + self.eps)
 
         hist = torch.unsqueeze(hist, dim=1)
@@ -120,6 +120,8 @@ class AttentionSequencePoolingLayer(nn.Module):
         outputs = torch.transpose(attention_score, 1, 2)  # [B, 1, T]
 
         if self.weight_normalization:
+            # masked and normalized in float32, under autocast the scores may be half precision
+            outputs = outputs.float()
             paddings = torch.ones_like(outputs) * (-2 ** 32 + 1)
         else:
             paddings = torch.zeros_like(outputs)
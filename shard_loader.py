@@ -0,0 +1,382 @@
+# Loading and iterating mini batches over feature shards.
+# A shard is any object understood by the load_shard callable, which returns the
+# whole shard as (input, label) tensors
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from inputs import FeatureBatch
+from utils import TensorBatchIterator
+
+
+class LazyFeatureDict(Mapping):
+    """Read-only {feature name: array} mapping whose arrays are only loaded (and converted)
+    the first time they are accessed, and kept afterwards.
+    """
+
+    def __init__(self):
+        self._loaders = OrderedDict()
+        self._arrays = {}
+
+    def add(self, name, loader):
+        # loader: callable without arguments returning the array of the feature
+        self._loaders[name] = loader
+        self._arrays.pop(name, None)
+
+    def is_loaded(self, name):
+        return name in self._arrays
+
+    def project(self, names):
+        # sub mapping of the given features, sharing the already loaded arrays
+        projected = LazyFeatureDict()
+        for name in names:
+            if name not in self._loaders:
+                raise KeyError(name)
+            projected.add(name, lambda name=name: self[name])
+        return projected
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self._loaders[name]()
+        return self._arrays[name]
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+
+def tensors_nbytes(tensors):
+    return sum(
+        t.nbytes() if isinstance(t, FeatureBatch) else t.element_size() * t.nelement()
+        for t in tensors
+    )
+
+
+class ShardCache(object):
+    """Decoded shards kept in memory across epochs, so that shards seen again (e.g. the
+    validation set) are not parsed and tensorized again. Least recently used shards are evicted
+    once the cached tensors would take more than ``max_bytes``, pinned shards are never evicted.
+    Cached tensors are shared with the consumers and should not be modified in place.
+    Safe to call from the prefetching threads.
+    :param load_shard: callable, shard -> (input, label) tensors of the whole shard.
+    :param key_fn: callable, shard -> hashable key identifying the decoded content of the shard.
+    :param max_bytes: int, memory budget of the cached tensors.
+    """
+
+    def __init__(self, load_shard, key_fn, max_bytes):
+        self.load_shard = load_shard
+        self.key_fn = key_fn
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entries = OrderedDict()
+        self._pinned = set()
+        self._lock = threading.Lock()
+
+    def pin(self, shards):
+        # shards kept once loaded, whatever the memory pressure
+        with self._lock:
+            self._pinned.update(self.key_fn(shard) for shard in shards)
+
+    def _evict(self, num_bytes, pinned=False):
+        # make room for num_bytes, False when the pinned shards leave no room. Nothing is evicted
+        # then, unless the new shard is pinned (and cached anyway)
+        unpinned_bytes = sum(
+            tensors_nbytes(tensors)
+            for key, tensors in self._entries.items()
+            if key not in self._pinned
+        )
+        fits = self.nbytes - unpinned_bytes + num_bytes <= self.max_bytes
+        if not fits and not pinned:
+            return False
+        for key in list(self._entries):
+            if self.nbytes + num_bytes <= self.max_bytes:
+                break
+            if key in self._pinned:
+                continue
+            self.nbytes -= tensors_nbytes(self._entries.pop(key))
+        return fits
+
+    def __call__(self, shard):
+        key = self.key_fn(shard)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.num_hits += 1
+                return self._entries[key]
+            self.num_misses += 1
+
+        # decoded outside of the lock, other shards can be served meanwhile
+        tensors = self.load_shard(shard)
+        num_bytes = tensors_nbytes(tensors)
+        with self._lock:
+            if key not in self._entries:
+                # pinned shards are cached even when they exceed the budget
+                pinned = key in self._pinned
+                if self._evict(num_bytes, pinned) or pinned:
+                    self._entries[key] = tensors
+                    self.nbytes += num_bytes
+        return tensors
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ShardPrefetcher(object):
+    """Loads the next shards in background threads while the current one is being consumed.
+    Yields (shard, (input, label)) in the order of ``shards``.
+    :param shards: list of shards, loaded in order.
+    :param load_shard: callable, shard -> (input, label) tensors of the whole shard.
+    :param depth: int, number of shards loaded ahead of the consumer, 0 to load synchronously.
+    :param max_bytes: int or None, no shard is started while the shards loaded (or estimated from
+        the last loaded shard) ahead of the consumer would take more than this many bytes.
+    """
+
+    def __init__(self, shards, load_shard, depth=1, max_bytes=None):
+        self.shards = list(shards)
+        self.load_shard = load_shard
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.last_shard_bytes = 0
+
+    def _load(self, shard):
+        tensors = self.load_shard(shard)
+        self.last_shard_bytes = tensors_nbytes(tensors)
+        return tensors
+
+    def _can_start(self, in_flight):
+        if len(in_flight) >= self.depth:
+            return False
+        # always keep one shard in flight, otherwise the consumer would wait on the cap
+        if not in_flight or not self.max_bytes:
+            return True
+        ahead_bytes = self.last_shard_bytes
+        for _, future in in_flight:
+            if future.done() and future.exception() is None:
+                ahead_bytes += tensors_nbytes(future.result())
+            else:
+                ahead_bytes += self.last_shard_bytes
+        return ahead_bytes <= self.max_bytes
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for shard in self.shards:
+                yield shard, self._load(shard)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.depth) as executor:
+            in_flight = deque()
+            next_shard = 0
+            while in_flight or next_shard < len(self.shards):
+                while next_shard < len(self.shards) and self._can_start(in_flight):
+                    shard = self.shards[next_shard]
+                    in_flight.append((shard, executor.submit(self._load, shard)))
+                    next_shard += 1
+                shard, future = in_flight.popleft()
+                yield shard, future.result()
+
+
+# mini batches shard by shard, rows are only shuffled within each shard
+# sort_key_fn: optional callable, shard input -> [N] key of every row (e.g. history length),
+# shuffled rows are grouped by key within buckets of bucket_batches batches
+# seed: optional int, the rows of the shard at position n are shuffled by a generator seeded
+# with seed + n (instead of the global one), so that the batches of a shard can be drawn again.
+# The pass starts at shard position start_shard, after its first start_batch batches, and
+# progress (a dict) is set before every batch to the position right after it, {'shard': n,
+# 'batch': i} for the i-th batch of the shard at position n
+def iterate_shard_batches(
+    shards,
+    load_shard,
+    batch_size,
+    shuffle=True,
+    verbose=True,
+    prefetch_depth=0,
+    prefetch_max_bytes=None,
+    sort_key_fn=None,
+    bucket_batches=0,
+    seed=None,
+    start_shard=0,
+    start_batch=0,
+    progress=None,
+):
+    shards = list(shards)
+    prefetcher = ShardPrefetcher(
+        shards[start_shard:], load_shard, depth=prefetch_depth, max_bytes=prefetch_max_bytes
+    )
+    for n, (shard, (x, y)) in enumerate(prefetcher, start_shard):
+        if len(x) == 0:
+            continue
+
+        # without shuffle, batches are views of the shard tensors
+        sort_key = None
+        if shuffle and sort_key_fn is not None and bucket_batches > 0:
+            sort_key = sort_key_fn(x)
+        generator = None
+        if seed is not None:
+            generator = torch.Generator().manual_seed(seed + n)
+        skipped = start_batch if n == start_shard else 0
+        loader = TensorBatchIterator(
+            x,
+            y,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            generator=generator,
+            sort_key=sort_key,
+            bucket_batches=bucket_batches,
+            start_batch=skipped,
+        )
+        if verbose:
+            print(f'Batch {n+1}/{len(shards)}: {shard_name(shard)}, {len(x)} samples')
+        for i, (x_batch, y_batch) in enumerate(loader, skipped + 1):
+            if progress is not None:
+                progress['shard'], progress['batch'] = n, i
+            yield x_batch, y_batch
+
+
+def shard_name(shard):
+    # (file index, sparse feature path, hist feature path) shards as built by main.py
+    if isinstance(shard, tuple):
+        return f'file {shard[0]}'
+    return str(shard)
+
+
+class ShuffleBuffer(object):
+    """Mini batches mixed across shards through a bounded shuffle buffer.
+    Up to ``num_open_shards`` shards are read at the same time, rows are moved into the
+    buffer in small chunks from randomly chosen open shards (in a random order within each
+    shard), and every batch is drawn uniformly from the rows currently in the buffer.
+    The buffer memory is fixed to ``buffer_size`` rows.
+    :param shards: list of shards, consumed in order.
+    :param load_shard: callable, shard -> (input, label) tensors of the whole shard.
+    :param batch_size: int, number of rows per batch.
+    :param buffer_size: int, number of rows held by the shuffle buffer.
+    :param num_open_shards: int, number of shards interleaved at the same time.
+    :param chunk_size: int, number of rows moved from a shard into the buffer at once.
+    :param seed: integer ,to use as random seed.
+    :param verbose: bool. Whether to print every opened shard.
+    :param prefetch_depth: int, number of shards loaded ahead in background threads.
+    :param prefetch_max_bytes: int or None, memory cap of the shards loaded ahead.
+    :param start_batch: int, number of batches drawn without being yielded, to resume a pass
+        with the same seed after these batches (shards are still read to refill the buffer).
+    :param progress: dict or None, its 'batch' entry is set to the number of batches drawn so far
+        before every batch is yielded.
+    """
+
+    def __init__(
+        self,
+        shards,
+        load_shard,
+        batch_size,
+        buffer_size=65536,
+        num_open_shards=4,
+        chunk_size=1024,
+        seed=None,
+        verbose=True,
+        prefetch_depth=0,
+        prefetch_max_bytes=None,
+        start_batch=0,
+        progress=None,
+    ):
+        if buffer_size < batch_size:
+            raise ValueError('buffer_size should not be smaller than batch_size')
+        self.shards = list(shards)
+        self.load_shard = load_shard
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.num_open_shards = max(1, num_open_shards)
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.verbose = verbose
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_max_bytes = prefetch_max_bytes
+        self.start_batch = start_batch
+        self.progress = progress
+
+    def _open_shards(self, pending, open_shards, rng):
+        while len(open_shards) < self.num_open_shards:
+            loaded = next(pending, None)
+            if loaded is None:
+                break
+            shard, (x, y) = loaded
+            if len(x) == 0:
+                continue
+            if self.verbose:
+                print(f'Opened {shard_name(shard)}, {len(x)} samples')
+            # [input, label, row order, next position]
+            open_shards.append([x, y, torch.from_numpy(rng.permutation(len(x))), 0])
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        pending = iter(
+            ShardPrefetcher(
+                self.shards,
+                self.load_shard,
+                depth=self.prefetch_depth,
+                max_bytes=self.prefetch_max_bytes,
+            )
+        )
+        open_shards = []
+        buffer_x, buffer_y = None, None
+        filled = 0
+        num_batches = 0
+
+        while True:
+            self._open_shards(pending, open_shards, rng)
+
+            # fill the buffer from randomly chosen open shards
+            while filled < self.buffer_size and open_shards:
+                i = int(rng.integers(len(open_shards)))
+                x, y, order, position = open_shards[i]
+                if buffer_x is None:
+                    if isinstance(x, FeatureBatch):
+                        buffer_x = x.new_empty(self.buffer_size)
+                    else:
+                        buffer_x = torch.empty(
+                            (self.buffer_size,) + tuple(x.shape[1:]), dtype=x.dtype
+                        )
+                    buffer_y = torch.empty((self.buffer_size,) + tuple(y.shape[1:]), dtype=y.dtype)
+
+                num_rows = min(self.chunk_size, self.buffer_size - filled, len(x) - position)
+                rows = order[position : position + num_rows]
+                buffer_x[filled : filled + num_rows] = x[rows]
+                buffer_y[filled : filled + num_rows] = y[rows]
+                filled += num_rows
+                open_shards[i][3] += num_rows
+
+                # release exhausted shards and open the next ones
+                if open_shards[i][3] >= len(x):
+                    open_shards.pop(i)
+                    self._open_shards(pending, open_shards, rng)
+
+            if filled == 0:
+                break
+
+            # draw a batch uniformly from the buffer
+            num_rows = min(self.batch_size, filled)
+            picked = torch.from_numpy(rng.choice(filled, size=num_rows, replace=False))
+            num_batches += 1
+            skipped = num_batches <= self.start_batch
+            if not skipped:
+                x_batch, y_batch = buffer_x[picked], buffer_y[picked]
+
+            # move the kept rows of the buffer tail into the holes left by the batch
+            kept = torch.ones(filled, dtype=torch.bool)
+            kept[picked] = False
+            holes = picked[picked < filled - num_rows]
+            tail = torch.arange(filled - num_rows, filled)[kept[filled - num_rows :]]
+            buffer_x[holes] = buffer_x[tail]
+            buffer_y[holes] = buffer_y[tail]
+            filled -= num_rows
+
+            if skipped:
+                continue
+            if self.progress is not None:
+                self.progress['batch'] = num_batches
+            yield x_batch, y_batch
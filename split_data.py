@@ -6,6 +6,9 @@ import random
 import numpy as np
 import argparse
 
+from manifest import update_manifest, reset_manifest, shard_stats
+
+
 def get_stats(sparse_feature_path):
     num_ratings = 0
     unique_users = []
@@ -34,8 +37,13 @@ def split_data(
     data_type,
     all_sparse_feature_paths,
     all_hist_feature_paths,
+    global_vocab=None,
 ):
 
+    # fresh manifests for both splits, sharing the vocab of the whole dataset
+    for split_name in ['train', 'test']:
+        reset_manifest(os.path.join(output_dir, split_name))
+
     train_file_index = 0
     test_file_index = 0
     for i in range(len(all_sparse_feature_paths)):
@@ -84,6 +92,9 @@ def split_data(
         # labels
         labels = sparse_features['labels'].to_numpy()
 
+        # generated history width
+        feature_length = positive_ic_feature.shape[1]
+
         # train and test split based on loaded user_id (they should all be related)
         temp_train_indices = [np.where(user_id == cur_id) for cur_id in train_user_ids_list]
         train_indices = []
@@ -136,6 +147,21 @@ def split_data(
             np.savez(train_ic_uc_path, **train_arrays_to_save)
             print(f'Train IC/UC features has been saved to {train_ic_uc_path}')
 
+            # record the statistics of this shard in the split manifest
+            update_manifest(
+                os.path.join(output_dir, 'train'),
+                os.path.basename(train_df_path),
+                shard_stats(
+                    train_df,
+                    train_arrays_to_save,
+                    feature_length,
+                    os.path.basename(train_ic_uc_path),
+                ),
+                data_type,
+                feature_length,
+                global_vocab=global_vocab,
+            )
+
             # update train file index number
             train_file_index += 1
 
@@ -192,6 +218,21 @@ def split_data(
             np.savez(test_ic_uc_path, **test_arrays_to_save)
             print(f'Test IC/UC features has been saved to {test_ic_uc_path}')
 
+            # record the statistics of this shard in the split manifest
+            update_manifest(
+                os.path.join(output_dir, 'test'),
+                os.path.basename(test_df_path),
+                shard_stats(
+                    test_df,
+                    test_arrays_to_save,
+                    feature_length,
+                    os.path.basename(test_ic_uc_path),
+                ),
+                data_type,
+                feature_length,
+                global_vocab=global_vocab,
+            )
+
             # update train file index number
             test_file_index += 1
 
@@ -215,7 +256,7 @@ if __name__ == "__main__":
     output_dir = args.output_dir[0]
 
     # load files
-    num_files = len(os.listdir(feature_dir)) // 2
+    num_files = len([f for f in os.listdir(feature_dir) if f.endswith('.npz')])
     print(f'\n{num_files} data files loaded')
     file_indices = [i for i in range(num_files)]
     all_sparse_feature_paths, all_hist_feature_paths = [], []
@@ -228,6 +269,11 @@ if __name__ == "__main__":
         )
     all_unique_users, all_unique_movies, all_num_ratings = get_stats(all_sparse_feature_paths)
     print(f'Total: {len(all_unique_users)} users, {len(all_unique_movies)} movies and {all_num_ratings} ratings')
+    # vocab sizes are shared by train and test so that ids never exceed the embedding tables
+    global_vocab = {
+        'user_id': int(max(all_unique_users)) + 1,
+        'movie_id': int(max(all_unique_movies)) + 1,
+    }
 
     # split train and val/test based on users
     num_train_users = int(len(all_unique_users) * 0.8)
@@ -247,6 +293,7 @@ if __name__ == "__main__":
         data_type,
         all_sparse_feature_paths,
         all_hist_feature_paths,
+        global_vocab=global_vocab,
     )
 
     # save users list
@@ -0,0 +1,5 @@
+# the modules of the repository are imported from its root directory
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
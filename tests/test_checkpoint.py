@@ -0,0 +1,100 @@
+import os
+import copy
+
+import torch
+import torch.nn as nn
+
+from checkpoint import (
+    AsyncCheckpointWriter,
+    EmbeddingRowTracker,
+    apply_delta,
+    load_checkpoint,
+    DELTA_ROWS_KEY,
+)
+
+
+class TinyModel(nn.Module):
+    def __init__(self):
+        super(TinyModel, self).__init__()
+        self.embedding = nn.Embedding(10, 4)
+        self.linear = nn.Linear(4, 1)
+
+    def forward(self, ids):
+        return self.linear(self.embedding(ids)).sum()
+
+
+def train_step(model, optimizer, tracker, ids):
+    optimizer.zero_grad()
+    model(torch.tensor(ids)).backward()
+    tracker.update()
+    optimizer.step()
+
+
+def training_state(model, optimizer):
+    return {
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+    }
+
+
+def assert_same_state(loaded, expected):
+    for name, tensor in expected['model_state_dict'].items():
+        assert torch.equal(loaded['model_state_dict'][name], tensor), name
+    expected_states = expected['optimizer_state_dict']['state']
+    loaded_states = loaded['optimizer_state_dict']['state']
+    assert set(loaded_states) == set(expected_states)
+    for index, state in expected_states.items():
+        for key, value in state.items():
+            assert torch.equal(torch.as_tensor(loaded_states[index][key]), torch.as_tensor(value))
+
+
+def test_apply_delta_writes_changed_rows():
+    base = {'weight': torch.zeros(4, 2), 'bias': torch.zeros(2)}
+    delta = {
+        'weight': {DELTA_ROWS_KEY: torch.tensor([1, 3]), 'values': torch.ones(2, 2)},
+        'bias': torch.ones(2),
+    }
+    full = apply_delta(base, delta)
+    assert torch.equal(full['weight'], torch.tensor([[0., 0.], [1., 1.], [0., 0.], [1., 1.]]))
+    assert torch.equal(full['bias'], torch.ones(2))
+
+
+def test_base_plus_delta_equals_full_save(tmp_path):
+    torch.manual_seed(0)
+    model = TinyModel()
+    optimizer = torch.optim.Adagrad(model.parameters(), lr=0.1)
+    tracker = EmbeddingRowTracker(model, optimizer)
+    # small shards, so that the embedding table and its accumulators get their own files
+    writer = AsyncCheckpointWriter(min_shard_bytes=64, row_tracker=tracker, num_deltas=2)
+
+    saved = []
+    for step, ids in enumerate([[1, 3], [5], [3, 7]]):
+        train_step(model, optimizer, tracker, ids)
+        path = os.path.join(str(tmp_path), f'step_{step}.ckpt')
+        is_delta = writer.save(training_state(model, optimizer), path)
+        writer.wait()
+        assert is_delta == (step > 0)
+        saved.append((path, copy.deepcopy(training_state(model, optimizer))))
+    writer.close()
+
+    # deltas are cumulative since the full checkpoint, each one restores its own step
+    for path, expected in saved:
+        assert_same_state(load_checkpoint(path), expected)
+
+
+def test_full_save_resets_the_changed_rows(tmp_path):
+    torch.manual_seed(0)
+    model = TinyModel()
+    optimizer = torch.optim.Adagrad(model.parameters(), lr=0.1)
+    tracker = EmbeddingRowTracker(model, optimizer)
+    writer = AsyncCheckpointWriter(row_tracker=tracker, num_deltas=1)
+
+    train_step(model, optimizer, tracker, [2])
+    writer.save(training_state(model, optimizer), os.path.join(str(tmp_path), 'full.ckpt'))
+    writer.wait()
+    weight = model.embedding.weight
+    assert len(tracker.changed_rows()[weight.data_ptr()]) == 0
+
+    train_step(model, optimizer, tracker, [4, 4, 6])
+    assert tracker.changed_rows()[weight.data_ptr()].tolist() == [4, 6]
+    writer.close()
@@ -0,0 +1,67 @@
+import numpy as np
+
+from history_store import POSITIVE_RATING, RingBufferHistoryStore
+
+NUM_USERS, NUM_MOVIES, FEATURE_LENGTH = 6, 9, 4
+
+
+def random_events(num_events, seed=0):
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(1, NUM_USERS, size=num_events)
+    movie_ids = rng.integers(1, NUM_MOVIES, size=num_events)
+    ratings = rng.choice([1.0, 2.5, 4.0, 5.0], size=num_events)
+    return user_ids, movie_ids, ratings
+
+
+def naive_histories(user_ids, movie_ids, ratings):
+    # {npz history key: {entity: ids from the most recent}}
+    histories = {
+        'positive_ic_feature': {},
+        'negative_ic_feature': {},
+        'positive_uc_feature': {},
+        'negative_uc_feature': {},
+    }
+    for user_id, movie_id, rating in zip(user_ids, movie_ids, ratings):
+        polarity = 'positive' if rating >= POSITIVE_RATING else 'negative'
+        histories[f'{polarity}_ic_feature'].setdefault(user_id, []).insert(0, movie_id)
+        histories[f'{polarity}_uc_feature'].setdefault(movie_id, []).insert(0, user_id)
+    return histories
+
+
+def test_ring_buffer_keeps_the_latest_ids_past_capacity():
+    events = random_events(200)
+    store = RingBufferHistoryStore(NUM_USERS, NUM_MOVIES, FEATURE_LENGTH)
+    store.add_batch(*events)
+
+    user_ids = np.arange(NUM_USERS)
+    movie_ids = np.arange(NUM_MOVIES)[: NUM_USERS]
+    outputs = store.read(user_ids, movie_ids)
+    for key, history in naive_histories(*events).items():
+        entity_ids = user_ids if '_ic_' in key else movie_ids
+        for row, entity_id in enumerate(entity_ids):
+            expected = history.get(entity_id, [])[:FEATURE_LENGTH]
+            padded = expected + [0] * (FEATURE_LENGTH - len(expected))
+            assert outputs[key][row].tolist() == padded
+            assert outputs[f'{key}_length'][row] == len(expected)
+
+
+def test_restored_snapshot_reads_the_same_histories(tmp_path):
+    store = RingBufferHistoryStore(NUM_USERS, NUM_MOVIES, FEATURE_LENGTH)
+    store.add_batch(*random_events(50))
+    store.snapshot(str(tmp_path))
+    restored = RingBufferHistoryStore.restore(str(tmp_path))
+
+    user_ids = np.array([1, 2, 3, 4, 5, 1, 2, 3])
+    movie_ids = np.arange(1, NUM_MOVIES)
+    expected = store.read(user_ids, movie_ids)
+    outputs = restored.read(user_ids, movie_ids)
+    assert outputs.keys() == expected.keys()
+    for key in expected:
+        assert np.array_equal(outputs[key], expected[key])
+
+    # appends after the restore do not write into the snapshot files
+    restored.add_batch(*random_events(50, seed=1))
+    reloaded = RingBufferHistoryStore.restore(str(tmp_path), mmap_mode=None)
+    outputs = reloaded.read(user_ids, movie_ids)
+    for key in expected:
+        assert np.array_equal(outputs[key], expected[key])
@@ -0,0 +1,53 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from history_table import _StalePooledLookup
+
+NUM_ENTITIES, VOCABULARY_SIZE = 5, 10
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_stale_pooled_lookup_backward_matches_sum_pooling(sparse):
+    generator = torch.Generator().manual_seed(0)
+    splits = [3, 2]
+    # histories of different maxlen, masked by the same lengths
+    hist_ids = [
+        torch.randint(1, VOCABULARY_SIZE, (NUM_ENTITIES, maxlen), generator=generator)
+        for maxlen in (4, 3)
+    ]
+    hist_length = torch.tensor([0, 1, 4, 2, 3])
+    hist_mask = torch.arange(4).unsqueeze(0) < hist_length.unsqueeze(1)
+    pooled = torch.randn(NUM_ENTITIES, sum(splits), generator=generator)
+    entity_ids = torch.tensor([0, 2, 2, 4, 1])
+    grad_output = torch.randn(len(entity_ids), sum(splits), generator=generator)
+
+    weights = [
+        torch.randn(VOCABULARY_SIZE, dim, generator=generator, requires_grad=True)
+        for dim in splits
+    ]
+    output = _StalePooledLookup.apply(
+        entity_ids, pooled, hist_ids, hist_mask, splits, sparse, *weights
+    )
+    assert torch.equal(output, pooled[entity_ids])
+    (output * grad_output).sum().backward()
+
+    reference_weights = [weight.detach().clone().requires_grad_() for weight in weights]
+    reference = torch.cat(
+        [
+            F.embedding_bag(
+                ids[entity_ids],
+                weight,
+                mode='sum',
+                per_sample_weights=hist_mask[entity_ids, : ids.shape[1]].float(),
+            )
+            for ids, weight in zip(hist_ids, reference_weights)
+        ],
+        dim=-1,
+    )
+    (reference * grad_output).sum().backward()
+
+    for weight, reference_weight in zip(weights, reference_weights):
+        assert weight.grad.is_sparse == sparse
+        grad = weight.grad.to_dense() if sparse else weight.grad
+        assert torch.allclose(grad, reference_weight.grad, atol=1e-6)
@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+from inputs import (
+    DenseFeat,
+    FeatureBatch,
+    SparseFeat,
+    VarLenSparseFeat,
+    build_input_plan,
+    trim_histories,
+)
+
+MAXLEN = 16
+
+
+def make_batch(lengths):
+    hist_columns = [
+        VarLenSparseFeat(SparseFeat(name, 50), maxlen=MAXLEN, length_name='hist_length')
+        for name in ('hist_movie_id', 'hist_user_id')
+    ]
+    plan = build_input_plan([SparseFeat('user_id', 50), DenseFeat('score')] + hist_columns)
+    lengths = np.asarray(lengths)
+    positions = np.arange(MAXLEN)[None, :]
+    hist = np.where(positions < lengths[:, None], positions + 1, 0)
+    arrays = {
+        'user_id': np.arange(len(lengths)) + 1,
+        'score': np.linspace(0, 1, len(lengths)),
+        'hist_movie_id': hist,
+        'hist_user_id': hist * 2,
+        'hist_length': lengths,
+    }
+    return FeatureBatch.from_arrays(arrays, plan), hist_columns
+
+
+def test_trim_histories_cuts_to_the_longest_history():
+    X, hist_columns = make_batch([3, 5, 0, 2])
+    trimmed = trim_histories(X, hist_columns)
+    for fc in hist_columns:
+        assert trimmed.column(fc.name).shape == (4, 5)
+        assert torch.equal(trimmed.column(fc.name), X.column(fc.name)[:, :5])
+    for name in ('user_id', 'score', 'hist_length'):
+        assert torch.equal(trimmed.column(name), X.column(name))
+
+
+def test_trim_histories_rounds_to_a_power_of_two():
+    X, hist_columns = make_batch([3, 5, 0, 2])
+    trimmed = trim_histories(X, hist_columns, round_pow2=True)
+    for fc in hist_columns:
+        assert torch.equal(trimmed.column(fc.name), X.column(fc.name)[:, :8])
+
+    # at least one column is kept for batches without history
+    X, hist_columns = make_batch([0, 0])
+    assert trim_histories(X, hist_columns, round_pow2=True).column('hist_movie_id').shape == (2, 1)
@@ -0,0 +1,40 @@
+from manifest import load_manifest, update_manifest
+
+
+def shard(num_rows, num_positive, max_id, histogram):
+    return {
+        'hist_file': None,
+        'num_rows': num_rows,
+        'num_positive': num_positive,
+        'max_id': max_id,
+        'length_histogram': {'positive_ic_feature_length': histogram},
+    }
+
+
+def test_update_manifest_merges_the_shards(tmp_path):
+    data_dir = str(tmp_path)
+    # history lengths 0, 1, 1, 2 and 3, 3
+    first = shard(4, 1, {'user_id': 5, 'movie_id': 9}, [1, 2, 1])
+    second = shard(2, 2, {'user_id': 7}, [0, 0, 0, 2])
+    update_manifest(data_dir, 'shard_0', first, '10M', 3, global_vocab={'movie_id': 20})
+    update_manifest(data_dir, 'shard_1', second, '10M', 3)
+
+    manifest = load_manifest(data_dir)
+    # vocab sizes are the largest id + 1, never below the global ones
+    assert manifest['vocab'] == {'user_id': 8, 'movie_id': 20}
+    assert manifest['labels'] == {'num_rows': 6, 'num_positive': 3, 'positive_rate': 0.5}
+    history = manifest['history']['positive_ic_feature_length']
+    assert history['max'] == 3
+    assert abs(history['mean'] - 10 / 6) < 1e-9
+    assert history['p50'] == 1
+    assert history['p90'] == 3
+
+
+def test_update_manifest_replaces_a_shard_entry(tmp_path):
+    data_dir = str(tmp_path)
+    update_manifest(data_dir, 'shard_0', shard(4, 1, {'user_id': 5}, [1, 3]), '10M', 3)
+    update_manifest(data_dir, 'shard_0', shard(4, 1, {'user_id': 5}, [1, 3]), '10M', 3)
+
+    manifest = load_manifest(data_dir)
+    assert manifest['labels']['num_rows'] == 4
+    assert manifest['history']['positive_ic_feature_length']['max'] == 1
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from negative_sampling import AliasTable
+
+
+def test_alias_table_draws_follow_the_weights():
+    weights = np.array([0., 1., 3., 6.])
+    table = AliasTable(weights, seed=0)
+    draws = table.sample(200000)
+
+    frequencies = np.bincount(draws, minlength=len(weights)) / len(draws)
+    assert frequencies[0] == 0
+    assert np.allclose(frequencies, weights / weights.sum(), atol=0.01)
+
+
+def test_alias_table_is_reproducible_from_its_seed():
+    weights = np.arange(1, 50, dtype=np.float64)
+    assert np.array_equal(AliasTable(weights, seed=3).sample(100), AliasTable(weights, seed=3).sample(100))
+
+
+@pytest.mark.parametrize('weights', [[], [0., 0.], [1., -1.], [[1., 2.]]])
+def test_alias_table_rejects_invalid_weights(weights):
+    with pytest.raises(ValueError):
+        AliasTable(weights)
@@ -0,0 +1,59 @@
+import math
+
+import torch
+
+from optimizers import RowWiseAdagrad
+
+
+def make_table():
+    return torch.nn.Parameter(torch.tensor([[1., 2.], [3., 4.], [5., 6.]]))
+
+
+def test_rowwise_adagrad_matches_hand_computed_update():
+    table = make_table()
+    optimizer = RowWiseAdagrad([table], lr=0.1)
+    grad = torch.tensor([[1., 1.], [0., 0.], [2., 0.]])
+
+    # accumulators: mean squared gradient of every row, [1, 0, 2]
+    table.grad = grad.clone()
+    optimizer.step()
+    assert torch.allclose(optimizer.state[table]['sum'], torch.tensor([1., 0., 2.]))
+    # a row without gradient is left unchanged
+    expected = torch.tensor([[0.9, 1.9], [3., 4.], [5. - 0.2 / math.sqrt(2), 6.]])
+    assert torch.allclose(table.detach(), expected)
+
+    # accumulators grow to [2, 0, 4]
+    table.grad = grad.clone()
+    optimizer.step()
+    expected -= torch.tensor([[0.1 / math.sqrt(2), 0.1 / math.sqrt(2)], [0., 0.], [0.1, 0.]])
+    assert torch.allclose(optimizer.state[table]['sum'], torch.tensor([2., 0., 4.]))
+    assert torch.allclose(table.detach(), expected)
+
+
+def test_rowwise_adagrad_sparse_matches_dense():
+    dense_table, sparse_table = make_table(), make_table()
+    dense = RowWiseAdagrad([dense_table], lr=0.1)
+    sparse = RowWiseAdagrad([sparse_table], lr=0.1)
+
+    # row 2 appears twice, the uncoalesced values are summed
+    rows = torch.tensor([[2, 0, 2]])
+    values = torch.tensor([[1., 0.], [1., 1.], [1., 0.]])
+    sparse_table.grad = torch.sparse_coo_tensor(rows, values, (3, 2))
+    dense_table.grad = sparse_table.grad.to_dense()
+    dense.step()
+    sparse.step()
+
+    assert torch.allclose(sparse_table.detach(), dense_table.detach())
+    assert torch.allclose(sparse.state[sparse_table]['sum'], dense.state[dense_table]['sum'])
+
+
+def test_rowwise_adagrad_loads_elementwise_adagrad_state():
+    table = make_table()
+    adagrad = torch.optim.Adagrad([table], lr=0.1)
+    table.grad = torch.tensor([[1., 3.], [0., 2.], [2., 2.]])
+    adagrad.step()
+
+    optimizer = RowWiseAdagrad([table], lr=0.1)
+    optimizer.load_state_dict(adagrad.state_dict())
+    assert torch.allclose(optimizer.state[table]['sum'], torch.tensor([5., 2., 4.]))
+    assert 'step' not in optimizer.state[table]
@@ -0,0 +1,167 @@
+import pytest
+import torch
+
+from shard_loader import ShardCache, ShuffleBuffer, iterate_shard_batches, tensors_nbytes
+from utils import TensorBatchIterator
+
+# shards of consecutive row ids, (first row, number of rows)
+SHARDS = [(0, 37), (37, 5), (42, 0), (42, 61), (103, 20)]
+
+
+def load_range(shard):
+    start, num_rows = shard
+    x = torch.arange(start, start + num_rows).view(-1, 1)
+    return x, x.view(-1).float()
+
+
+def drawn_rows(batches):
+    return [x_batch.view(-1).tolist() for x_batch, _ in batches]
+
+
+def make_buffer(**kwargs):
+    kwargs.setdefault('seed', 7)
+    return ShuffleBuffer(
+        SHARDS,
+        load_range,
+        batch_size=8,
+        buffer_size=24,
+        num_open_shards=2,
+        chunk_size=5,
+        verbose=False,
+        **kwargs,
+    )
+
+
+class CountingLoader(object):
+    def __init__(self):
+        self.loaded = []
+
+    def __call__(self, shard):
+        self.loaded.append(shard)
+        return load_range(shard)
+
+
+def make_cache(max_shards):
+    # budget of max_shards shards of 10 rows
+    loader = CountingLoader()
+    max_bytes = max_shards * tensors_nbytes(load_range((0, 10)))
+    return ShardCache(loader, key_fn=lambda shard: shard[0], max_bytes=max_bytes), loader
+
+
+def test_shard_cache_evicts_the_least_recently_used_shard():
+    cache, loader = make_cache(2)
+    cache((0, 10))
+    cache((10, 10))
+    cache((0, 10))
+    cache((20, 10))
+    assert len(cache) == 2
+    assert loader.loaded == [(0, 10), (10, 10), (20, 10)]
+    assert (cache.num_hits, cache.num_misses) == (1, 3)
+
+    # 10 was evicted, 0 was used more recently
+    cache((0, 10))
+    assert cache.num_hits == 2
+    cache((10, 10))
+    assert loader.loaded[-1] == (10, 10)
+    assert cache.nbytes <= cache.max_bytes
+
+
+def test_shard_cache_never_evicts_pinned_shards():
+    cache, loader = make_cache(2)
+    cache.pin([(0, 10)])
+    for start in (0, 10, 20, 30):
+        cache((start, 10))
+    cache((0, 10))
+    assert loader.loaded == [(0, 10), (10, 10), (20, 10), (30, 10)]
+    assert cache.num_hits == 1
+
+
+def test_shard_cache_keeps_its_entries_for_an_oversized_shard():
+    cache, loader = make_cache(2)
+    cache((0, 10))
+    cache((10, 10))
+    x, _ = cache((20, 30))
+    assert len(x) == 30
+    assert len(cache) == 2
+    assert cache.nbytes == 2 * tensors_nbytes(load_range((0, 10)))
+
+    cache((0, 10))
+    cache((10, 10))
+    assert cache.num_hits == 2
+    assert loader.loaded == [(0, 10), (10, 10), (20, 30)]
+
+
+def test_shuffle_buffer_emits_every_row_once_per_epoch():
+    rows = [row for batch in drawn_rows(make_buffer()) for row in batch]
+    assert sorted(rows) == list(range(123))
+    for x_batch, y_batch in make_buffer():
+        assert torch.equal(x_batch.view(-1).float(), y_batch)
+
+
+def test_shuffle_buffer_order_is_fixed_by_the_seed():
+    assert drawn_rows(make_buffer(seed=3)) == drawn_rows(make_buffer(seed=3))
+    assert drawn_rows(make_buffer(seed=3)) != drawn_rows(make_buffer(seed=4))
+
+
+def test_shuffle_buffer_resumes_after_start_batch():
+    full = drawn_rows(make_buffer())
+    progress = {}
+    resumed = []
+    for x_batch, _ in make_buffer(start_batch=5, progress=progress):
+        resumed.append(x_batch.view(-1).tolist())
+        assert progress['batch'] == 5 + len(resumed)
+    assert resumed == full[5:]
+
+
+def iterate_with_dropout(batches):
+    # rows of every batch and a draw of the global RNG after it, as dropout would
+    for x_batch, _ in batches:
+        yield x_batch.view(-1).tolist(), torch.rand(1).item()
+
+
+def shard_batches(**kwargs):
+    return iterate_shard_batches(SHARDS, load_range, batch_size=8, verbose=False, seed=5, **kwargs)
+
+
+@pytest.mark.parametrize('num_trained', [1, 4, 5, 9, 12])
+def test_shard_batches_resume_from_the_progress(num_trained):
+    torch.manual_seed(0)
+    progress = {'shard': 0, 'batch': 0}
+    full, cursor = [], None
+    for step in iterate_with_dropout(shard_batches(progress=progress)):
+        full.append(step)
+        if len(full) == num_trained:
+            # what a mid-epoch checkpoint saves
+            cursor = dict(progress, rng_state=torch.get_rng_state())
+
+    torch.manual_seed(1)
+    batches = shard_batches(start_shard=cursor['shard'], start_batch=cursor['batch'])
+    torch.set_rng_state(cursor['rng_state'])
+    assert list(iterate_with_dropout(batches)) == full[num_trained:]
+
+
+def test_tensor_batch_iterator_start_batch_skips_the_first_batches():
+    x = torch.arange(50)
+    key = x % 7
+    full = [
+        batch.tolist()
+        for batch, in TensorBatchIterator(
+            x,
+            batch_size=6,
+            shuffle=True,
+            generator=torch.Generator().manual_seed(2),
+            sort_key=key,
+            bucket_batches=2,
+        )
+    ]
+    resumed = TensorBatchIterator(
+        x,
+        batch_size=6,
+        shuffle=True,
+        generator=torch.Generator().manual_seed(2),
+        sort_key=key,
+        bucket_batches=2,
+        start_batch=3,
+    )
+    assert len(resumed) == len(full) - 3
+    assert [batch.tolist() for batch, in resumed] == full[3:]
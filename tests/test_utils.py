@@ -0,0 +1,37 @@
+import torch
+
+from utils import TensorBatchIterator
+
+
+def test_bucketed_batches_hold_rows_of_one_length_bucket():
+    num_rows, batch_size, bucket_batches = 100, 8, 3
+    x = torch.arange(num_rows)
+    key = torch.randint(0, 20, (num_rows,), generator=torch.Generator().manual_seed(0))
+    loader = TensorBatchIterator(
+        x,
+        batch_size=batch_size,
+        shuffle=True,
+        generator=torch.Generator().manual_seed(1),
+        sort_key=key,
+        bucket_batches=bucket_batches,
+    )
+    batches = [batch for batch, in loader]
+    assert len(batches) == len(loader)
+    assert sorted(torch.cat(batches).tolist()) == list(range(num_rows))
+
+    # buckets are consecutive rows of the pass's permutation, drawn first from the generator
+    order = torch.randperm(num_rows, generator=torch.Generator().manual_seed(1))
+    bucket_rows = batch_size * bucket_batches
+    bucket_of = {}
+    for b, start in enumerate(range(0, num_rows, bucket_rows)):
+        bucket_of.update((row, b) for row in order[start : start + bucket_rows].tolist())
+
+    for batch in batches:
+        buckets = set(bucket_of[row] for row in batch.tolist())
+        assert len(buckets) == 1
+        # rows of the bucket outside of the batch are not within its key range
+        others = [
+            row for row, b in bucket_of.items() if b in buckets and row not in batch.tolist()
+        ]
+        low, high = key[batch].min(), key[batch].max()
+        assert not any(low < key[row] < high for row in others)
@@ -60,4 +60,81 @@ def slice_arrays(arrays, start=None, stop=None):
         elif hasattr(start, '__getitem__'):
             return arrays[start:stop]
         else:
-            return [None]
\ No newline at end of file
+            return [None]
+
+
+class TensorBatchIterator(object):
+    """Mini batches of row-aligned tensors, taken as whole slices instead of row by row.
+    With shuffle, one permutation is drawn per pass and every batch is gathered with a single
+    `index_select`; without it, batches are views of the tensors and nothing is copied.
+    Arguments:
+        tensors: tensors with the same first dimension.
+        batch_size: number of rows per batch.
+        shuffle: whether to visit the rows in a new random order on every pass.
+        generator: optional `torch.Generator` used to draw the permutations.
+        sort_key: optional 1D tensor, one key per row (e.g. history length). With shuffle and
+            `bucket_batches`, the shuffled rows are split in buckets of `bucket_batches` batches
+            and sorted by key within each bucket, so that every batch holds rows of similar keys.
+            The order of the batches is shuffled again afterwards.
+        bucket_batches: number of batches per bucket, 0 to disable bucketing.
+        start_batch: number of batches of the pass skipped without being gathered (e.g. to
+            resume a pass), the permutations are drawn as for a full pass.
+    """
+
+    def __init__(self, *tensors, batch_size=256, shuffle=False, generator=None, sort_key=None,
+                 bucket_batches=0, start_batch=0):
+        if not tensors:
+            raise ValueError('At least one tensor is required')
+        if any(len(t) != len(tensors[0]) for t in tensors):
+            raise ValueError('All tensors should have the same number of rows')
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        if sort_key is not None and len(sort_key) != len(tensors[0]):
+            raise ValueError('sort_key should have one key per row')
+        self.sort_key = sort_key
+        self.bucket_batches = bucket_batches
+        self.start_batch = start_batch
+
+    def _bucketed(self):
+        return self.shuffle and self.sort_key is not None and self.bucket_batches > 0
+
+    def __len__(self):
+        return max(self._num_batches() - self.start_batch, 0)
+
+    def _num_batches(self):
+        num_rows = len(self.tensors[0])
+        if not self._bucketed():
+            return (num_rows + self.batch_size - 1) // self.batch_size
+        # the last batch of every bucket may be incomplete
+        bucket_rows = self.batch_size * self.bucket_batches
+        num_full, remainder = divmod(num_rows, bucket_rows)
+        return num_full * self.bucket_batches + (remainder + self.batch_size - 1) // self.batch_size
+
+    def _bucket_batches(self, order):
+        # rows of every batch, sorted by key within buckets of consecutive shuffled rows
+        bucket_rows = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(order), bucket_rows):
+            bucket = order[start:start + bucket_rows]
+            _, by_key = torch.sort(self.sort_key[bucket], stable=True)
+            batches.extend(torch.split(bucket[by_key], self.batch_size))
+        # otherwise every bucket would go from short to long rows
+        batch_order = torch.randperm(len(batches), generator=self.generator)
+        return [batches[i] for i in batch_order.tolist()]
+
+    def __iter__(self):
+        num_rows = len(self.tensors[0])
+        if not self.shuffle:
+            for start in range(self.start_batch * self.batch_size, num_rows, self.batch_size):
+                yield tuple(t[start:start + self.batch_size] for t in self.tensors)
+            return
+
+        order = torch.randperm(num_rows, generator=self.generator)
+        if self._bucketed():
+            batches = self._bucket_batches(order)
+        else:
+            batches = torch.split(order, self.batch_size)
+        for rows in batches[self.start_batch:]:
+            yield tuple(t.index_select(0, rows.to(t.device)) for t in self.tensors)
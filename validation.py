@@ -0,0 +1,109 @@
+# Validation overlapped with training. At the end of an epoch the weights are copied into a
+# model in shared memory, and a worker process with its own thread budget validates them while
+# the parent process already trains the next epoch. The results are collected by the parent
+# whenever it polls, e.g. between training steps
+import copy
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+
+class AsyncValidator(object):
+    """Validation of epoch snapshots of a model in a worker process, on CPU.
+    The worker is forked by ``start``, it inherits the shard loading callables (and their caches)
+    of the parent, which should not be running other threads yet. A single snapshot is kept:
+    ``submit`` first waits for the validation of the previous one.
+    :param model: the trained model, copied once into shared memory.
+    :param validate: callable, (model, shards) -> result, run by the worker under no_grad with the
+        model in eval mode, the result is sent back to the parent (e.g. per batch losses).
+    :param num_threads: int, number of threads of the worker.
+    """
+
+    def __init__(self, model, validate, num_threads=1):
+        self.validate = validate
+        self.num_threads = num_threads
+        self.model = copy.deepcopy(model).cpu()
+        self.model.share_memory()
+        # fork keeps the closures of validate, which spawn could not pickle
+        self.context = mp.get_context('fork')
+        self.tasks = None
+        self.results = None
+        self.worker = None
+        self.num_pending = 0
+        self._received = []
+
+    def start(self):
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        self.worker = self.context.Process(target=self._work, daemon=True)
+        self.worker.start()
+
+    def _work(self):
+        torch.set_num_threads(self.num_threads)
+        self.model.train(False)
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            tag, shards = task
+            try:
+                with torch.no_grad():
+                    result = self.validate(self.model, shards)
+            except Exception:
+                self.results.put(('error', tag, traceback.format_exc()))
+                return
+            self.results.put(('done', tag, result))
+
+    def _receive(self, block):
+        # -> False when no result is available (without block)
+        while True:
+            try:
+                status, tag, result = self.results.get(block=block, timeout=1 if block else None)
+                break
+            except queue.Empty:
+                if not block:
+                    return False
+                if not self.worker.is_alive():
+                    raise Exception('Validation worker exited unexpectedly')
+        self.num_pending -= 1
+        if status == 'error':
+            self.close()
+            raise Exception(f'Validation worker failed:\n{result}')
+        self._received.append((tag, result))
+        return True
+
+    def submit(self, model, shards, tag):
+        # validate the current weights of model on shards, tag: returned with the result
+        if self.worker is None:
+            self.start()
+        while self.num_pending > 0:
+            self._receive(block=True)
+        # copied into the shared tensors read by the worker
+        self.model.load_state_dict(model.state_dict())
+        self.tasks.put((tag, list(shards)))
+        self.num_pending += 1
+
+    def poll(self):
+        # -> [(tag, result)] of the validations done since the last call, without waiting
+        while self.num_pending > 0 and self._receive(block=False):
+            pass
+        received, self._received = self._received, []
+        return received
+
+    def wait(self):
+        # -> [(tag, result)] as poll, once every submitted validation is done
+        while self.num_pending > 0:
+            self._receive(block=True)
+        return self.poll()
+
+    def close(self):
+        if self.worker is None:
+            return
+        if self.worker.is_alive():
+            self.tasks.put(None)
+        self.worker.join(timeout=10)
+        if self.worker.is_alive():
+            self.worker.terminate()
+        self.worker = None